@@ -0,0 +1,490 @@
+"""
+Benchmark / load simulation of transfer_auto.py.
+
+A synthetic BSS writes monitor.txt, .dataset_paths_for_kamo.txt and fake CBF/HDF5
+frames at a given rate under a temporary data_root, and transfer_auto.py runs as
+a separate process against a local S3 stand-in:
+  - s3cmd backend: a fake s3cmd (put / sync / sync --dry-run) storing objects in a
+    local directory, with optional per-request latency and bandwidth
+  - boto3 backend: moto's threaded server (if moto is installed)
+
+The report gives, per run: detection latency, time to upload and to kamo
+registration (from the state_db of the daemon), upload throughput, CPU time per
+sync cycle and peak memory (RSS) of the daemon.
+
+Examples:
+    python bench_transfer.py --datasets 5 --frames 200 --frame-kb 6000
+    python bench_transfer.py --matrix num_threads=2,8 --matrix wait_time=1,5
+    python bench_transfer.py --set dataset_mode=all --set engine=asyncio --json report.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import sqlite3
+import argparse
+import tempfile
+import itertools
+import threading
+import statistics
+import subprocess as sp
+
+import yaml
+
+# moto is optional (only for --backend boto3)
+try:
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BUCKET = "bench"
+
+# fake s3cmd: objects are stored as files under $BENCH_S3_ROOT/<bucket>/<key>
+FAKE_S3CMD = r'''
+import os, sys, time, shutil
+
+ROOT = os.environ["BENCH_S3_ROOT"]
+LATENCY = float(os.environ.get("BENCH_S3_LATENCY", "0"))
+BANDWIDTH = float(os.environ.get("BENCH_S3_BANDWIDTH", "0"))
+
+
+def object_path(url):
+    return os.path.join(ROOT, url[len("s3://"):])
+
+
+def put(local_path, url):
+    if url.endswith("/"):
+        url += os.path.basename(local_path)
+    size = os.path.getsize(local_path)
+    time.sleep(LATENCY + (size / BANDWIDTH if BANDWIDTH else 0))
+    target = object_path(url)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copyfile(local_path, target)
+    print(f"upload: '{local_path}' -> '{url}'  [1 of 1]")
+
+
+def sync_plan(local_dir, url):
+    # s3cmd と同じく, 末尾に / の無いディレクトリは <url>/<basename>/ の下に置く
+    base = url + os.path.basename(local_dir.rstrip("/")) + "/"
+    time.sleep(LATENCY)
+    for root, _dirs, files in os.walk(local_dir):
+        for name in sorted(files):
+            local_path = os.path.join(root, name)
+            remote = base + os.path.relpath(local_path, local_dir)
+            target = object_path(remote)
+            if not os.path.isfile(target) or os.path.getsize(target) != os.path.getsize(local_path):
+                print(f"upload: '{local_path}' -> '{remote}'")
+
+
+args = [a for a in sys.argv[1:] if not a.startswith("--")]
+flags = [a for a in sys.argv[1:] if a.startswith("--")]
+command, paths = args[0], args[1:]
+if command == "put":
+    put(paths[0], paths[1])
+elif command == "sync" and "--dry-run" in flags:
+    sync_plan(paths[0], paths[1])
+elif command == "sync":
+    if os.path.isdir(paths[0]):
+        sys.exit("fake s3cmd: only the sync of single files is supported")
+    put(paths[0], paths[1])
+else:
+    sys.exit(f"fake s3cmd: unsupported command {sys.argv[1:]}")
+'''
+
+
+# added BssSimulator 2026-10-17
+class BssSimulator:
+    """
+    Writes datasets the way BSS does: a line in monitor.txt pointing to
+    <data_root>/mxstaff/.dataset_paths_for_kamo.txt (auto measurement), one line
+    per dataset in that file, and the frames of the dataset at frame_interval.
+
+    line_written[dataset_path] is the time the line of each dataset was written.
+    """
+    def __init__(self, data_root: str, monitor_file: str, datasets: int, frames: int, frame_bytes: int,
+                 frame_interval: float, dataset_interval: float, frame_format: str = "cbf",
+                 line_timing: str = "start"):
+        self.data_root = data_root
+        self.monitor_file = monitor_file
+        self.datasets = datasets
+        self.frames = frames
+        self.frame_bytes = frame_bytes
+        self.frame_interval = frame_interval
+        self.dataset_interval = dataset_interval
+        self.frame_format = frame_format
+        self.line_timing = line_timing
+        self.kamo_file = os.path.join(data_root, "mxstaff", ".dataset_paths_for_kamo.txt")
+        self.line_written = {}
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.thread = None
+        # 同じ内容のフレームを書かないように, フレームごとに先頭のバイトを変える
+        self.payload = os.urandom(min(frame_bytes, 1024 * 1024))
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.kamo_file), exist_ok=True)
+        open(self.kamo_file, "a").close()
+        with open(self.monitor_file, "a") as fout:
+            fout.write(f"{self.kamo_file}\n")
+        self.thread = threading.Thread(target=self.run, name="bss", daemon=True)
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def write_payload(self, fout, index: int, nbytes: int):
+        fout.write(index.to_bytes(8, "little"))
+        remaining = nbytes - 8
+        while remaining > 0:
+            chunk = self.payload[:remaining]
+            fout.write(chunk)
+            remaining -= len(chunk)
+
+    def write_frame(self, path: str, index: int):
+        with open(path, "wb") as fout:
+            self.write_payload(fout, index, self.frame_bytes)
+        self.frames_written += 1
+        self.bytes_written += self.frame_bytes
+
+    def write_line(self, dataset_path: str):
+        self.line_written[dataset_path] = time.time()
+        with open(self.kamo_file, "a") as fout:
+            fout.write(f"{dataset_path}, 1, {self.frames}\n")
+
+    def run(self):
+        date = time.strftime("%y%m%d")
+        for i in range(self.datasets):
+            sample = f"sample{i:03d}"
+            frame_dir = os.path.join(self.data_root, "mxstaff", "Data", f"{date}_BENCH", sample, "data")
+            os.makedirs(frame_dir, exist_ok=True)
+            dataset_path = os.path.join(frame_dir, f"{sample}_*.cbf")
+            if self.line_timing == "start":
+                self.write_line(dataset_path)
+
+            if self.frame_format == "h5":
+                # HDF5: master ファイルと, 100 フレームごとの data ファイル
+                with open(os.path.join(frame_dir, f"{sample}_master.h5"), "wb") as fout:
+                    fout.write(b"\x89HDF\r\n\x1a\n" + bytes(4096))
+                for j in range(0, self.frames, 100):
+                    n = min(100, self.frames - j)
+                    with open(os.path.join(frame_dir, f"{sample}_data_{j // 100 + 1:06d}.h5"), "wb") as fout:
+                        for k in range(n):
+                            self.write_payload(fout, i * self.frames + j + k, self.frame_bytes)
+                    self.frames_written += n
+                    self.bytes_written += n * self.frame_bytes
+                    time.sleep(self.frame_interval * n)
+            else:
+                for j in range(1, self.frames + 1):
+                    self.write_frame(os.path.join(frame_dir, f"{sample}_{j:06d}.cbf"), i * self.frames + j)
+                    time.sleep(self.frame_interval)
+
+            if self.line_timing == "end":
+                self.write_line(dataset_path)
+            time.sleep(self.dataset_interval)
+
+#--- BssSimulator ---#
+
+
+# added ProcessSampler 2026-10-17
+class ProcessSampler:
+    """Samples the CPU time and RSS of a process from /proc (Linux)."""
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_seconds = 0.0
+        self.peak_rss = 0
+        self.rss_samples = []
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def sample(self):
+        try:
+            with open(f"/proc/{self.pid}/stat") as fin:
+                fields = fin.read().rsplit(")", 1)[1].split()
+            # utime, stime (子プロセスの s3cmd/xargs は cutime, cstime)
+            self.cpu_seconds = sum(int(f) for f in fields[11:15]) / self.ticks
+            with open(f"/proc/{self.pid}/status") as fin:
+                for line in fin:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) * 1024
+                        self.rss_samples.append(rss)
+                        self.peak_rss = max(self.peak_rss, rss)
+        except (OSError, IndexError, ValueError):
+            pass
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.sample()
+        self.stopped.set()
+        self.thread.join()
+
+#--- ProcessSampler ---#
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(values: list):
+    if not values:
+        return {"n": 0}
+    return {"n": len(values), "mean": statistics.mean(values), "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95), "max": max(values)}
+
+
+def start_s3_stand_in(args, workdir: str, env: dict, cfg: dict):
+    #--- local S3 stand-in; returns a function stopping it ---#
+    s3_root = os.path.join(workdir, "s3")
+    os.makedirs(os.path.join(s3_root, BUCKET), exist_ok=True)
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    # kamo のファイルは upload_backend に関わらず s3cmd で送られるので常に用意する
+    fake = os.path.join(bin_dir, "s3cmd")
+    with open(fake, "w") as fout:
+        fout.write(f"#!{sys.executable}\n{FAKE_S3CMD}")
+    os.chmod(fake, 0o755)
+    env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+    env["BENCH_S3_ROOT"] = s3_root
+    env["BENCH_S3_LATENCY"] = str(args.s3_latency)
+    env["BENCH_S3_BANDWIDTH"] = str(args.s3_bandwidth_mb * 1e6 if args.s3_bandwidth_mb else 0)
+
+    if cfg.get("upload_backend", "s3cmd") != "boto3":
+        return lambda: None
+
+    if ThreadedMotoServer is None:
+        sys.exit("--backend boto3 requires moto (pip install 'moto[server]')")
+    import boto3
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f"http://{host}:{port}"
+    env.update(AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", AWS_DEFAULT_REGION="us-east-1")
+    boto3.client("s3", endpoint_url=endpoint, aws_access_key_id="bench", aws_secret_access_key="bench",
+                 region_name="us-east-1").create_bucket(Bucket=BUCKET)
+    cfg["s3_endpoint_url"] = endpoint
+    cfg["s3_profile"] = None
+    return server.stop
+
+
+def read_states(state_db: str):
+    if not os.path.isfile(state_db):
+        return {}
+    conn = sqlite3.connect(f"file:{state_db}?mode=ro", uri=True)
+    try:
+        cursor = conn.execute("SELECT * FROM datasets")
+        columns = [c[0] for c in cursor.description]
+        return {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+
+def read_metrics(snapshot_file: str):
+    try:
+        with open(snapshot_file) as fin:
+            return json.load(fin).get("metrics", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def run_once(args, overrides: dict):
+    #--- one simulated beamtime with the given config overrides; returns the report ---#
+    workdir = tempfile.mkdtemp(prefix="bench_transfer_")
+    data_root = os.path.join(workdir, "data")
+    with open(os.path.join(REPO_DIR, "transfer_auto_config.yaml")) as fin:
+        cfg = yaml.safe_load(fin)
+    cfg.update({
+        "bss_dataset_path": os.path.join(workdir, "monitor.txt"),
+        "destination_path_via_s3": f"s3://{BUCKET}/mxdata/",
+        "destination_path_via_aoba": os.path.join(workdir, "aoba"),
+        "data_root": data_root,
+        "upload_backend": args.backend,
+        "state_db": os.path.join(workdir, "state.sqlite"),
+        "metrics_port": None,
+        "metrics_snapshot_file": os.path.join(workdir, "metrics.json"),
+        "metrics_snapshot_interval": 1,
+        "xds_dispatch": None,
+    })
+    for key in ("offset_state_file", "manifest_db", "checksum_db", "retry_db", "xds_state_file"):
+        if cfg.get(key):
+            cfg[key] = os.path.join(workdir, os.path.basename(cfg[key]))
+    cfg.update(overrides)
+
+    env = dict(os.environ)
+    stop_s3 = start_s3_stand_in(args, workdir, env, cfg)
+    with open(os.path.join(workdir, "transfer_auto_config.yaml"), "w") as fout:
+        yaml.safe_dump(cfg, fout)
+
+    bss = BssSimulator(data_root, cfg["bss_dataset_path"], args.datasets, args.frames, int(args.frame_kb * 1024),
+                       args.frame_interval, args.dataset_interval, args.format, args.line_timing)
+    open(cfg["bss_dataset_path"], "a").close()
+    daemon = sp.Popen([sys.executable, os.path.join(REPO_DIR, "transfer_auto.py")], cwd=workdir, env=env,
+                      stdout=sp.DEVNULL, stderr=sp.STDOUT)
+    sampler = ProcessSampler(daemon.pid)
+    started = time.time()
+    bss.start()
+
+    # 全てのデータセットが転送される（--wait-for kamo の場合は kamo に登録される）か timeout まで待つ
+    done_states = ("kamo_registered",) if args.wait_for == "kamo" else ("uploaded", "kamo_registered")
+    deadline = started + args.timeout
+    while time.time() < deadline and daemon.poll() is None:
+        time.sleep(0.5)
+        if bss.thread.is_alive():
+            continue
+        states = read_states(cfg["state_db"])
+        if all(states.get(p, {}).get("state") in done_states for p in bss.line_written):
+            break
+    elapsed = time.time() - started
+
+    daemon.send_signal(signal.SIGTERM)
+    try:
+        daemon.wait(timeout=60)
+    except sp.TimeoutExpired:
+        daemon.kill()
+    sampler.stop()
+    stop_s3()
+
+    states = read_states(cfg["state_db"])
+    metrics = read_metrics(cfg["metrics_snapshot_file"])
+    detection, upload, kamo = [], [], []
+    for dataset_path, written in bss.line_written.items():
+        entry = states.get(dataset_path)
+        if entry is None:
+            continue
+        if entry["created_at"]:
+            detection.append(entry["created_at"] - written)
+        # uploaded_at は最後に同期した時刻なので, 先に kamo に登録されていればその時刻を転送完了とみなす
+        uploaded_at = min(t for t in (entry["uploaded_at"], entry["registered_at"]) if t) \
+            if entry["uploaded_at"] or entry["registered_at"] else None
+        if uploaded_at:
+            upload.append(uploaded_at - written)
+        if entry["registered_at"]:
+            kamo.append(entry["registered_at"] - written)
+
+    uploaded_bytes = sum(v for k, v in metrics.items() if k.startswith("transfer_uploaded_bytes_total"))
+    uploaded_times = [e["uploaded_at"] for e in states.values() if e["uploaded_at"]]
+    upload_span = (max(uploaded_times) - started) if uploaded_times else elapsed
+    cycles = metrics.get("transfer_cycle_seconds_count", 0)
+    report = {
+        "settings": overrides,
+        "datasets": args.datasets,
+        "frames_written": bss.frames_written,
+        "bytes_written": bss.bytes_written,
+        "elapsed_seconds": elapsed,
+        "datasets_uploaded": len(upload),
+        "datasets_kamo_registered": len(kamo),
+        "detection_latency": summarize(detection),
+        "time_to_upload": summarize(upload),
+        "time_to_kamo": summarize(kamo),
+        "uploaded_bytes": uploaded_bytes,
+        "throughput_mb_s": uploaded_bytes / max(upload_span, 1e-6) / 1e6,
+        "cycles": cycles,
+        "cycle_seconds_mean": metrics.get("transfer_cycle_seconds_sum", 0) / cycles if cycles else None,
+        "cpu_seconds": sampler.cpu_seconds,
+        "cpu_seconds_per_cycle": sampler.cpu_seconds / cycles if cycles else None,
+        "peak_rss_mb": sampler.peak_rss / 1e6,
+        "workdir": workdir,
+    }
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+        report["workdir"] = None
+    return report
+
+
+def format_value(value, digits: int = 2):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.{digits}f}"
+    return str(value)
+
+
+def print_report(reports: list):
+    columns = [
+        ("settings", lambda r: " ".join(f"{k}={v}" for k, v in r["settings"].items()) or "(default)"),
+        ("uploaded", lambda r: f"{r['datasets_uploaded']}/{r['datasets']}"),
+        ("kamo", lambda r: f"{r['datasets_kamo_registered']}/{r['datasets']}"),
+        ("detect p50/max [s]", lambda r: f"{format_value(r['detection_latency'].get('p50'))}/"
+                                         f"{format_value(r['detection_latency'].get('max'))}"),
+        ("upload p50/max [s]", lambda r: f"{format_value(r['time_to_upload'].get('p50'))}/"
+                                         f"{format_value(r['time_to_upload'].get('max'))}"),
+        ("kamo p50/max [s]", lambda r: f"{format_value(r['time_to_kamo'].get('p50'))}/"
+                                       f"{format_value(r['time_to_kamo'].get('max'))}"),
+        ("MB/s", lambda r: format_value(r["throughput_mb_s"])),
+        ("cycles", lambda r: format_value(r["cycles"])),
+        ("CPU/cycle [s]", lambda r: format_value(r["cpu_seconds_per_cycle"], 3)),
+        ("peak RSS [MB]", lambda r: format_value(r["peak_rss_mb"], 1)),
+    ]
+    rows = [[name for name, _f in columns]] + [[f(r) for _name, f in columns] for r in reports]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for n, row in enumerate(rows):
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+        if n == 0:
+            print("  ".join("-" * width for width in widths))
+
+
+def parse_assignment(text: str):
+    key, _, value = text.partition("=")
+    if not key or not _:
+        raise argparse.ArgumentTypeError(f"expected key=value: {text}")
+    return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transfer_auto.py with a simulated BSS and a local S3.")
+    parser.add_argument("--datasets", type=int, default=3, help="number of datasets")
+    parser.add_argument("--frames", type=int, default=100, help="frames per dataset")
+    parser.add_argument("--frame-kb", type=float, default=256, help="size of one frame in KiB")
+    parser.add_argument("--frame-interval", type=float, default=0.01, help="seconds between frames")
+    parser.add_argument("--dataset-interval", type=float, default=1.0, help="seconds between datasets")
+    parser.add_argument("--format", choices=("cbf", "h5"), default="cbf", help="frame file format")
+    parser.add_argument("--line-timing", choices=("start", "end"), default="start",
+                        help="write the .dataset_paths_for_kamo.txt line at the start or the end of a dataset")
+    parser.add_argument("--backend", choices=("s3cmd", "boto3"), default="s3cmd", help="upload_backend")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="latency of the S3 stand-in per request [s]")
+    parser.add_argument("--s3-bandwidth-mb", type=float, default=None,
+                        help="bandwidth of the fake s3cmd per request [MB/s]")
+    parser.add_argument("--wait-for", choices=("upload", "kamo"), default="upload",
+                        help="finish a run once every dataset is uploaded or registered to kamo")
+    parser.add_argument("--timeout", type=float, default=300, help="maximum seconds per run")
+    parser.add_argument("--set", dest="settings", type=parse_assignment, action="append", default=[],
+                        metavar="KEY=VALUE", help="config override for every run (YAML value)")
+    parser.add_argument("--matrix", type=parse_assignment, action="append", default=[], metavar="KEY=V1,V2",
+                        help="run every combination of these config values")
+    parser.add_argument("--json", metavar="FILE", help="write the reports as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the working directories (logs, S3 stand-in)")
+    args = parser.parse_args()
+
+    base = {key: yaml.safe_load(value) for key, value in args.settings}
+    keys = [key for key, _values in args.matrix]
+    choices = [[yaml.safe_load(v) for v in values.split(",")] for _key, values in args.matrix]
+
+    reports = []
+    for combination in itertools.product(*choices):
+        overrides = dict(base, **dict(zip(keys, combination)))
+        print(f"Running {overrides or '(default)'} ...", file=sys.stderr)
+        report = run_once(args, overrides)
+        reports.append(report)
+        if report["workdir"]:
+            print(f"  working directory: {report['workdir']}", file=sys.stderr)
+
+    print_report(reports)
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump(reports, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
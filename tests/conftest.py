@@ -0,0 +1,10 @@
+import logging
+import os
+import sys
+
+# transfer_auto は import 時に logging.basicConfig(filename='transfer.log') を実行するので,
+# 先に root logger にハンドラを付けてリポジトリの transfer.log に書き込まないようにする
+logging.getLogger().addHandler(logging.NullHandler())
+logging.getLogger().setLevel(logging.DEBUG)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,125 @@
+import json
+import os
+import time
+
+import pytest
+import yaml
+
+import transfer_auto as ta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def auto(tmp_path):
+    #--- AutoTransferAndProcess in bundle_mode with an auto measurement data directory of 3 frames ---#
+    data_root = tmp_path / "data"
+    frame_dir = data_root / "mxstaff" / "Data" / "261017_BL" / "s1" / "data"
+    frame_dir.mkdir(parents=True)
+    old = time.time() - 60
+    for i in range(1, 4):
+        frame = frame_dir / f"s1_{i:06d}.cbf"
+        frame.write_bytes(os.urandom(1000))
+        os.utime(frame, (old, old))
+    kamo_file = data_root / "mxstaff" / ".dataset_paths_for_kamo.txt"
+    kamo_file.write_text(f"{frame_dir}/s1_*.cbf, 1, 3\n")
+    monitor = tmp_path / "monitor.txt"
+    monitor.write_text(f"{kamo_file}\n")
+
+    with open(os.path.join(REPO_DIR, "transfer_auto_config.yaml")) as fin:
+        cfg = yaml.safe_load(fin)
+    cfg.update(bss_dataset_path=str(monitor), data_root=str(data_root),
+               destination_path_via_aoba=str(tmp_path / "aoba"), bundle_mode=True,
+               bundle_spool_dir=str(tmp_path / "spool"), stream_stable_seconds=0)
+    auto = ta.AutoTransferAndProcess(cfg)
+    auto.test_dataset_path = f"{frame_dir}/s1_*.cbf"
+    auto.test_kamo_file = str(kamo_file)
+
+    # S3 の代わりに remote (URL -> 内容) に書き込む. fail に含まれる名前のファイルは失敗させる
+    auto.remote = {}
+    auto.fail = set()
+
+    def upload_file_list(uploads, num_threads=None, preempt=None):
+        uploaded = set()
+        for local_path, s3_url in uploads:
+            if os.path.basename(s3_url) in auto.fail:
+                continue
+            with open(local_path, "rb") as fin:
+                auto.remote[s3_url] = fin.read()
+            uploaded.add(local_path)
+        return uploaded
+    auto.upload_file_list = upload_file_list
+    yield auto
+    auto.shutdown()
+
+
+def remote_index(auto):
+    for url, body in auto.remote.items():
+        if url.endswith("/_bundle/index.json"):
+            return json.loads(body)
+    return None
+
+
+def test_bundles_and_index_are_uploaded(auto):
+    assert auto.transfer_bundled(auto.test_dataset_path)
+    index = remote_index(auto)
+    assert sorted(index["frames"]) == ["s1_000001.cbf", "s1_000002.cbf", "s1_000003.cbf"]
+    assert index["bundles"] == ["bundle_0000.tar"]
+    # 2 回目は新しいフレームが無いので何も送らない
+    auto.remote.clear()
+    assert auto.transfer_bundled(auto.test_dataset_path)
+    assert auto.remote == {}
+
+
+def test_failed_index_upload_is_retried(auto):
+    auto.fail.add("index.json")
+    assert not auto.transfer_bundled(auto.test_dataset_path)
+    assert remote_index(auto) is None
+    # 新しいフレームが無くても, 前回失敗した index は再送する
+    assert not auto.transfer_bundled(auto.test_dataset_path)
+
+    auto.fail.clear()
+    assert auto.transfer_bundled(auto.test_dataset_path)
+    assert len(remote_index(auto)["frames"]) == 3
+    # bundle は作り直さない
+    assert [url for url in auto.remote if url.endswith(".tar")] == [
+        url for url in auto.remote if url.endswith("bundle_0000.tar")]
+
+
+def test_unbundle_directory_restores_the_frames(auto, tmp_path):
+    assert auto.transfer_bundled(auto.test_dataset_path)
+    # AOBA 側と同じく, _bundle/ の下に bundle と index.json のみがあるディレクトリで展開する
+    aoba_dir = tmp_path / "aoba_data"
+    (aoba_dir / "_bundle").mkdir(parents=True)
+    for url, body in auto.remote.items():
+        (aoba_dir / "_bundle" / os.path.basename(url)).write_bytes(body)
+
+    assert ta.unbundle_directory(str(aoba_dir)) == 3
+    frame_dir = os.path.dirname(auto.test_dataset_path)
+    for name in ("s1_000001.cbf", "s1_000002.cbf", "s1_000003.cbf"):
+        with open(os.path.join(frame_dir, name), "rb") as fin:
+            assert (aoba_dir / name).read_bytes() == fin.read()
+
+
+def test_bundled_dataset_is_registered_to_kamo_after_unbundling(auto, tmp_path):
+    ssh_log = tmp_path / "ssh.log"
+    stub_ssh = tmp_path / "ssh"
+    stub_ssh.write_text(f"#!/bin/sh\necho \"$@\" >> {ssh_log}\n")
+    stub_ssh.chmod(0o755)
+    auto.restore_command = "python3 transfer_auto.py"
+    auto.restore_ssh_command = str(stub_ssh)
+    uploaded_kamo_files = []
+    auto.kamo_writer.upload = lambda local_path, remote_url: uploaded_kamo_files.append(local_path)
+
+    # 復元する前は dataset_paths_for_kamo.txt に書かない
+    auto.write_kamo_dataset_file(auto.test_dataset_path, data_origin=1, data_total=3)
+    assert uploaded_kamo_files == []
+
+    auto.register_restored_kamo(auto.test_dataset_path, 3, auto.test_kamo_file)
+    auto.register_restored_kamo(auto.test_dataset_path, 3, auto.test_kamo_file)
+    # 復元は 1 回だけ行い, 通常のエントリを登録する
+    assert ssh_log.read_text().count("--unbundle") == 1
+    local_path, _remote_url, entry = auto.kamo_entry(auto.test_dataset_path, 1, 3)
+    assert uploaded_kamo_files == [local_path]
+    with open(local_path) as fin:
+        assert fin.read().strip() == entry
@@ -0,0 +1,53 @@
+import time
+
+import transfer_auto as ta
+
+
+def test_failures_are_retried_with_backoff(tmp_path):
+    queue = ta.RetryQueue(str(tmp_path / "retry.sqlite"), base_delay=60, max_delay=600)
+    try:
+        queue.record_failures([("/data/a/1.cbf", "s3://b/a/1.cbf", "timeout")], dataset_path="/data/a")
+        # 次の試行は base_delay の 50% - 100% 後
+        assert queue.due() == []
+        assert queue.has_pending("/data/a")
+        assert queue.counts() == {"pending": 1}
+        (next_attempt,) = queue.conn.execute("SELECT next_attempt FROM retries").fetchone()
+        assert 30 <= next_attempt - time.time() <= 60
+    finally:
+        queue.close()
+
+
+def test_due_files_and_success(tmp_path):
+    queue = ta.RetryQueue(str(tmp_path / "retry.sqlite"), base_delay=0)
+    try:
+        queue.record_failures([("/data/a/1.cbf", "s3://b/a/1.cbf", "timeout"),
+                               ("/data/a/2.cbf", "s3://b/a/2.cbf", "timeout")], dataset_path="/data/a")
+        queue.record_failures([("/data/a/1.cbf", "s3://b/a/1.cbf", "timeout")])
+        due = {local_path: (remote, dataset_path, attempts) for local_path, remote, dataset_path, attempts in queue.due()}
+        # 2 回目の失敗でも dataset_path は引き継ぐ
+        assert due == {"/data/a/1.cbf": ("s3://b/a/1.cbf", "/data/a", 2),
+                       "/data/a/2.cbf": ("s3://b/a/2.cbf", "/data/a", 1)}
+
+        queue.record_success(["/data/a/1.cbf", "/data/a/2.cbf"])
+        assert queue.due() == []
+        assert not queue.has_pending("/data/a")
+    finally:
+        queue.close()
+
+
+def test_file_is_given_up_after_max_attempts(tmp_path):
+    db_path = str(tmp_path / "retry.sqlite")
+    queue = ta.RetryQueue(db_path, base_delay=0, max_attempts=2)
+    failure = [("/data/a/1.cbf", "s3://b/a/1.cbf", "AccessDenied")]
+    assert queue.record_failures(failure, dataset_path="/data/a") == []
+    assert queue.record_failures(failure) == ["/data/a/1.cbf"]
+    queue.close()
+
+    # 諦めたファイルは再送しないが, 再起動後も記録は残る
+    queue = ta.RetryQueue(db_path, base_delay=0, max_attempts=2)
+    try:
+        assert queue.due() == []
+        assert queue.counts() == {"failed": 1}
+        assert queue.has_pending("/data/a")
+    finally:
+        queue.close()
@@ -0,0 +1,204 @@
+import os
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+import transfer_auto as ta
+
+BUCKET = "mxdata"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    # moto のダミーの認証情報（実際の S3 には接続しない）
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_frames(directory, n, size=1000):
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(1, n + 1):
+        path = os.path.join(directory, f"sample_{i:06d}.cbf")
+        with open(path, "wb") as fout:
+            fout.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def object_body(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_sync_directory_uploads_missing_files_only(s3, tmp_path):
+    frame_dir = str(tmp_path / "data")
+    frames = make_frames(frame_dir, 3)
+    uploader = ta.S3Uploader(2)
+    try:
+        result = uploader.sync_directory(frame_dir, f"s3://{BUCKET}/mxstaff/")
+        assert sorted(result["uploaded"]) == frames
+        assert not result["failed"]
+        for path in frames:
+            with open(path, "rb") as fin:
+                assert object_body(s3, f"mxstaff/data/{os.path.basename(path)}") == fin.read()
+
+        # 2 回目は S3 側の一覧と同じなので何も送らない
+        result = uploader.sync_directory(frame_dir, f"s3://{BUCKET}/mxstaff/")
+        assert result["uploaded"] == []
+    finally:
+        uploader.close()
+
+
+def test_upload_files_reports_failed_files(s3, tmp_path):
+    frames = make_frames(str(tmp_path / "data"), 2)
+    uploader = ta.S3Uploader(2)
+    try:
+        result = uploader.upload_files([
+            (frames[0], BUCKET, "ok/sample_000001.cbf"),
+            (frames[1], "no-such-bucket", "ng/sample_000002.cbf"),
+        ])
+    finally:
+        uploader.close()
+    assert result["uploaded"] == [frames[0]]
+    assert [path for path, _error in result["failed"]] == [frames[1]]
+
+
+def test_large_file_is_sent_as_multipart_upload(s3, tmp_path):
+    path = str(tmp_path / "large.h5")
+    data = os.urandom(11 * 1024 * 1024)
+    with open(path, "wb") as fout:
+        fout.write(data)
+    chunk = 5 * 1024 * 1024
+    uploader = ta.S3Uploader(2, multipart_threshold=chunk, multipart_chunksize=chunk, multipart_threads=3)
+    try:
+        result = uploader.upload_files([(path, BUCKET, "mxstaff/large.h5")])
+    finally:
+        uploader.close()
+    assert result["uploaded"] == [path]
+    head = s3.head_object(Bucket=BUCKET, Key="mxstaff/large.h5")
+    # multipart でアップロードしたオブジェクトの ETag は "<md5>-<part 数>"
+    assert head["ETag"].strip('"').endswith("-3")
+    assert object_body(s3, "mxstaff/large.h5") == data
+
+
+def test_compressed_frames_are_restored_by_decompress_directory(s3, tmp_path):
+    frame_dir = str(tmp_path / "data")
+    frames = make_frames(frame_dir, 2, size=4000)
+    uploader = ta.S3Uploader(2, compression="gzip", compression_processes=1)
+    try:
+        result = uploader.sync_directory(frame_dir, f"s3://{BUCKET}/mxstaff/")
+        assert sorted(result["uploaded"]) == frames
+        # 圧縮したフレームはオブジェクトの有無で判断するので, 2 回目は送らない
+        assert uploader.sync_directory(frame_dir, f"s3://{BUCKET}/mxstaff/")["uploaded"] == []
+    finally:
+        uploader.close()
+
+    # AOBA 側と同じく, S3 上の *.cbf.gz のみがあるディレクトリで復元する
+    aoba_dir = tmp_path / "aoba"
+    aoba_dir.mkdir()
+    for path in frames:
+        key = f"mxstaff/data/{os.path.basename(path)}.gz"
+        head = s3.head_object(Bucket=BUCKET, Key=key)
+        assert head["Metadata"]["compression"] == "gzip"
+        assert head["Metadata"]["original-size"] == "4000"
+        (aoba_dir / f"{os.path.basename(path)}.gz").write_bytes(object_body(s3, key))
+
+    assert ta.decompress_directory(str(aoba_dir), remove=True) == 2
+    for path in frames:
+        with open(path, "rb") as fin:
+            assert (aoba_dir / os.path.basename(path)).read_bytes() == fin.read()
+    assert not list(aoba_dir.glob("*.gz"))
+
+
+def checksum_uploader(tmp_path, **kwargs):
+    cache = ta.ChecksumCache(str(tmp_path / "checksums.sqlite"))
+    return ta.S3Uploader(2, checksum_algorithm="blake2b", checksum_cache=cache, **kwargs), cache
+
+
+def test_checksum_metadata_verify_and_dedup(s3, tmp_path):
+    frames = make_frames(str(tmp_path / "data"), 1)
+    copy = str(tmp_path / "copy.cbf")
+    with open(frames[0], "rb") as fin, open(copy, "wb") as fout:
+        fout.write(fin.read())
+    uploader, cache = checksum_uploader(tmp_path)
+    try:
+        assert uploader.upload_files([(frames[0], BUCKET, "a/sample_000001.cbf")])["bytes"] == 1000
+        digest = ta.hash_file(frames[0], "blake2b")
+        head = s3.head_object(Bucket=BUCKET, Key="a/sample_000001.cbf")
+        assert head["Metadata"]["content-hash"] == f"blake2b:{digest}"
+        assert uploader.verify_file(frames[0], BUCKET, "a/sample_000001.cbf") == "ok"
+
+        # 同じ内容のファイルは S3 内でコピーし, 送らない
+        assert uploader.upload_files([(copy, BUCKET, "b/copy.cbf")])["bytes"] == 0
+        assert object_body(s3, "b/copy.cbf") == object_body(s3, "a/sample_000001.cbf")
+    finally:
+        uploader.close()
+        cache.close()
+
+
+def test_sync_reuploads_files_deleted_on_the_remote(s3, tmp_path):
+    frame_dir = str(tmp_path / "data")
+    frames = make_frames(frame_dir, 2)
+    uploader, cache = checksum_uploader(tmp_path)
+    try:
+        uploader.sync_directory(frame_dir, f"s3://{BUCKET}/mxstaff/")
+        s3.delete_object(Bucket=BUCKET, Key="mxstaff/data/sample_000001.cbf")
+
+        # checksum_cache では転送済みでも, S3 側の一覧に無いファイルは送り直す
+        result = uploader.sync_directory(frame_dir, f"s3://{BUCKET}/mxstaff/")
+        assert result["uploaded"] == [frames[0]]
+        assert result["bytes"] == 1000
+        assert s3.head_object(Bucket=BUCKET, Key="mxstaff/data/sample_000001.cbf")["ContentLength"] == 1000
+    finally:
+        uploader.close()
+        cache.close()
+
+
+def test_compressed_remote_is_not_used_for_dedup_of_plain_upload(s3, tmp_path):
+    frames = make_frames(str(tmp_path / "data"), 1)
+    compressing, cache = checksum_uploader(tmp_path, compression="gzip", compression_processes=1)
+    try:
+        compressing.upload_files([(frames[0], BUCKET, "gz/sample_000001.cbf")])
+    finally:
+        compressing.close()
+
+    plain = ta.S3Uploader(2, checksum_algorithm="blake2b", checksum_cache=cache)
+    try:
+        # *.cbf.gz からコピーすると圧縮されたままのオブジェクトになるので, 送り直す
+        assert plain.upload_files([(frames[0], BUCKET, "plain/sample_000001.cbf")])["bytes"] == 1000
+        with open(frames[0], "rb") as fin:
+            assert object_body(s3, "plain/sample_000001.cbf") == fin.read()
+    finally:
+        plain.close()
+        cache.close()
+
+
+def test_large_file_is_hashed_while_it_is_sent(s3, tmp_path, monkeypatch):
+    path = str(tmp_path / "large.h5")
+    with open(path, "wb") as fout:
+        fout.write(os.urandom(64 * 1024))
+    digest = ta.hash_file(path, "blake2b")
+    monkeypatch.setattr(ta, "SINGLE_READ_LIMIT", 1024)
+
+    def no_second_read(*args, **kwargs):
+        raise AssertionError("the file was hashed before the upload")
+    monkeypatch.setattr(ta, "hash_file", no_second_read)
+
+    uploader, cache = checksum_uploader(tmp_path)
+    try:
+        assert uploader.upload_files([(path, BUCKET, "mxstaff/large.h5")])["bytes"] == 64 * 1024
+        # チェックサムは送り終わってからメタデータに付けられ, checksum_cache にも記録される
+        head = s3.head_object(Bucket=BUCKET, Key="mxstaff/large.h5")
+        assert head["Metadata"]["content-hash"] == f"blake2b:{digest}"
+        assert cache.get(path, os.stat(path), "blake2b")[0] == digest
+    finally:
+        uploader.close()
+        cache.close()
@@ -0,0 +1,50 @@
+import transfer_auto as ta
+
+
+def test_pending_returns_new_and_changed_files(tmp_path):
+    manifest = ta.TransferManifest(str(tmp_path / "manifest.sqlite"))
+    try:
+        manifest.record([("/data/a/1.cbf", 100, 1.0, "s3://b/a/1.cbf"),
+                         ("/data/a/2.cbf", 100, 1.0, "s3://b/a/2.cbf")])
+        local_files = [
+            ("/data/a/1.cbf", 100, 1.0),    # 変更なし
+            ("/data/a/2.cbf", 200, 2.0),    # サイズ・mtime が変わった
+            ("/data/a/3.cbf", 100, 1.0),    # 新しいファイル
+        ]
+        assert manifest.pending(local_files) == local_files[1:]
+    finally:
+        manifest.close()
+
+
+def test_seeded_state_persists_across_instances(tmp_path):
+    db_path = str(tmp_path / "manifest.sqlite")
+    manifest = ta.TransferManifest(db_path)
+    assert not manifest.is_seeded("/data/a")
+    manifest.mark_seeded("/data/a", "s3://b/")
+    manifest.record([("/data/a/1.cbf", 100, 1.0, "s3://b/a/1.cbf")])
+    manifest.close()
+
+    manifest = ta.TransferManifest(db_path)
+    try:
+        assert manifest.is_seeded("/data/a")
+        assert manifest.pending([("/data/a/1.cbf", 100, 1.0)]) == []
+    finally:
+        manifest.close()
+
+
+def test_forget_directory_drops_only_that_directory(tmp_path):
+    manifest = ta.TransferManifest(str(tmp_path / "manifest.sqlite"))
+    try:
+        manifest.mark_seeded("/data/a", "s3://b/")
+        manifest.mark_seeded("/data/ab", "s3://b/")
+        manifest.record([("/data/a/1.cbf", 100, 1.0, "s3://b/a/1.cbf"),
+                         ("/data/ab/1.cbf", 100, 1.0, "s3://b/ab/1.cbf")])
+
+        manifest.forget_directory("/data/a")
+
+        assert not manifest.is_seeded("/data/a")
+        assert manifest.is_seeded("/data/ab")
+        assert manifest.pending([("/data/a/1.cbf", 100, 1.0)]) == [("/data/a/1.cbf", 100, 1.0)]
+        assert manifest.pending([("/data/ab/1.cbf", 100, 1.0)]) == []
+    finally:
+        manifest.close()
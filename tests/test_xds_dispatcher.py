@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+import transfer_auto as ta
+
+# ssh のスタブ: オプションとホスト名を読み飛ばし, 残りのコマンド (bash -s) をローカルで実行する
+STUB_SSH = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/ssh.log"
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o|-O) shift 2 ;;
+        *) shift; break ;;
+    esac
+done
+exec "$@"
+"""
+
+# generate_XDS.INP のスタブ: テンプレートに "broken" を含む場合は失敗する
+STUB_GENERATE = """#!/bin/sh
+case "$1" in
+    *broken*) echo "no frames" >&2; exit 1 ;;
+esac
+echo "$1" > XDS.INP
+"""
+
+STUB_QSUB = """#!/bin/sh
+echo "1234.sqd"
+"""
+
+
+def write_stub(path, content):
+    path.write_text(content)
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def dispatcher_factory(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    results = []
+    dispatchers = []
+
+    def make(**kwargs):
+        dispatcher = ta.XdsDispatcher(
+            ssh_command=write_stub(bin_dir / "ssh", STUB_SSH),
+            qsub=write_stub(bin_dir / "qsub", STUB_QSUB),
+            generate_command=write_stub(bin_dir / "generate_XDS.INP", STUB_GENERATE),
+            control_path=str(tmp_path / "ssh_%C"),
+            state_file=str(tmp_path / "xds_submitted.json"),
+            on_result=lambda dataset_path, ok, output: results.append((dataset_path, ok, output)),
+            **kwargs,
+        )
+        dispatchers.append(dispatcher)
+        return dispatcher
+    make.results = results
+    make.ssh_log = bin_dir / "ssh.log"
+    yield make
+    for dispatcher in dispatchers:
+        dispatcher.close()
+
+
+def test_batch_is_submitted_in_one_ssh_call(dispatcher_factory, tmp_path):
+    dispatcher = dispatcher_factory(batch_size=2, batch_seconds=60)
+    aoba = tmp_path / "aoba"
+    assert dispatcher.add("/data/a/*.cbf", str(aoba / "a" / "XDS"), str(aoba / "a" / "a_??????.cbf"))
+    # batch_size に達したので, この add() で 2 件まとめて投入する
+    assert dispatcher.add("/data/b/*.cbf", str(aoba / "b" / "XDS"), str(aoba / "b" / "b_??????.cbf"))
+
+    assert sorted(dispatcher_factory.results) == [
+        ("/data/a/*.cbf", True, "1234.sqd"),
+        ("/data/b/*.cbf", True, "1234.sqd"),
+    ]
+    assert len(dispatcher_factory.ssh_log.read_text().splitlines()) == 1
+    assert (aoba / "a" / "XDS" / "XDS.INP").read_text().strip() == str(aoba / "a" / "a_??????.cbf")
+    assert (aoba / "a" / "XDS" / "xds.sh").read_text() == ta.XDS_JOB_SCRIPT
+
+    # 投入済みのデータセットは state_file から読み込まれ, 再投入しない
+    assert not dispatcher_factory(batch_size=2).add("/data/a/*.cbf", str(aoba / "a" / "XDS"), "a_??????.cbf")
+
+
+def test_failed_job_does_not_affect_the_rest_of_the_batch(dispatcher_factory, tmp_path):
+    dispatcher = dispatcher_factory(batch_size=2, batch_seconds=60)
+    dispatcher.add("/data/broken", str(tmp_path / "broken" / "XDS"), str(tmp_path / "broken" / "x_??????.cbf"))
+    dispatcher.add("/data/ok", str(tmp_path / "ok" / "XDS"), str(tmp_path / "ok" / "x_??????.cbf"))
+
+    results = {dataset_path: ok for dataset_path, ok, _output in dispatcher_factory.results}
+    assert results == {"/data/broken": False, "/data/ok": True}
+    assert dispatcher.submitted == {"/data/ok"}
+
+
+def test_restore_commands_run_before_generate(dispatcher_factory, tmp_path):
+    restore = write_stub(tmp_path / "restore", '#!/bin/sh\necho "$@" > "$2/restored"\n')
+    dispatcher = dispatcher_factory(batch_size=1, restore_commands=[f"{restore} --unbundle"])
+    frame_dir = tmp_path / "aoba" / "data"
+    frame_dir.mkdir(parents=True)
+    dispatcher.add("/data/a", str(frame_dir / "XDS"), str(frame_dir / "a_??????.cbf"))
+
+    assert dispatcher_factory.results == [("/data/a", True, "1234.sqd")]
+    assert (frame_dir / "restored").read_text().strip() == f"--unbundle {frame_dir}"
+
+
+def test_unreachable_host_is_retried_then_reported(dispatcher_factory, tmp_path):
+    dispatcher = dispatcher_factory(batch_size=1, retries=2, batch_seconds=0)
+    write_stub(tmp_path / "bin" / "ssh", "#!/bin/sh\nexit 255\n")
+    dispatcher.add("/data/a", str(tmp_path / "XDS"), str(tmp_path / "a_??????.cbf"))
+    dispatcher.flush_all()
+
+    assert [(dataset_path, ok) for dataset_path, ok, _output in dispatcher_factory.results] == [("/data/a", False)]
+    assert dispatcher.submitted == set()
@@ -13,24 +13,2547 @@ import os
 import subprocess as sp
 import logging as log
 import time
+import json
+import fnmatch
+import sqlite3
 import sys 
 import yaml 
 import threading
+import queue
+import itertools
+import signal
+import select
+import struct
+import ctypes
+import ctypes.util
+import re
+import mmap
+import tarfile
+import tempfile
+import hashlib
+import random
+import gzip
+import argparse
+import shlex
+import asyncio
+import socket
+import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+# boto3 is only required for upload_backend: boto3
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+
+# zstandard / lz4 are only required for compression: zstd / lz4
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# xxhash / blake3 are optional faster checksums (hashlib.blake2b is used otherwise)
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
 
 # -*- coding: utf-8 -*-
 
-#--- logging configuration ---#
-log.basicConfig(
-    filename='transfer.log',
-    level=log.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-    )
-#--- logging configuration ---#
+#--- logging configuration ---#
+log.basicConfig(
+    filename='transfer.log',
+    level=log.DEBUG,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+    )
+# boto3 の DEBUG ログはリクエストごとに出力されるため抑制する
+for noisy_logger in ("boto3", "botocore", "s3transfer", "urllib3"):
+    log.getLogger(noisy_logger).setLevel(log.WARNING)
+#--- logging configuration ---#
+
+#--- inotify constants (linux/inotify.h) ---#
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("iIII")
+#--- inotify constants ---#
+
+# Lustre/NFS 等のネットワークファイルシステムでは inotify が他ホストからの書き込みを検知できない
+NETWORK_FS_TYPES = ("nfs", "nfs4", "lustre", "cifs", "smb3", "fuse.sshfs", "gpfs", "beegfs")
+
+# 圧縮形式 -> S3 上のオブジェクト名に付ける拡張子
+COMPRESSION_SUFFIXES = {"zstd": ".zst", "lz4": ".lz4", "gzip": ".gz"}
+# 圧縮して転送するファイル（CBF フレーム）
+COMPRESSIBLE_SUFFIXES = (".cbf",)
+# フレームのファイル（CBF, HDF5 の master/data ファイル）
+FRAME_SUFFIXES = (".cbf", ".h5")
+
+# これ以下のサイズのファイルはメモリに 1 回読み込んでチェックサムの計算とアップロードを行う
+# (より大きいファイルはメモリに読み込まず, 送りながらチェックサムを求める)
+SINGLE_READ_LIMIT = 8 * 1024 * 1024
+# 1 回の CopyObject でコピーできる最大サイズ (S3 の制限)
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+
+# job file for XDS on AOBA-S (same as xds_auto.sh)
+XDS_JOB_SCRIPT = """#!/bin/sh
+#PBS -q sxs
+#PBS --venode 1
+#PBS -l elapstim_req=2:00:00
+cd $PBS_O_WORKDIR
+xds_par
+"""
+
+# error codes / HTTP status of S3 responses asking the client to slow down
+THROTTLE_ERROR_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                        "TooManyRequests", "ServiceUnavailable", "RequestTimeTooSkewed"}
+THROTTLE_HTTP_STATUS = {429, 503}
+
+# 転送の優先度 (小さいほど先に転送): Kamo に渡る auto の data が最優先, scan/check 等は空いた帯域で転送
+DATASET_PRIORITIES = {
+    ("auto", "data"): 0,
+    ("visit", "data"): 1,
+    ("auto", "other"): 2,
+    ("visit", "other"): 2,
+}
+
+
+# added InotifyWatcher 2026-10-17
+class InotifyWatcher:
+    """
+    Minimal inotify wrapper (via libc/ctypes) used to wake the main loop
+    as soon as monitor.txt or .dataset_paths_for_kamo.txt is written.
+
+    The parent directory of each watched file is registered, so that files
+    which are replaced (mv) or created later are also detected.
+    """
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+        # wd -> directory, directory -> set of file names of interest
+        self.wd_to_dir = {}
+        self.dir_to_wd = {}
+        self.watched_names = {}
+
+    def watch(self, file_path: str):
+        directory = os.path.dirname(os.path.abspath(file_path))
+        name = os.path.basename(file_path)
+
+        if directory not in self.dir_to_wd:
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode(), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                log.warning(f"inotify_add_watch failed for {directory}: {os.strerror(errno)}")
+                return False
+            self.wd_to_dir[wd] = directory
+            self.dir_to_wd[directory] = wd
+            log.info(f"inotify: watching {directory}")
+
+        self.watched_names.setdefault(directory, set()).add(name)
+        return True
+
+    def wait(self, timeout: float):
+        """
+        Block until one of the watched files is written or `timeout` seconds pass.
+        Returns True if a relevant event was received.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+
+            if self.read_events():
+                return True
+
+    def read_events(self):
+        #--- read the pending events without blocking; True if a watched file was written ---#
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+
+        changed = False
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(buf):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+
+            directory = self.wd_to_dir.get(wd)
+            if directory is not None and name in self.watched_names.get(directory, ()):
+                log.debug(f"inotify: event 0x{mask:x} on {os.path.join(directory, name)}")
+                changed = True
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+#--- InotifyWatcher ---#
+
+
+# added is_network_fs 2026-10-17
+def is_network_fs(path: str):
+    #--- check whether path lives on a network filesystem (Lustre/NFS etc.) ---#
+    # /proc/mounts の中で最も長く一致するマウントポイントのファイルシステム種別を調べる
+    path = os.path.realpath(path)
+    best_mount, best_type = "", ""
+    try:
+        with open("/proc/mounts", "r") as fin:
+            for line in fin:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point, fs_type = fields[1], fields[2]
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) > len(best_mount):
+                    best_mount, best_type = mount_point, fs_type
+    except OSError:
+        return False
+
+    return best_type in NETWORK_FS_TYPES
+
+#--- is_network_fs ---#
+
+
+# added TailReader 2026-10-17
+class TailReader:
+    """
+    Reads only the lines appended to a file since the previous call.
+
+    For each file the inode, the byte offset of the end of the last complete
+    line and the last non-empty line are kept. A trailing line without a
+    newline is still being written by BSS (e.g. "path, 1, 1" before
+    "path, 1, 120"), so it is not returned until its newline arrives; it is
+    read again from the same offset in the next call. If the inode changes (rotation)
+    or the file becomes shorter than the offset (truncation), the file is read
+    again from the beginning.
+
+    Offsets read in a cycle are kept pending until commit() is called, and
+    commit() saves them to state_file so that they survive a restart.
+    """
+    def __init__(self, state_file: str = None):
+        self.state_file = state_file
+        self.state = {}
+        self.pending = {}
+        self.load()
+
+    def load(self):
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r") as fin:
+                self.state = json.load(fin)
+            log.info(f"Loaded read offsets from {self.state_file}")
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to load read offsets from {self.state_file}: {e}")
+            self.state = {}
+
+    def entry(self, file_path: str):
+        return self.pending.get(file_path) or self.state.get(file_path) or {}
+
+    def last_line(self, file_path: str):
+        return self.entry(file_path).get("last_line")
+
+    def read_new_lines(self, file_path: str):
+        """
+        Returns the non-empty lines appended since the previous call.
+        Raises FileNotFoundError if file_path does not exist.
+        """
+        st = os.stat(file_path)
+        entry = self.entry(file_path)
+        offset = entry.get("offset", 0)
+        last_line = entry.get("last_line")
+
+        if entry and (entry.get("inode") != st.st_ino or st.st_size < offset):
+            log.info(f"{file_path} was rotated or truncated. Reading from the beginning.")
+            offset, last_line = 0, None
+
+        if st.st_size == offset:
+            return []
+
+        with open(file_path, "rb") as fin:
+            fin.seek(offset)
+            data = fin.read(st.st_size - offset)
+
+        # 最後の改行までが確定した行, それ以降は書き込み途中の行（改行が来るまで返さず, 次回同じ位置から読み直す）
+        end = data.rfind(b"\n") + 1
+        complete = data[:end].decode(errors="replace")
+        if end < len(data):
+            log.debug(f"Waiting for the rest of a partially written line in {file_path}")
+
+        lines = [l.strip() for l in complete.splitlines() if l.strip()]
+        if lines:
+            last_line = lines[-1]
+
+        self.pending[file_path] = {
+            "inode": st.st_ino,
+            "offset": offset + end,
+            "last_line": last_line,
+        }
+        return lines
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.state.update(self.pending)
+        self.pending = {}
+
+        if not self.state_file:
+            return
+        # 書き込み途中でクラッシュしても壊れないように一時ファイル経由で置き換える
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, "w") as fout:
+                json.dump(self.state, fout)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            log.error(f"Failed to save read offsets to {self.state_file}: {e}")
+
+#--- TailReader ---#
+
+
+# added FrameBundleWriter 2026-10-17
+class FrameBundleWriter:
+    """
+    Packs frames into uncompressed tar archives ("bundles") of at most
+    max_bytes / max_frames each, in spool_dir, and keeps the index of every
+    frame: name -> [bundle name, byte offset of the frame data, size, mtime].
+
+    Because the tar is not compressed, one frame can be read back with a single
+    byte-range request (see read_bundled_frame()).
+    """
+    def __init__(self, spool_dir: str, max_bytes: int, max_frames: int):
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+
+    def chunks(self, frames: list):
+        #--- split [(path, size, mtime), ...] into lists that fit in one bundle ---#
+        chunk, chunk_bytes = [], 0
+        for frame in frames:
+            if chunk and (len(chunk) >= self.max_frames or chunk_bytes + frame[1] > self.max_bytes):
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(frame)
+            chunk_bytes += frame[1]
+        if chunk:
+            yield chunk
+
+    def write(self, bundle_name: str, frames: list):
+        """
+        Writes frames [(path, size, mtime), ...] into a new tar file in spool_dir.
+        Returns (tar path, {frame name: [bundle_name, offset, size, mtime]}).
+        """
+        fd, tar_path = tempfile.mkstemp(prefix="bundle_", suffix=".tar", dir=self.spool_dir)
+        entries = {}
+        try:
+            with os.fdopen(fd, "wb") as fout, tarfile.open(fileobj=fout, mode="w", format=tarfile.GNU_FORMAT) as tar:
+                for frame_path, size, mtime in frames:
+                    info = tar.gettarinfo(frame_path, arcname=os.path.basename(frame_path))
+                    with open(frame_path, "rb") as fin:
+                        tar.addfile(info, fin)
+                    # 書き込み時は offset_data が設定されないので, 512 バイト単位に詰めたデータの先頭から求める
+                    padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    entries[info.name] = [bundle_name, tar.offset - padded, info.size, mtime]
+        except BaseException:
+            os.remove(tar_path)
+            raise
+        return tar_path, entries
+
+#--- FrameBundleWriter ---#
+
+
+# added read_bundled_frame 2026-10-17
+def read_bundled_frame(index_path: str, frame_name: str):
+    """
+    Reads one frame from a bundle through its sidecar index.json, e.g. on the
+    AOBA side where the bucket is mounted: only [offset, offset + size) of the
+    bundle is read, which the S3 mount turns into a single byte-range request.
+    """
+    with open(index_path, "r") as fin:
+        index = json.load(fin)
+    bundle_name, offset, size, _mtime = index["frames"][frame_name]
+    with open(os.path.join(os.path.dirname(index_path), bundle_name), "rb") as fin:
+        fin.seek(offset)
+        return fin.read(size)
+
+#--- read_bundled_frame ---#
+
+
+# added unbundle_directory 2026-10-17
+def unbundle_directory(directory: str):
+    """
+    Extracts the frames of the bundles in directory/_bundle next to them, e.g. on
+    the AOBA side before XDS runs. Frames already extracted are skipped.
+    Returns the number of extracted frames.
+    """
+    index_path = os.path.join(directory, "_bundle", "index.json")
+    if not os.path.isfile(index_path):
+        log.info(f"No bundles in {directory}")
+        return 0
+    with open(index_path, "r") as fin:
+        index = json.load(fin)
+
+    extracted = 0
+    by_bundle = {}
+    for frame_name, (bundle_name, offset, size, mtime) in index["frames"].items():
+        by_bundle.setdefault(bundle_name, []).append((offset, frame_name, size, mtime))
+    for bundle_name, frames in sorted(by_bundle.items()):
+        with open(os.path.join(directory, "_bundle", bundle_name), "rb") as fin:
+            for offset, frame_name, size, mtime in sorted(frames):
+                dst = os.path.join(directory, frame_name)
+                if os.path.exists(dst):
+                    continue
+                fin.seek(offset)
+                tmp = f"{dst}.tmp"
+                with open(tmp, "wb") as fout:
+                    fout.write(fin.read(size))
+                os.utime(tmp, (mtime, mtime))
+                os.replace(tmp, dst)
+                extracted += 1
+    log.info(f"Extracted {extracted} frames from bundles in {directory}")
+    return extracted
+
+#--- unbundle_directory ---#
+
+
+# added TransferMetrics 2026-10-17
+class TransferMetrics:
+    """
+    In-process transfer metrics (counters, gauges and summaries).
+
+    Exposed in Prometheus text format on a local HTTP endpoint (serve()) and
+    written as periodic JSON snapshots (write_snapshots()).
+    Bytes uploaded in the current thread are also counted per dataset, between
+    begin_dataset() and end_dataset(), to give the per-dataset throughput.
+    """
+    # name -> (type, help)
+    METRICS = {
+        "transfer_uploaded_bytes_total": ("counter", "Bytes uploaded to S3"),
+        "transfer_uploaded_files_total": ("counter", "Files uploaded to S3"),
+        "transfer_upload_errors_total": ("counter", "Upload errors (failed files or failed s3cmd/backend runs)"),
+        "transfer_dataset_seconds": ("summary", "Duration of a dataset transfer"),
+        "transfer_dataset_mb_per_second": ("summary", "Throughput of a dataset transfer (MB/s)"),
+        "transfer_detect_to_upload_seconds": ("summary", "Time from the BSS line to upload complete"),
+        "transfer_detect_to_kamo_seconds": ("summary", "Time from the BSS line to kamo registration"),
+        "transfer_cycle_seconds": ("summary", "Duration of a sync cycle of the main loop"),
+        "transfer_queue_depth": ("gauge", "Datasets queued or running in the scheduler"),
+        "transfer_active_streams": ("gauge", "Datasets being streamed"),
+        "transfer_timeouts_total": ("counter", "Dataset transfers stopped by dataset_timeout"),
+        "transfer_concurrency_limit": ("gauge", "Current number of parallel uploads (adaptive limit)"),
+        "xds_jobs_total": ("counter", "XDS jobs dispatched to AOBA-S, by result"),
+        "transfer_detect_to_xds_seconds": ("summary", "Time from the BSS line to XDS job submission"),
+        "transfer_retried_files_total": ("counter", "Files resent from the retry queue"),
+        "transfer_retries_given_up_total": ("counter", "Files given up after retry_max_attempts"),
+        "transfer_retry_queue_depth": ("gauge", "Files waiting in the retry queue"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}        # (name, labels) -> value of counters and gauges
+        self.summaries = {}     # (name, labels) -> [count, sum, max]
+        self.gauge_functions = {}
+        self.local = threading.local()
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            summary = self.summaries.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def register_gauge(self, name: str, func, **labels):
+        #--- gauge whose value is read from func() when the metrics are collected ---#
+        self.gauge_functions[(name, tuple(sorted(labels.items())))] = func
+
+    def count_upload(self, files: int, nbytes: int, backend: str):
+        self.inc("transfer_uploaded_files_total", files, backend=backend)
+        self.inc("transfer_uploaded_bytes_total", nbytes, backend=backend)
+        self.local.bytes = getattr(self.local, "bytes", 0) + nbytes
+
+    def count_error(self, backend: str, n: int = 1):
+        self.inc("transfer_upload_errors_total", n, backend=backend)
+
+    def begin_dataset(self):
+        self.local.bytes = 0
+        self.local.started = time.monotonic()
+
+    def end_dataset(self):
+        #--- (bytes, seconds) uploaded by this thread since begin_dataset() ---#
+        started = getattr(self.local, "started", None)
+        if started is None:
+            return 0, 0.0
+        seconds = time.monotonic() - started
+        nbytes = getattr(self.local, "bytes", 0)
+        self.local.started = None
+        self.observe("transfer_dataset_seconds", seconds)
+        if seconds > 0 and nbytes > 0:
+            self.observe("transfer_dataset_mb_per_second", nbytes / seconds / 1e6)
+        return nbytes, seconds
+
+    def collect(self):
+        #--- list of (name, labels, value) including summaries as _count/_sum/_max ---#
+        with self.lock:
+            samples = [(name, labels, value) for (name, labels), value in self.values.items()]
+            for (name, labels), (count, total, maximum) in self.summaries.items():
+                samples += [(f"{name}_count", labels, count), (f"{name}_sum", labels, total),
+                            (f"{name}_max", labels, maximum)]
+        for (name, labels), func in list(self.gauge_functions.items()):
+            try:
+                samples.append((name, labels, func()))
+            except Exception as e:
+                log.debug(f"Failed to read gauge {name}: {e}")
+        return sorted(samples)
+
+    def snapshot(self):
+        data = {"time": time.time(), "uptime_seconds": time.time() - self.started_at, "metrics": {}}
+        for name, labels, value in self.collect():
+            label = ",".join(f"{k}={v}" for k, v in labels)
+            data["metrics"][f"{name}{{{label}}}" if label else name] = value
+        return data
+
+    def family(self, name: str):
+        #--- (metric family, type, help) of a sample name ---#
+        if name in self.METRICS:
+            return (name,) + self.METRICS[name]
+        base, _, suffix = name.rpartition("_")
+        if base in self.METRICS and suffix in ("count", "sum"):
+            return (base,) + self.METRICS[base]
+        if base in self.METRICS and suffix == "max":
+            # 最大値は summary の一部ではないので別の gauge として出力する
+            return name, "gauge", f"Maximum of {base}"
+        return name, "untyped", name
+
+    def render(self):
+        #--- Prometheus text exposition format ---#
+        lines = []
+        described = set()
+        samples = sorted(self.collect(), key=lambda sample: (self.family(sample[0])[0], sample[0], sample[1]))
+        for name, labels, value in samples:
+            family, metric_type, help_text = self.family(name)
+            if family not in described:
+                lines.append(f"# HELP {family} {help_text}")
+                lines.append(f"# TYPE {family} {metric_type}")
+                described.add(family)
+            label = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        #--- start the /metrics HTTP endpoint in a background thread ---#
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug(f"metrics: {fmt % args}")
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        log.info(f"Metrics endpoint: http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def write_snapshots(self, snapshot_file: str, interval: float):
+        #--- write a JSON snapshot to snapshot_file every interval seconds in a background thread ---#
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot(snapshot_file)
+
+        threading.Thread(target=loop, name="metrics-snapshot", daemon=True).start()
+
+    def write_snapshot(self, snapshot_file: str):
+        tmp_file = f"{snapshot_file}.tmp"
+        try:
+            with open(tmp_file, "w") as fout:
+                json.dump(self.snapshot(), fout, indent=1)
+            os.replace(tmp_file, snapshot_file)
+        except OSError as e:
+            log.error(f"Failed to write metrics snapshot to {snapshot_file}: {e}")
+
+#--- TransferMetrics ---#
+
+
+# added parse_s3cmd_uploads 2026-10-17
+def parse_s3cmd_uploads(stdout: str):
+    #--- local paths of the "upload: 'local' -> 's3://...'" lines printed by s3cmd put ---#
+    return re.findall(r"^upload: '([^']*)' -> '[^']*'", stdout or "", re.MULTILINE)
+
+#--- parse_s3cmd_uploads ---#
+
+
+# added read_s3cmd_plan 2026-10-17
+def read_s3cmd_plan(plan_file: str):
+    #--- [(local_path, s3_url), ...] of the "local remote" lines written by the sync --dry-run | sed pipeline ---#
+    planned = []
+    try:
+        with open(plan_file, "r") as fin:
+            for line in fin:
+                local_path, _, s3_url = line.rstrip("\n").rpartition(" ")
+                if local_path and s3_url.startswith("s3://"):
+                    planned.append((local_path, s3_url))
+    except OSError as e:
+        log.warning(f"Failed to read upload plan {plan_file}: {e}")
+    return planned
+
+#--- read_s3cmd_plan ---#
+
+
+# added local_size 2026-10-17
+def local_size(local_paths: list):
+    #--- total size of the existing files of local_paths ---#
+    total = 0
+    for local_path in local_paths:
+        try:
+            total += os.path.getsize(local_path)
+        except OSError:
+            continue
+    return total
+
+#--- local_size ---#
+
+
+# added split_s3_url 2026-10-17
+def split_s3_url(s3_url: str):
+    #--- s3://bucket/prefix/ -> ("bucket", "prefix/") ---#
+    if not s3_url.startswith("s3://"):
+        raise ValueError(f"Not an S3 URL: {s3_url}")
+    bucket, _, key = s3_url[len("s3://"):].partition("/")
+    return bucket, key
+
+#--- split_s3_url ---#
+
+
+# added new_hasher 2026-10-17
+def new_hasher(algorithm: str):
+    #--- hash object of algorithm: xxh3 (xxhash), blake3 or blake2b (hashlib) ---#
+    if algorithm == "xxh3" and xxhash is not None:
+        return xxhash.xxh3_128()
+    if algorithm == "blake3" and blake3 is not None:
+        return blake3.blake3()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=32)
+    raise ValueError(f"Checksum algorithm is not available: {algorithm}")
+
+#--- new_hasher ---#
+
+
+# added default_checksum_algorithm 2026-10-17
+def default_checksum_algorithm():
+    #--- fastest available checksum algorithm ---#
+    if xxhash is not None:
+        return "xxh3"
+    if blake3 is not None:
+        return "blake3"
+    return "blake2b"
+
+#--- default_checksum_algorithm ---#
+
+
+# added hash_file 2026-10-17
+def hash_file(local_path: str, algorithm: str, chunk_size: int = 8 * 1024 * 1024):
+    #--- hex digest of local_path, read once in chunks ---#
+    hasher = new_hasher(algorithm)
+    with open(local_path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+#--- hash_file ---#
+
+
+# added ChecksumCache 2026-10-17
+class ChecksumCache:
+    """
+    Local cache (SQLite) of file checksums keyed by local path and valid while
+    (inode, size, mtime) are unchanged, with the S3 URL the content was uploaded to.
+
+    The uploader uses it to skip re-reading unchanged files, and to copy a content
+    already in the bucket server-side instead of uploading it again (dedup).
+    The encoding of the remote object ("identity" or the compression codec) is
+    stored per row, and dedup only copies from a remote with the same encoding.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS checksums ("
+                " local_path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime REAL,"
+                " algorithm TEXT, digest TEXT, remote TEXT, encoding TEXT)"
+            )
+            # 以前の形式のテーブルには encoding を追加する (既存の行は NULL のままで dedup の対象にしない)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(checksums)")]
+            if "encoding" not in columns:
+                self.conn.execute("ALTER TABLE checksums ADD COLUMN encoding TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS checksums_digest ON checksums (digest)")
+
+    def get(self, local_path: str, st: os.stat_result, algorithm: str):
+        #--- (digest, remote) of local_path if it is unchanged since it was hashed, else (None, None) ---#
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, remote FROM checksums WHERE local_path = ? AND inode = ? AND size = ?"
+                " AND mtime = ? AND algorithm = ?",
+                (local_path, st.st_ino, st.st_size, st.st_mtime, algorithm),
+            ).fetchone()
+        return row if row is not None else (None, None)
+
+    def put(self, local_path: str, st: os.stat_result, algorithm: str, digest: str, remote: str = None,
+            encoding: str = None):
+        #--- digest is of the local content; encoding is how it is stored at remote ("identity" or codec) ---#
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO checksums"
+                " (local_path, inode, size, mtime, algorithm, digest, remote, encoding)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (local_path, st.st_ino, st.st_size, st.st_mtime, algorithm, digest, remote, encoding),
+            )
+
+    def find_remote(self, algorithm: str, digest: str, size: int, encoding: str = "identity"):
+        #--- S3 URL of an uploaded object with the same content stored with the same encoding, or None ---#
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT remote FROM checksums WHERE algorithm = ? AND digest = ? AND size = ?"
+                " AND encoding = ? AND remote IS NOT NULL LIMIT 1",
+                (algorithm, digest, size, encoding),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+#--- ChecksumCache ---#
+
+
+# added compress_file 2026-10-17
+# updated compress_file 2026-10-17 (checksum of the original content)
+def compress_file(codec: str, local_path: str, level: int = 3, checksum_algorithm: str = None):
+    """
+    Compressed content of local_path (run in a worker process of the compression pool).
+    Returns (compressed bytes, hex digest of the original content or None).
+    """
+    with open(local_path, "rb") as fin:
+        data = fin.read()
+    digest = None
+    if checksum_algorithm:
+        hasher = new_hasher(checksum_algorithm)
+        hasher.update(data)
+        digest = hasher.hexdigest()
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data), digest
+    if codec == "lz4":
+        return lz4.frame.compress(data, compression_level=level), digest
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=level), digest
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+#--- compress_file ---#
+
+
+# added decompress_data 2026-10-17
+def decompress_data(codec: str, data: bytes):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    if codec == "gzip":
+        return gzip.decompress(data)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+#--- decompress_data ---#
+
+
+# added decompress_directory 2026-10-17
+def decompress_directory(directory: str, remove: bool = False):
+    """
+    Restores the compressed frames (*.cbf.zst / *.cbf.lz4 / *.cbf.gz) of directory
+    next to them, e.g. on the AOBA side before XDS runs.
+    Frames already restored are skipped. Returns the number of restored frames.
+    """
+    codecs = {suffix: codec for codec, suffix in COMPRESSION_SUFFIXES.items()}
+    restored = 0
+    for name in sorted(os.listdir(directory)):
+        stem, suffix = os.path.splitext(name)
+        if suffix not in codecs or not stem.endswith(COMPRESSIBLE_SUFFIXES):
+            continue
+        src = os.path.join(directory, name)
+        dst = os.path.join(directory, stem)
+        if not os.path.exists(dst):
+            with open(src, "rb") as fin:
+                data = decompress_data(codecs[suffix], fin.read())
+            tmp = f"{dst}.tmp"
+            with open(tmp, "wb") as fout:
+                fout.write(data)
+            os.replace(tmp, dst)
+            restored += 1
+        if remove:
+            os.remove(src)
+    log.info(f"Restored {restored} frames in {directory}")
+    return restored
+
+#--- decompress_directory ---#
+
+
+# added AdaptiveConcurrency 2026-10-17
+class AdaptiveConcurrency:
+    """
+    AIMD controller of the number of parallel uploads.
+
+    Uploads are recorded with their size, duration and outcome, and every
+    `interval` seconds the window is evaluated:
+      - throttle responses (SlowDown, 503, ...) or an error rate above
+        max_error_rate: the limit is multiplied by `decrease` (multiplicative decrease)
+      - a mean latency above latency_factor times the best window so far
+        (the uplink or the endpoint is saturated): the limit is decreased by one
+      - throughput at the bandwidth cap: the limit is kept
+      - otherwise the limit is increased by one (additive increase)
+    The limit stays within [min_workers, max_workers].
+
+    With bandwidth_cap (bytes/s), throttle(nbytes) delays the caller so that
+    the total upload rate stays below the cap (token bucket shared by all workers).
+    """
+    def __init__(self, initial: int, min_workers: int = 1, max_workers: int = 16, interval: float = 5.0,
+                 bandwidth_cap: float = None, decrease: float = 0.5, latency_factor: float = 2.0,
+                 max_error_rate: float = 0.05, min_samples: int = 4):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.current = min(max(initial, self.min_workers), self.max_workers)
+        self.interval = interval
+        self.bandwidth_cap = bandwidth_cap
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.best_latency = None
+        self.next_free = 0.0
+        self.reset_window()
+
+    def reset_window(self):
+        self.window_started = time.monotonic()
+        self.samples = 0
+        self.errors = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.latency_sum = 0.0
+
+    def limit(self):
+        return self.current
+
+    def record(self, nbytes: int, seconds: float, error: bool = False, files: int = 1):
+        #--- record `files` uploads of nbytes in total that took `seconds` each on average ---#
+        with self.lock:
+            self.samples += files
+            self.latency_sum += seconds * files
+            if error:
+                self.errors += files
+            else:
+                self.bytes += nbytes
+            self.evaluate()
+
+    def record_throttle(self):
+        with self.lock:
+            self.throttled += 1
+            self.evaluate()
+
+    def evaluate(self):
+        #--- adjust the limit once per interval (called with lock) ---#
+        elapsed = time.monotonic() - self.window_started
+        if elapsed < self.interval or (self.samples < self.min_samples and not self.throttled):
+            return
+
+        throughput = self.bytes / elapsed
+        latency = self.latency_sum / self.samples if self.samples else None
+        error_rate = self.errors / self.samples if self.samples else 0.0
+        previous = self.current
+        if self.throttled or error_rate > self.max_error_rate:
+            self.current = max(self.min_workers, int(self.current * self.decrease))
+            reason = f"{self.throttled} throttled, error rate {error_rate:.2f}"
+        elif latency is not None and self.best_latency is not None \
+                and latency > self.latency_factor * self.best_latency:
+            self.current = max(self.min_workers, self.current - 1)
+            reason = f"latency {latency:.2f}s (best {self.best_latency:.2f}s)"
+        elif self.bandwidth_cap and throughput >= 0.95 * self.bandwidth_cap:
+            reason = "bandwidth cap reached"
+        else:
+            self.current = min(self.max_workers, self.current + 1)
+            reason = "no congestion"
+        if latency is not None and not self.throttled:
+            self.best_latency = latency if self.best_latency is None else min(self.best_latency, latency)
+
+        if self.current != previous:
+            log.info(f"Upload concurrency {previous} -> {self.current} ({reason}, "
+                     f"{throughput / 1e6:.1f} MB/s, {self.samples} uploads in {elapsed:.1f}s)")
+        self.reset_window()
+
+    def throttle(self, nbytes: int):
+        #--- wait until nbytes may be sent without exceeding bandwidth_cap ---#
+        if not self.bandwidth_cap or nbytes <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.bandwidth_cap
+        if start > now:
+            time.sleep(start - now)
+
+#--- AdaptiveConcurrency ---#
+
+
+# added MmapPartReader 2026-10-17
+class MmapPartReader:
+    """
+    Read-only file-like view of [start, end) of a memory-mapped file, used as the
+    body of one multipart part so that the part is not copied into memory as a whole.
+    Supports seek/tell so that botocore can rewind it on a retry.
+    """
+    def __init__(self, mm: mmap.mmap, start: int, end: int):
+        self.mm = mm
+        self.start = start
+        self.end = end
+        self.pos = start
+
+    def __len__(self):
+        return self.end - self.start
+
+    def read(self, size: int = -1):
+        if size is None or size < 0:
+            size = self.end - self.pos
+        size = max(0, min(size, self.end - self.pos))
+        data = self.mm[self.pos:self.pos + size]
+        self.pos += size
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = self.start + offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        else:
+            pos = self.end + offset
+        self.pos = min(max(pos, self.start), self.end)
+        return self.pos - self.start
+
+    def tell(self):
+        return self.pos - self.start
+
+#--- MmapPartReader ---#
+
+
+# added HashingReader 2026-10-17
+class HashingReader:
+    """
+    File-like wrapper that feeds the bytes of fileobj to hasher as they are read,
+    so that a file streamed as an upload body is hashed by the same read.
+    Bytes read again after a rewind (e.g. a retry of botocore) are not hashed twice;
+    `hashed` is the number of bytes hashed from the start of the file.
+    """
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+        self.hashed = 0
+
+    def read(self, size: int = -1):
+        pos = self.fileobj.tell()
+        data = self.fileobj.read(size)
+        end = pos + len(data)
+        if pos <= self.hashed < end:
+            self.hasher.update(memoryview(data)[self.hashed - pos:])
+            self.hashed = end
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET):
+        return self.fileobj.seek(offset, whence)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+#--- HashingReader ---#
+
+
+# added S3Uploader 2026-10-17
+# updated S3Uploader 2026-10-17 (multipart upload of large files)
+class S3Uploader:
+    """
+    In-process S3 upload engine (boto3).
+
+    A single client with a pooled keep-alive connection set is shared by a
+    bounded pool of num_threads workers, instead of starting one s3cmd
+    process (and one TLS handshake) per file via xargs.
+    endpoint_url can point to a local S3 stand-in such as moto or MinIO.
+
+    Files of multipart_threshold bytes or more are sent as multipart uploads:
+    the parts (multipart_chunksize bytes each) are read from a memory-mapped
+    file, sent in parallel by a separate pool of multipart_threads workers and
+    retried one by one (part_retries attempts).
+
+    With compression (zstd, lz4 or gzip), CBF frames are compressed by a pool of
+    compression_processes worker processes and the compressed bytes are sent
+    directly (no temporary file) as <key><suffix> with the original size in the
+    object metadata.
+
+    With checksum_algorithm, the checksum of each file is computed from the same
+    read as the upload and stored as "content-hash: <algorithm>:<digest>" in the
+    object metadata. With checksum_cache, unchanged files already uploaded to the
+    same key are skipped (except in sync_directory(), where the remote listing
+    has just reported the object as missing or different), and contents already
+    in the bucket are copied server-side (dedup) instead of being uploaded again.
+    Files above SINGLE_READ_LIMIT and multipart uploads are not read into memory:
+    they are hashed while they are sent and the content-hash is added afterwards
+    by a server-side copy (objects above 5 GiB keep it in checksum_cache only).
+
+    With concurrency (AdaptiveConcurrency), the number of files in flight is
+    the controller's current limit instead of a fixed max_workers, every upload
+    and throttle response is reported to it, and the bytes sent are paced by
+    its bandwidth cap. The pool then has num_threads workers at most.
+    """
+    def __init__(self, num_threads: int, endpoint_url: str = None, profile: str = None,
+                 multipart_threshold: int = None, multipart_chunksize: int = 64 * 1024 * 1024,
+                 multipart_threads: int = 4, part_retries: int = 3,
+                 compression: str = None, compression_level: int = 3, compression_processes: int = 2,
+                 checksum_algorithm: str = None, checksum_cache: ChecksumCache = None,
+                 concurrency: AdaptiveConcurrency = None):
+        if boto3 is None:
+            raise ImportError("boto3 is required for upload_backend: boto3")
+        if compression is not None and compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown compression codec: {compression}")
+        if (compression == "zstd" and zstandard is None) or (compression == "lz4" and lz4 is None):
+            raise ImportError(f"The module for compression: {compression} is not installed")
+
+        session = boto3.session.Session(profile_name=profile) if profile else boto3.session.Session()
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            config=BotoConfig(
+                max_pool_connections=num_threads + multipart_threads,
+                tcp_keepalive=True,
+                retries={"max_attempts": 5, "mode": "standard"},
+            ),
+        )
+        self.num_threads = num_threads
+        self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="s3upload")
+        self.concurrency = concurrency
+        if concurrency is not None:
+            # botocore の再送で隠れてしまう SlowDown / 503 も検出する
+            self.client.meta.events.register("needs-retry.s3", self.on_retry)
+
+        # S3 の multipart の part は最後以外 5 MiB 以上が必要
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = max(multipart_chunksize, 5 * 1024 * 1024)
+        self.part_retries = max(1, part_retries)
+        # part は upload_file() を実行中の executor とは別のプールで送る（同じプールだとデッドロックする）
+        self.part_executor = ThreadPoolExecutor(max_workers=max(1, multipart_threads), thread_name_prefix="s3part")
+
+        self.checksum_algorithm = checksum_algorithm
+        self.checksum_cache = checksum_cache
+        if checksum_algorithm:
+            new_hasher(checksum_algorithm)
+
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compress_pool = None
+        if compression:
+            self.compress_pool = ProcessPoolExecutor(max_workers=max(1, compression_processes))
+
+    def on_retry(self, response=None, **kwargs):
+        #--- botocore needs-retry hook: report throttle responses to the concurrency controller ---#
+        if response is None:
+            return None
+        http_response, parsed = response
+        code = (parsed or {}).get("Error", {}).get("Code")
+        if code in THROTTLE_ERROR_CODES or getattr(http_response, "status_code", None) in THROTTLE_HTTP_STATUS:
+            self.concurrency.record_throttle()
+        return None
+
+    def remote_key(self, local_path: str, key: str):
+        #--- object key of local_path (with the compression suffix for compressed frames) ---#
+        if self.compression and local_path.endswith(COMPRESSIBLE_SUFFIXES):
+            return key + COMPRESSION_SUFFIXES[self.compression]
+        return key
+
+    def list_remote(self, bucket: str, prefix: str):
+        #--- {key: size} of the objects under prefix ---#
+        remote = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                remote[obj["Key"]] = obj["Size"]
+        return remote
+
+    def sync_directory(self, local_dir: str, s3_destination: str, max_workers: int = None,
+                       stop: threading.Event = None):
+        """
+        Uploads the files in local_dir whose size differs from (or which are missing in)
+        s3_destination, like `s3cmd sync --no-check-md5 local_dir s3_destination`.
+        As with s3cmd, local_dir without a trailing slash is placed under s3_destination/<basename>/.
+        """
+        bucket, prefix = split_s3_url(s3_destination)
+        key_prefix = prefix + os.path.basename(local_dir.rstrip("/")) + "/"
+
+        remote = self.list_remote(bucket, key_prefix)
+
+        uploads = []
+        for root, _dirs, files in os.walk(local_dir):
+            for name in files:
+                local_path = os.path.join(root, name)
+                key = key_prefix + os.path.relpath(local_path, local_dir)
+                try:
+                    size = os.path.getsize(local_path)
+                except OSError:
+                    continue
+                remote_key = self.remote_key(local_path, key)
+                if remote_key != key:
+                    # 圧縮したフレームはサイズが変わるので, オブジェクトの有無のみで判断する
+                    if remote_key not in remote:
+                        uploads.append((local_path, bucket, key))
+                elif remote.get(key) != size:
+                    uploads.append((local_path, bucket, key))
+
+        log.info(f"{len(uploads)} files to upload ({len(remote)} objects already in s3://{bucket}/{key_prefix})")
+        # 一覧で無い・サイズが違うと分かったファイルなので, checksum_cache の「アップロード済み」は信用しない
+        return self.upload_files(uploads, max_workers, stop, trust_cache=False)
+
+    def upload_file(self, local_path: str, bucket: str, key: str, trust_cache: bool = True):
+        #--- upload one file; returns the number of bytes sent (trust_cache: skip it if the cache says it is uploaded) ---#
+        st = os.stat(local_path)
+        size = st.st_size
+        remote_key = self.remote_key(local_path, key)
+        remote_url = f"s3://{bucket}/{remote_key}"
+
+        digest = None
+        if self.checksum_cache is not None:
+            digest, uploaded_to = self.checksum_cache.get(local_path, st, self.checksum_algorithm)
+            if trust_cache and digest is not None and uploaded_to == remote_url:
+                log.debug(f"Unchanged since the last upload: {local_path}")
+                return 0
+
+        multipart = bool(self.multipart_threshold) and size >= self.multipart_threshold
+        if remote_key != key:
+            sent, digest = self.upload_compressed(local_path, bucket, key, size)
+        elif (multipart or size > SINGLE_READ_LIMIT) and self.copy_duplicate(digest, size, bucket, key):
+            # チェックサムが checksum_cache にある（変更されていない）大きいファイルは読まずに dedup できる
+            sent = 0
+        elif multipart or size > SINGLE_READ_LIMIT:
+            # 大きいファイルはメモリに読み込まず, 送りながら（同じ 1 回の読み込みで）チェックサムを求める.
+            # チェックサムは送り終わってからメタデータに付ける (attach_checksum)
+            hasher = new_hasher(self.checksum_algorithm) if self.checksum_algorithm and digest is None else None
+            metadata = self.checksum_metadata(digest)
+            if multipart:
+                sent = self.upload_multipart(local_path, bucket, key, size, metadata, hasher)
+                hashed = size
+            else:
+                self.throttle(size)
+                with open(local_path, "rb") as fin:
+                    body = fin if hasher is None else HashingReader(fin, hasher)
+                    self.client.put_object(Bucket=bucket, Key=key, Body=body, ContentLength=size, Metadata=metadata)
+                hashed = size if hasher is None else body.hashed
+                sent = size
+            # 途中を読み飛ばされた場合 (hashed < size) はチェックサムを使わない
+            if hasher is not None and hashed == size:
+                digest = hasher.hexdigest()
+                self.attach_checksum(bucket, key, size, digest)
+        else:
+            # 小さいファイルは 1 回の読み込みでチェックサムの計算とアップロードを行う
+            with open(local_path, "rb") as fin:
+                data = fin.read()
+            if self.checksum_algorithm:
+                hasher = new_hasher(self.checksum_algorithm)
+                hasher.update(data)
+                digest = hasher.hexdigest()
+            if self.copy_duplicate(digest, size, bucket, key):
+                sent = 0
+            else:
+                self.throttle(size)
+                self.client.put_object(Bucket=bucket, Key=key, Body=data, Metadata=self.checksum_metadata(digest))
+                sent = size
+
+        if self.checksum_cache is not None and digest is not None:
+            encoding = self.compression if remote_key != key else "identity"
+            self.checksum_cache.put(local_path, st, self.checksum_algorithm, digest, remote_url, encoding)
+        return sent
+
+    def throttle(self, nbytes: int):
+        if self.concurrency is not None:
+            self.concurrency.throttle(nbytes)
+
+    def timed_upload(self, local_path: str, bucket: str, key: str, trust_cache: bool = True):
+        #--- upload_file() reporting its size, duration and outcome to the concurrency controller ---#
+        if self.concurrency is None:
+            return self.upload_file(local_path, bucket, key, trust_cache)
+        started = time.monotonic()
+        try:
+            sent = self.upload_file(local_path, bucket, key, trust_cache)
+        except Exception:
+            self.concurrency.record(0, time.monotonic() - started, error=True)
+            raise
+        self.concurrency.record(sent, time.monotonic() - started)
+        return sent
+
+    def checksum_metadata(self, digest: str):
+        return {"content-hash": f"{self.checksum_algorithm}:{digest}"} if digest else {}
+
+    def attach_checksum(self, bucket: str, key: str, size: int, digest: str):
+        #--- add the content-hash of an object hashed while it was sent (server-side copy onto itself) ---#
+        if size > MAX_COPY_OBJECT_SIZE:
+            # 5 GiB を超えるオブジェクトは CopyObject できないので checksum_cache のみに記録する
+            log.debug(f"Checksum of s3://{bucket}/{key} is kept in the checksum cache only ({size} bytes)")
+            return
+        try:
+            self.client.copy_object(Bucket=bucket, Key=key, CopySource={"Bucket": bucket, "Key": key},
+                                    Metadata=self.checksum_metadata(digest), MetadataDirective="REPLACE")
+        except Exception as e:
+            log.warning(f"Failed to add the checksum to s3://{bucket}/{key}: {e}")
+
+    def copy_duplicate(self, digest: str, size: int, bucket: str, key: str):
+        #--- copy an uncompressed object with the same content server-side instead of uploading; True if copied ---#
+        if self.checksum_cache is None or digest is None or size == 0:
+            return False
+        source = self.checksum_cache.find_remote(self.checksum_algorithm, digest, size, "identity")
+        if source is None or source == f"s3://{bucket}/{key}":
+            return False
+        src_bucket, src_key = split_s3_url(source)
+        try:
+            self.client.copy_object(Bucket=bucket, Key=key, CopySource={"Bucket": src_bucket, "Key": src_key},
+                                    Metadata=self.checksum_metadata(digest), MetadataDirective="REPLACE")
+        except Exception as e:
+            log.warning(f"Server-side copy from {source} failed ({e}). Uploading s3://{bucket}/{key}.")
+            return False
+        log.debug(f"dedup: '{source}' -> 's3://{bucket}/{key}'")
+        return True
+
+    def upload_compressed(self, local_path: str, bucket: str, key: str, size: int):
+        #--- compress local_path in the process pool and send the compressed bytes; returns (bytes sent, digest) ---#
+        data, digest = self.compress_pool.submit(
+            compress_file, self.compression, local_path, self.compression_level, self.checksum_algorithm,
+        ).result()
+        metadata = {"compression": self.compression, "original-size": str(size)}
+        metadata.update(self.checksum_metadata(digest))
+        self.throttle(len(data))
+        self.client.put_object(Bucket=bucket, Key=self.remote_key(local_path, key), Body=data, Metadata=metadata)
+        return len(data), digest
+
+    def verify_file(self, local_path: str, bucket: str, key: str):
+        """
+        Compares the checksum of local_path (cached or computed locally) with the
+        content-hash metadata of its object (HEAD request only, no download).
+        Returns "ok", "missing", "mismatch" or "no-checksum".
+        """
+        remote_key = self.remote_key(local_path, key)
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=remote_key)
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return "missing"
+            raise
+        remote_hash = head.get("Metadata", {}).get("content-hash")
+        if not remote_hash:
+            return "no-checksum"
+
+        algorithm, _, remote_digest = remote_hash.partition(":")
+        st = os.stat(local_path)
+        digest = None
+        if self.checksum_cache is not None:
+            digest, _remote = self.checksum_cache.get(local_path, st, algorithm)
+        if digest is None:
+            digest = hash_file(local_path, algorithm)
+            if self.checksum_cache is not None:
+                self.checksum_cache.put(local_path, st, algorithm, digest)
+        return "ok" if digest == remote_digest else "mismatch"
+
+    def upload_multipart(self, local_path: str, bucket: str, key: str, size: int, metadata: dict = None,
+                         hasher=None):
+        #--- multipart upload of a large file with the parts sent in parallel (hasher: updated with the content) ---#
+        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata or {})["UploadId"]
+        ranges = [(start, min(start + self.multipart_chunksize, size))
+                  for start in range(0, size, self.multipart_chunksize)]
+        log.info(f"Multipart upload of {local_path} ({size} bytes, {len(ranges)} parts)")
+        try:
+            with open(local_path, "rb") as fin, \
+                    mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                futures = []
+                for number, (start, end) in enumerate(ranges, start=1):
+                    futures.append(
+                        self.part_executor.submit(self.upload_part, mm, bucket, key, upload_id, number, start, end))
+                    if hasher is not None:
+                        # 送信中の part と同じページを順に読むので, ディスクからの読み込みは 1 回で済む
+                        with memoryview(mm) as view, view[start:end] as part:
+                            hasher.update(part)
+                # mmap を閉じる前に全ての part の完了を待つ
+                wait(futures)
+                parts = [future.result() for future in futures]
+            self.client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            # 残った part が課金・容量の対象にならないように中止する
+            try:
+                self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            except Exception as e:
+                log.warning(f"Failed to abort multipart upload of {local_path}: {e}")
+            raise
+        return size
+
+    def upload_part(self, mm: mmap.mmap, bucket: str, key: str, upload_id: str,
+                    number: int, start: int, end: int):
+        #--- upload one part, retried up to part_retries times ---#
+        for attempt in range(1, self.part_retries + 1):
+            try:
+                self.throttle(end - start)
+                response = self.client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                    Body=MmapPartReader(mm, start, end), ContentLength=end - start,
+                )
+                return {"PartNumber": number, "ETag": response["ETag"]}
+            except Exception as e:
+                if attempt == self.part_retries:
+                    raise
+                log.warning(f"Retrying part {number} of s3://{bucket}/{key} ({attempt}/{self.part_retries}): {e}")
+                time.sleep(0.5 * 2 ** attempt)
+
+    def upload_files(self, uploads: list, max_workers: int = None, stop: threading.Event = None,
+                     trust_cache: bool = True):
+        """
+        uploads: list of (local_path, bucket, key)
+        max_workers: at most this many files of this call are in flight at once
+                     (the shared pool is still bounded by num_threads)
+        stop: when set, no more files are started and the call returns after the files in flight
+        trust_cache: skip files the checksum cache reports as uploaded unchanged to the same key
+                     (False when the remote listing has just reported them missing or different)
+        Returns {"uploaded": [local_path, ...], "failed": [(local_path, error), ...], "bytes": n,
+                 "stopped": bool}
+        """
+        result = {"uploaded": [], "failed": [], "bytes": 0, "stopped": False}
+        max_workers = max(1, min(max_workers or self.num_threads, self.num_threads))
+        next_index = 0
+        futures = {}
+        while True:
+            if stop is not None and stop.is_set() and next_index < len(uploads):
+                # 残りのファイルは投入せず, 転送中のファイルの完了を待って戻る
+                result["stopped"] = True
+                next_index = len(uploads)
+            # 1 データセットが共有プールを占有しないように、投入数を max_workers に制限する
+            # (adaptive の場合は制御器の現在の上限も超えない)
+            limit = max_workers if self.concurrency is None else min(max_workers, self.concurrency.limit())
+            while next_index < len(uploads) and len(futures) < limit:
+                u = uploads[next_index]
+                futures[self.executor.submit(self.timed_upload, *u, trust_cache)] = u
+                next_index += 1
+            if not futures:
+                break
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                local_path, bucket, key = futures.pop(future)
+                try:
+                    result["bytes"] += future.result()
+                    result["uploaded"].append(local_path)
+                    log.debug(f"upload: '{local_path}' -> 's3://{bucket}/{key}'")
+                except Exception as e:
+                    log.error(f"Failed to upload {local_path} -> s3://{bucket}/{key}: {e}")
+                    result["failed"].append((local_path, str(e)))
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.part_executor.shutdown(wait=True)
+        if self.compress_pool is not None:
+            self.compress_pool.shutdown(wait=True)
+
+#--- S3Uploader ---#
+
+
+# added scan_local_files 2026-10-17
+def scan_local_files(local_dir: str):
+    #--- list of (path, size, mtime) of all files under local_dir (local stat calls only) ---#
+    local_files = []
+    for root, _dirs, files in os.walk(local_dir):
+        for name in files:
+            local_path = os.path.join(root, name)
+            try:
+                st = os.stat(local_path)
+            except OSError:
+                continue
+            local_files.append((local_path, st.st_size, st.st_mtime))
+    return local_files
+
+#--- scan_local_files ---#
+
+
+# added remote_url_for 2026-10-17
+def remote_url_for(local_path: str, dirname_transferred: str, s3_destination: str):
+    #--- S3 URL of local_path when dirname_transferred is synced to s3_destination (s3cmd layout) ---#
+    base = os.path.basename(dirname_transferred.rstrip("/"))
+    return s3_destination + base + "/" + os.path.relpath(local_path, dirname_transferred)
+
+#--- remote_url_for ---#
+
+
+# added TransferManifest 2026-10-17
+class TransferManifest:
+    """
+    Persistent local manifest (SQLite) of the files confirmed uploaded to S3,
+    keyed by local path with size and mtime.
+
+    Once a directory has been synced against a full remote listing (seeded),
+    the files to upload are worked out from local stat calls only.
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploaded_files ("
+                " local_path TEXT PRIMARY KEY, size INTEGER, mtime REAL,"
+                " remote TEXT, uploaded_at REAL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS synced_dirs ("
+                " local_dir TEXT PRIMARY KEY, remote TEXT, listed_at REAL)"
+            )
+
+    def is_seeded(self, local_dir: str):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM synced_dirs WHERE local_dir = ?", (local_dir,)
+            ).fetchone()
+        return row is not None
+
+    def mark_seeded(self, local_dir: str, remote: str):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO synced_dirs VALUES (?, ?, ?)",
+                (local_dir, remote, time.time()),
+            )
+
+    def pending(self, local_files: list):
+        #--- files of local_files that are not recorded with the same size and mtime ---#
+        with self.lock:
+            recorded = {}
+            for local_path, _size, _mtime in local_files:
+                row = self.conn.execute(
+                    "SELECT size, mtime FROM uploaded_files WHERE local_path = ?", (local_path,)
+                ).fetchone()
+                if row is not None:
+                    recorded[local_path] = row
+        return [f for f in local_files if recorded.get(f[0]) != (f[1], f[2])]
+
+    def record(self, entries: list):
+        #--- entries: list of (local_path, size, mtime, remote) confirmed uploaded ---#
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO uploaded_files VALUES (?, ?, ?, ?, ?)",
+                [(p, size, mtime, remote, now) for p, size, mtime, remote in entries],
+            )
+
+    def forget_directory(self, local_dir: str):
+        #--- drop a directory from the manifest so that the next sync lists the remote again ---#
+        prefix = local_dir.rstrip("/") + "/"
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM synced_dirs WHERE local_dir = ?", (local_dir,))
+            self.conn.execute(
+                "DELETE FROM uploaded_files WHERE substr(local_path, 1, ?) = ?", (len(prefix), prefix)
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+#--- TransferManifest ---#
+
+
+# added DatasetStateStore 2026-10-17
+class DatasetStateStore:
+    """
+    Persistent, crash-safe (SQLite) transfer state of each dataset path.
+
+    state: pending -> in_progress -> uploaded -> kamo_registered
+    A dataset that reached uploaded/kamo_registered never goes back to an
+    earlier state: the latest dataset is synced again every cycle, and that
+    re-sync must not make it look interrupted.
+    A dataset is "final" once a newer line follows it in .dataset_paths_for_kamo.txt;
+    final datasets that reached uploaded/kamo_registered are not synced again after
+    a restart, and datasets left in pending/in_progress are resumed.
+    """
+    STATES = ("pending", "in_progress", "uploaded", "kamo_registered")
+    # state -> column holding the time the state was first reached
+    STATE_TIMES = {"pending": "created_at", "in_progress": "started_at",
+                   "uploaded": "uploaded_at", "kamo_registered": "registered_at"}
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS datasets ("
+                " dataset_path TEXT PRIMARY KEY, state TEXT, final INTEGER DEFAULT 0,"
+                " output_path_by_bss TEXT, total INTEGER, files INTEGER, bytes INTEGER,"
+                " created_at REAL, started_at REAL, uploaded_at REAL, registered_at REAL, updated_at REAL)"
+            )
+
+    def update(self, dataset_path: str, state: str, output_path_by_bss: str = None,
+               total: int = None, files: int = None, nbytes: int = None):
+        #--- set the state of dataset_path (other values are kept if None) ---#
+        if state not in self.STATES:
+            raise ValueError(f"Unknown dataset state: {state}")
+        now = time.time()
+        time_column = self.STATE_TIMES[state]
+        # created_at は最初に見つかった時刻, それ以外はその状態に最後になった時刻
+        time_value = f"COALESCE({time_column}, ?)" if time_column == "created_at" else "?"
+        # uploaded / kamo_registered から前の状態には戻さない
+        kept = [s for s in ("uploaded", "kamo_registered") if self.STATES.index(s) > self.STATES.index(state)]
+        state_value = f"CASE WHEN state IN ({', '.join(repr(s) for s in kept)}) THEN state ELSE ? END" if kept else "?"
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO datasets (dataset_path, state, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (dataset_path, state, now, now),
+            )
+            self.conn.execute(
+                f"UPDATE datasets SET state = {state_value}, updated_at = ?,"
+                f" {time_column} = {time_value},"
+                " output_path_by_bss = COALESCE(?, output_path_by_bss),"
+                " total = COALESCE(?, total), files = COALESCE(?, files), bytes = COALESCE(?, bytes)"
+                " WHERE dataset_path = ?",
+                (state, now, now, output_path_by_bss, total, files, nbytes, dataset_path),
+            )
+
+    def mark_final(self, dataset_paths: list):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE datasets SET final = 1 WHERE dataset_path = ?", [(p,) for p in dataset_paths]
+            )
+
+    def get(self, dataset_path: str):
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM datasets WHERE dataset_path = ?", (dataset_path,))
+            row = cursor.fetchone()
+            columns = [c[0] for c in cursor.description]
+        return dict(zip(columns, row)) if row is not None else None
+
+    def processed(self):
+        #--- final datasets that are already uploaded (replaces the in-memory processed_files) ---#
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT dataset_path FROM datasets WHERE final = 1 AND state IN ('uploaded', 'kamo_registered')"
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def interrupted(self):
+        #--- datasets left in pending/in_progress, oldest first: [(dataset_path, output_path_by_bss, total), ...] ---#
+        with self.lock:
+            return self.conn.execute(
+                "SELECT dataset_path, output_path_by_bss, total FROM datasets"
+                " WHERE state IN ('pending', 'in_progress') ORDER BY created_at"
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+#--- DatasetStateStore ---#
+
+
+# added RetryQueue 2026-10-17
+class RetryQueue:
+    """
+    Durable (SQLite) queue of the files whose upload failed, with per-file outcome.
+
+    Each failure increments the attempts of the file and schedules the next
+    attempt with exponential backoff and jitter
+    (base_delay * 2 ** (attempts - 1), at most max_delay, between 50% and 100%
+    of that). After max_attempts the file is kept with state "failed" for
+    inspection and is not retried automatically. A successful upload removes
+    the file from the queue.
+    """
+    def __init__(self, db_path: str, base_delay: float = 10, max_delay: float = 600, max_attempts: int = 10):
+        self.db_path = db_path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max(1, max_attempts)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS retries ("
+                " local_path TEXT PRIMARY KEY, remote TEXT, dataset_path TEXT, state TEXT,"
+                " attempts INTEGER, next_attempt REAL, last_error TEXT, updated_at REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS retries_next ON retries (state, next_attempt)")
+
+    def backoff(self, attempts: int):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def record_failures(self, failures: list, dataset_path: str = None):
+        #--- failures: list of (local_path, remote, error); returns the local paths given up ---#
+        now = time.time()
+        given_up = []
+        with self.lock, self.conn:
+            for local_path, remote, error in failures:
+                row = self.conn.execute(
+                    "SELECT attempts, dataset_path FROM retries WHERE local_path = ?", (local_path,)
+                ).fetchone()
+                attempts = (row[0] if row is not None else 0) + 1
+                state = "pending" if attempts < self.max_attempts else "failed"
+                if state == "failed":
+                    given_up.append(local_path)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (local_path, remote, dataset_path or (row[1] if row is not None else None), state,
+                     attempts, now + self.backoff(attempts), str(error)[:1000], now),
+                )
+        return given_up
+
+    def record_success(self, local_paths):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM retries WHERE local_path = ?", [(p,) for p in local_paths])
+
+    def due(self, limit: int = 1000):
+        #--- [(local_path, remote, dataset_path, attempts), ...] whose next attempt is due ---#
+        with self.lock:
+            return self.conn.execute(
+                "SELECT local_path, remote, dataset_path, attempts FROM retries"
+                " WHERE state = 'pending' AND next_attempt <= ? ORDER BY next_attempt LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+
+    def has_pending(self, dataset_path: str):
+        #--- True if dataset_path still has files waiting for a retry (or given up) ---#
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM retries WHERE dataset_path = ? LIMIT 1", (dataset_path,)
+            ).fetchone()
+        return row is not None
+
+    def counts(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM retries GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+#--- RetryQueue ---#
+
+
+# added KamoFileWriter 2026-10-17
+# updated KamoFileWriter 2026-10-17 (upload outside the lock, retry of failed uploads)
+class KamoFileWriter:
+    """
+    Appends entries to dataset_paths_for_kamo.txt files and uploads them.
+
+    The entries of each file are read once and then kept in memory, so that the
+    duplicate check does not re-read the file. Entries added within
+    coalesce_seconds of each other are written with a single append and the
+    file is uploaded once (coalesce_seconds: 0 writes and uploads immediately).
+
+    upload(local_path, remote_url) uploads one file (raises on failure).
+    on_flushed(key) is called for the key of each entry once it is uploaded.
+
+    The upload runs outside the lock, so add() from other threads does not
+    wait for it. Only one upload of a file runs at a time: entries written
+    while it runs are uploaded by the same thread right after it. A file whose
+    upload failed stays in unsynced until flush_unsynced() (called every cycle)
+    or the next flush of that file uploads it.
+    """
+    def __init__(self, upload, coalesce_seconds: float = 0, on_flushed=None):
+        self.upload = upload
+        self.coalesce_seconds = coalesce_seconds
+        self.on_flushed = on_flushed
+        self.lock = threading.Lock()
+        self.registered = {}    # local_path -> set of entries in the file (or pending)
+        self.pending = {}       # local_path -> {"remote": url, "entries": [...], "keys": [...]}
+        self.unsynced = {}      # local_path -> {"remote": url, "keys": [...]} of files written but not uploaded yet
+        self.uploading = set()  # local_path of the files being uploaded
+        self.timers = {}
+
+    def load(self, local_path: str):
+        #--- entries already in local_path (called with lock) ---#
+        if local_path not in self.registered:
+            entries = set()
+            if os.path.isfile(local_path):
+                with open(local_path, "r") as fin:
+                    entries = {l.strip() for l in fin if l.strip()}
+            self.registered[local_path] = entries
+        return self.registered[local_path]
+
+    def contains(self, local_path: str, entry: str):
+        #--- True if entry is already in local_path (or pending) ---#
+        with self.lock:
+            return entry in self.load(local_path)
+
+    def add(self, local_path: str, remote_url: str, entry: str, key=None):
+        #--- queue entry for local_path; returns False if it is already registered ---#
+        with self.lock:
+            registered = self.load(local_path)
+            if entry in registered:
+                log.info(f"Path already exists in {local_path}. Skipping.")
+                return False
+            registered.add(entry)
+            batch = self.pending.setdefault(local_path, {"remote": remote_url, "entries": [], "keys": []})
+            batch["entries"].append(entry)
+            if key is not None:
+                batch["keys"].append(key)
+
+            if self.coalesce_seconds > 0:
+                if local_path not in self.timers:
+                    timer = threading.Timer(self.coalesce_seconds, self.flush, args=(local_path,))
+                    timer.daemon = True
+                    self.timers[local_path] = timer
+                    timer.start()
+                return True
+
+        self.flush(local_path)
+        return True
+
+    def flush(self, local_path: str):
+        #--- write the pending entries of local_path in one append and upload the file once ---#
+        with self.lock:
+            self.timers.pop(local_path, None)
+            batch = self.pending.pop(local_path, None)
+            if batch is None and local_path not in self.unsynced:
+                return
+            if batch is not None:
+                try:
+                    with open(local_path, "a") as fout:
+                        fout.write("".join(f"{entry}\n" for entry in batch["entries"]))
+                        fout.flush()
+                        os.fsync(fout.fileno())
+                except OSError as e:
+                    log.error(f"Failed to write to {local_path}: {e}")
+                    self.registered[local_path].difference_update(batch["entries"])
+                    return
+                log.info(f"Appended {len(batch['entries'])} paths to {local_path}: {batch['entries']}")
+                unsynced = self.unsynced.setdefault(local_path, {"remote": batch["remote"], "keys": []})
+                unsynced["keys"].extend(batch["keys"])
+            if local_path in self.uploading:
+                # 実行中のアップロードが終わった後に, そのスレッドがもう一度アップロードする
+                return
+            self.uploading.add(local_path)
+
+        while True:
+            with self.lock:
+                unsynced = self.unsynced.pop(local_path, None)
+                if unsynced is None:
+                    self.uploading.discard(local_path)
+                    return
+
+            try:
+                log.info(f"Transferring local kamo_proc_path to aoba: {local_path} -> {unsynced['remote']}")
+                self.upload(local_path, unsynced["remote"])
+            except Exception as e:
+                # 書き込み済みのファイルは flush_unsynced() か次回の flush で再度アップロードする
+                log.error(f"Failed to upload {local_path}: {e}")
+                with self.lock:
+                    newer = self.unsynced.pop(local_path, {"keys": []})
+                    self.unsynced[local_path] = {"remote": unsynced["remote"],
+                                                 "keys": unsynced["keys"] + newer["keys"]}
+                    self.uploading.discard(local_path)
+                return
+
+            if self.on_flushed is not None:
+                for key in unsynced["keys"]:
+                    self.on_flushed(key)
+
+    def flush_unsynced(self):
+        #--- upload again the files whose upload failed ---#
+        with self.lock:
+            local_paths = [p for p in self.unsynced if p not in self.uploading and p not in self.pending]
+        for local_path in local_paths:
+            self.flush(local_path)
+
+    def flush_all(self):
+        with self.lock:
+            local_paths = set(self.pending) | set(self.unsynced)
+            for timer in self.timers.values():
+                timer.cancel()
+        for local_path in local_paths:
+            self.flush(local_path)
+
+#--- KamoFileWriter ---#
+
+
+# added WorkerBudget 2026-10-17
+# updated WorkerBudget 2026-10-17 (workers reserved per lane)
+# updated WorkerBudget 2026-10-17 (granted in priority order)
+class WorkerBudget:
+    """
+    Global budget of upload workers shared by the datasets transferred at the same time.
+
+    acquire() blocks until at least one worker is free and grants up to the
+    requested number, so that a small scan/check directory can start with a
+    single worker while a large data collection holds the rest.
+
+    reserved keeps a number of workers for each lane: a lane cannot take the
+    workers reserved for another lane that are not in use by that lane, so a
+    data collection never holds the whole budget while scan/check waits.
+    The reservation is ignored if the budget cannot cover it.
+
+    Waiting callers are served in priority order (smaller first, then in
+    order of arrival): a worker is not granted while a caller with a smaller
+    priority that could use it is waiting. A preempted job that is requeued
+    therefore cannot win the workers it released back from the job that
+    preempted it.
+    """
+    def __init__(self, total: int, reserved: dict = None):
+        self.total = max(1, total)
+        self.available = self.total
+        self.reserved = dict(reserved or {})
+        if sum(self.reserved.values()) > self.total:
+            self.reserved = {}
+        self.in_use = {}
+        self.cond = threading.Condition()
+        # (priority, seq) -> lane of the callers waiting in acquire()
+        self.waiting = {}
+        self.seq = itertools.count()
+
+    def free_for(self, lane: str = None):
+        #--- workers lane can take now: the free workers minus those kept for the other lanes ---#
+        kept = sum(max(0, n - self.in_use.get(l, 0)) for l, n in self.reserved.items() if l != lane)
+        return self.available - kept
+
+    def can_grant(self, key: tuple, lane: str):
+        #--- True if lane has a free worker and no caller before key could take it (called with cond) ---#
+        if self.free_for(lane) < 1:
+            return False
+        return not any(other < key and self.free_for(other_lane) >= 1
+                       for other, other_lane in self.waiting.items())
+
+    def acquire(self, requested: int, lane: str = None, priority: int = 0):
+        with self.cond:
+            key = (priority, next(self.seq))
+            self.waiting[key] = lane
+            try:
+                while not self.can_grant(key, lane):
+                    self.cond.wait()
+            finally:
+                del self.waiting[key]
+            granted = max(1, min(requested, self.free_for(lane)))
+            self.available -= granted
+            self.in_use[lane] = self.in_use.get(lane, 0) + granted
+            # 次の順番の呼び出し元に確認させる
+            self.cond.notify_all()
+            return granted
+
+    def release(self, granted: int, lane: str = None):
+        with self.cond:
+            self.available = min(self.total, self.available + granted)
+            self.in_use[lane] = max(0, self.in_use.get(lane, 0) - granted)
+            self.cond.notify_all()
+
+#--- WorkerBudget ---#
+
+
+# added TransferPreempted 2026-10-17
+class TransferPreempted(Exception):
+    """Raised by a transfer that stopped early to make room for a higher-priority dataset."""
+
+#--- TransferPreempted ---#
+
+
+# added DatasetScheduler 2026-10-17
+# updated DatasetScheduler 2026-10-17 (priority queue and preemption)
+# updated DatasetScheduler 2026-10-17 (fair share between monitors)
+class DatasetScheduler:
+    """
+    Runs dataset transfers concurrently instead of one after another.
+
+    Each lane ("data", "other") has its own bounded set of workers, so that
+    scan/check directories do not queue behind a large data collection.
+    Within a lane, datasets are taken from a priority queue (smaller first,
+    FIFO for the same priority). Every job takes up to threads_per_dataset
+    workers from the shared WorkerBudget while it runs.
+
+    When a dataset is submitted while its lane or the budget is full, the
+    running job with the lowest priority is asked to stop (its preempt event
+    is set). A job that raises TransferPreempted is put back in the queue.
+    A dataset that is queued or running is not submitted again.
+
+    When several monitors (beamlines) share the scheduler, each submit names
+    its tenant and weight. Datasets of the same priority are then ordered by
+    a start-time fair queuing tag instead of arrival, so a beamline that
+    queues many datasets at once does not hold back the others: a tenant
+    with weight 2 gets about twice as many starts as one with weight 1.
+    """
+    def __init__(self, lanes: dict, budget: WorkerBudget, threads_per_dataset: int):
+        self.budget = budget
+        self.threads_per_dataset = threads_per_dataset
+        self.lane_size = {lane: max(1, n) for lane, n in lanes.items()}
+        self.queues = {lane: queue.PriorityQueue() for lane in lanes}
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.active = set()
+        # fair queuing: tag of the last started job, and the last tag given to each tenant
+        self.virtual_time = 0.0
+        self.last_tag = {}
+        # dataset_path -> (lane, priority, preempt event) of the running jobs
+        self.running = {}
+
+        self.workers = []
+        for lane, n in self.lane_size.items():
+            for i in range(n):
+                worker = threading.Thread(target=self.worker, args=(lane,),
+                                          name=f"dataset-{lane}-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, lane: str, dataset_path: str, priority: int, func, *args, tenant: str = None,
+               weight: float = 1.0):
+        """
+        Queues func(*args, num_threads=<granted workers>, preempt=<threading.Event>) in lane.
+        Returns False if dataset_path is already queued or running.
+        """
+        with self.lock:
+            if dataset_path in self.active:
+                log.debug(f"Dataset is already queued or running: {dataset_path}")
+                return False
+            self.active.add(dataset_path)
+            self.preempt_for(lane, priority)
+            tag = 0.0
+            if tenant is not None:
+                tag = max(self.virtual_time, self.last_tag.get(tenant, 0.0)) + 1.0 / max(weight, 1e-3)
+                self.last_tag[tenant] = tag
+
+        log.info(f"Queued dataset in '{lane}' lane with priority {priority}"
+                 f"{f' for {tenant}' if tenant else ''}: {dataset_path}")
+        self.queues[lane].put((priority, tag, next(self.seq), dataset_path, func, args))
+        return True
+
+    def preempt_for(self, lane: str, priority: int):
+        #--- ask the lowest-priority running job to stop if there is no room for a new job (called with lock) ---#
+        lane_full = sum(1 for r in self.running.values() if r[0] == lane) >= self.lane_size[lane]
+        if not lane_full and self.budget.free_for(lane) > 0:
+            return
+
+        candidates = [
+            (p, path) for path, (l, p, preempt) in self.running.items()
+            if p > priority and not preempt.is_set() and (l == lane or not lane_full)
+        ]
+        if not candidates:
+            return
+
+        victim_priority, victim = max(candidates)
+        log.info(f"Preempting {victim} (priority {victim_priority}) for a priority {priority} dataset.")
+        self.running[victim][2].set()
+
+    def worker(self, lane: str):
+        while True:
+            entry = self.queues[lane].get()
+            if entry[4] is None:
+                return
+            self.run(lane, entry)
+
+    def run(self, lane: str, entry: tuple):
+        priority, tag, _seq, dataset_path, func, args = entry
+        granted = self.budget.acquire(self.threads_per_dataset, lane, priority)
+        preempt = threading.Event()
+        with self.lock:
+            self.running[dataset_path] = (lane, priority, preempt)
+            self.virtual_time = max(self.virtual_time, tag)
+        log.info(f"Start dataset with {granted} workers "
+                 f"({self.budget.available}/{self.budget.total} free): {dataset_path}")
+
+        requeue = False
+        try:
+            func(*args, num_threads=granted, preempt=preempt)
+        except TransferPreempted:
+            log.info(f"Dataset preempted, requeued: {dataset_path}")
+            requeue = True
+        except Exception as e:
+            log.error(f"Error while processing {dataset_path}: {e}")
+        finally:
+            self.budget.release(granted, lane)
+            with self.lock:
+                self.running.pop(dataset_path, None)
+                if not requeue:
+                    self.active.discard(dataset_path)
+
+        if requeue:
+            # 元の順番 (tag, seq) のまま戻すので, 同じ優先度の中では先頭に近い位置から再開する
+            self.queues[lane].put(entry)
+
+    def queue_depth(self):
+        with self.lock:
+            return len(self.active)
+
+    def shutdown(self):
+        for lane, n in self.lane_size.items():
+            for _ in range(n):
+                self.queues[lane].put((float("inf"), float("inf"), next(self.seq), None, None, ()))
+        for worker in self.workers:
+            worker.join()
+
+#--- DatasetScheduler ---#
+
+
+# added AsyncEngine 2026-10-17
+class AsyncEngine:
+    """
+    asyncio-based daemon core (engine: asyncio).
+
+    The monitor, the dataset transfers, the kamo registration, the retries of
+    failed files and the post-transfer hooks (e.g. XDS submission) run as
+    cooperating tasks, so that a slow or hung s3cmd does not stop the
+    detection of new datasets.
+
+    The existing blocking transfer code runs in executor threads. Each transfer
+    gets a preempt event: on dataset_timeout or shutdown the event is set, which
+    kills the s3cmd/xargs process group (or stops the boto3 uploader between
+    files) and the dataset is left in_progress to be resumed later.
+
+    On SIGTERM/SIGINT the monitor stops, running transfers get shutdown_timeout
+    seconds to finish, and the kamo entries, read offsets and pools are flushed
+    and closed by auto.shutdown().
+    """
+    def __init__(self, auto, dataset_timeout: float = None, hook_timeout: float = None,
+                 shutdown_timeout: float = 60):
+        self.auto = auto
+        self.dataset_timeout = dataset_timeout
+        self.hook_timeout = hook_timeout
+        self.shutdown_timeout = shutdown_timeout
+        # dataset_path -> (task, preempt event) of the running transfers
+        self.transfers = {}
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        self.updated = asyncio.Event()
+        self.post_transfer_queue = asyncio.Queue()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.request_stop, signum)
+
+        # 並列数は max_parallel_datasets / max_parallel_other（1 の場合は 1 データセットずつ）
+        self.lanes = {
+            "data": asyncio.Semaphore(max(1, self.auto.max_parallel_datasets)),
+            "other": asyncio.Semaphore(max(1, self.auto.max_parallel_other)),
+        }
+        # 転送完了後の処理はフックから呼ばれるスレッドではなくイベントループ上のキューで行う
+        self.auto.post_transfer = self.enqueue_post_transfer
+
+        watcher = self.auto.watcher
+        if watcher is not None:
+            self.loop.add_reader(watcher.fd, self.on_inotify)
+
+        tasks = [
+            asyncio.create_task(self.monitor(), name="monitor"),
+            asyncio.create_task(self.kamo_flusher(), name="kamo"),
+            asyncio.create_task(self.post_transfer_worker(), name="post-transfer"),
+            asyncio.create_task(self.retry_worker(), name="retry"),
+        ]
+        await self.stop.wait()
+
+        log.info("Shutting down...")
+        tasks[0].cancel()
+        await self.drain_transfers()
+        await self.drain_post_transfer()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if watcher is not None:
+            self.loop.remove_reader(watcher.fd)
+        await asyncio.to_thread(self.auto.shutdown)
+        log.info("Shutdown complete.")
+
+    def request_stop(self, signum=None):
+        if signum is not None:
+            log.info(f"Received signal {signal.Signals(signum).name}.")
+        self.stop.set()
+
+    def on_inotify(self):
+        if self.auto.watcher.read_events():
+            self.updated.set()
+
+    async def wait_for_update(self, output_path_by_bss: str = None):
+        #--- wait until monitor.txt / .dataset_paths_for_kamo.txt is updated, wait_time passes or stop is requested ---#
+        auto = self.auto
+        if auto.watcher is not None and output_path_by_bss and os.path.isabs(output_path_by_bss):
+            auto.watcher.watch(output_path_by_bss)
+        waiters = [asyncio.ensure_future(self.stop.wait())]
+        if auto.watcher is not None:
+            waiters.append(asyncio.ensure_future(self.updated.wait()))
+        try:
+            await asyncio.wait(waiters, timeout=auto.wait_time, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+        if self.updated.is_set():
+            log.info("Update detected by inotify.")
+            self.updated.clear()
+
+    async def monitor(self):
+        #--- the main loop of proc() without blocking calls ---#
+        auto = self.auto
+        await asyncio.to_thread(auto.resume_interrupted, self.start_transfer_threadsafe)
+        while not self.stop.is_set():
+            cycle_started = time.monotonic()
+            output_path_by_bss = await asyncio.to_thread(auto.path)
+            if not output_path_by_bss:
+                log.info("No output_path_by_bss found yet. Waiting...")
+                await self.wait_for_update()
+                continue
+
+            dataset_info = await asyncio.to_thread(auto.load_dataset_paths_for_kamo_file, output_path_by_bss)
+            if dataset_info is None:
+                log.error("Failed to load dataset info.")
+                await self.wait_for_update(output_path_by_bss)
+                continue
+
+            for dataset_path, total, priority in auto.new_datasets(output_path_by_bss, dataset_info):
+                if auto.should_stream(dataset_path, dataset_info):
+                    auto.start_streaming(dataset_path, total, output_path_by_bss)
+                    continue
+                self.start_transfer(dataset_path, total, output_path_by_bss, priority)
+
+            await asyncio.to_thread(auto.finish_cycle, dataset_info, cycle_started)
+            log.info(f"Sync cycle finished ({len(self.transfers)} transfers running). Waiting...")
+            await self.wait_for_update(output_path_by_bss)
+
+    def start_transfer(self, dataset_path: str, total: int, output_path_by_bss: str, priority: int = 0):
+        #--- start a transfer task unless dataset_path is already being transferred ---#
+        if dataset_path in self.transfers:
+            log.debug(f"Dataset is already being transferred: {dataset_path}")
+            return
+        preempt = threading.Event()
+        task = asyncio.create_task(self.transfer(dataset_path, total, output_path_by_bss, priority, preempt),
+                                   name=f"transfer-{dataset_path}")
+        self.transfers[dataset_path] = (task, preempt)
+        task.add_done_callback(lambda _task: self.transfers.pop(dataset_path, None))
+
+    def start_transfer_threadsafe(self, dataset_path: str, total: int, output_path_by_bss: str, priority: int = 0):
+        self.loop.call_soon_threadsafe(self.start_transfer, dataset_path, total, output_path_by_bss, priority)
+
+    async def transfer(self, dataset_path: str, total: int, output_path_by_bss: str, priority: int,
+                       preempt: threading.Event):
+        auto = self.auto
+        lane = auto.identify_data_or_other(dataset_path)
+        async with self.lanes[lane]:
+            if self.stop.is_set():
+                return
+            # 同時に転送するデータセットで num_threads を分け合う（1 データセットずつの場合は設定値または adaptive の上限）
+            num_threads = None if auto.max_parallel_datasets <= 1 else auto.threads_per_dataset
+            job = asyncio.ensure_future(asyncio.to_thread(
+                auto.process_dataset, dataset_path, total, output_path_by_bss, num_threads, preempt,
+            ))
+            try:
+                # スレッドは中断できないので, 時間切れの場合は preempt で転送を止めてから終了を待つ
+                await asyncio.wait_for(asyncio.shield(job), self.dataset_timeout)
+            except asyncio.TimeoutError:
+                log.error(f"Transfer of {dataset_path} timed out after {self.dataset_timeout}s. Stopping it.")
+                auto.metrics.inc("transfer_timeouts_total")
+                preempt.set()
+            except asyncio.CancelledError:
+                preempt.set()
+            try:
+                await job
+            except TransferPreempted:
+                log.warning(f"Transfer of {dataset_path} was stopped. It is left in_progress.")
+            except Exception as e:
+                log.error(f"Error while processing {dataset_path}: {e}")
+
+    def enqueue_post_transfer(self, dataset_path: str, total: int, output_path_by_bss: str):
+        #--- auto.post_transfer while the engine is running (called from the transfer threads) ---#
+        self.loop.call_soon_threadsafe(self.post_transfer_queue.put_nowait,
+                                       (dataset_path, total, output_path_by_bss))
+
+    async def post_transfer_worker(self):
+        while True:
+            entry = await self.post_transfer_queue.get()
+            try:
+                await asyncio.wait_for(asyncio.to_thread(self.auto.run_post_transfer_hooks, *entry),
+                                       self.hook_timeout)
+            except asyncio.TimeoutError:
+                log.error(f"Post-transfer hooks of {entry[0]} timed out after {self.hook_timeout}s.")
+            finally:
+                self.post_transfer_queue.task_done()
+
+    async def retry_worker(self):
+        #--- resend the failed files whose backoff has expired ---#
+        while True:
+            await asyncio.sleep(max(self.auto.wait_time, 1))
+            await asyncio.to_thread(self.auto.retry_failed_uploads)
+
+    async def kamo_flusher(self):
+        #--- retry the upload of dataset_paths_for_kamo.txt files written but not uploaded yet ---#
+        while True:
+            await asyncio.sleep(max(self.auto.wait_time, 1))
+            if self.auto.kamo_writer.unsynced:
+                await asyncio.to_thread(self.auto.kamo_writer.flush_unsynced)
+
+    async def drain_transfers(self):
+        #--- give the running transfers shutdown_timeout seconds, then stop them ---#
+        if not self.transfers:
+            return
+        log.info(f"Waiting up to {self.shutdown_timeout}s for {len(self.transfers)} running transfers...")
+        running = list(self.transfers.values())
+        _done, pending = await asyncio.wait([task for task, _preempt in running], timeout=self.shutdown_timeout)
+        if pending:
+            log.warning(f"Stopping {len(pending)} transfers. They are resumed at the next start.")
+            for task, preempt in running:
+                preempt.set()
+            await asyncio.wait(pending)
+
+    async def drain_post_transfer(self):
+        try:
+            await asyncio.wait_for(self.post_transfer_queue.join(), self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            log.warning(f"{self.post_transfer_queue.qsize()} post-transfer jobs were not run.")
+
+#--- AsyncEngine ---#
+
+
+# added XdsDispatcher 2026-10-17
+class XdsDispatcher:
+    """
+    Submits XDS jobs on AOBA-S for uploaded datasets (replaces xds_auto.sh).
+
+    All ssh calls share one persistent connection (ControlMaster/ControlPath/
+    ControlPersist), and the jobs added within batch_seconds of each other
+    (at most batch_size) are sent in a single ssh round trip: for each dataset
+    the job file is written to its XDS directory, generate_XDS.INP is run and
+    the job is submitted with qsub. Every job prints a marker line, so that the
+    result of each dataset is known even if another job of the batch fails.
+
+    restore_commands are run on the frame directory before generate_XDS.INP
+    (e.g. `python3 transfer_auto.py --unbundle`), for frames that are not on
+    AOBA as plain files.
+
+    ssh_command, qsub and generate_command can point to local fakes for testing
+    (the remote script is passed to `<ssh_command> ... <host> bash -s` on stdin).
+    Datasets submitted successfully are saved to state_file and not submitted again.
+    on_result(dataset_path, ok, output) is called for each job.
+    """
+    def __init__(self, host: str = "sfront", ssh_command: str = "ssh", control_path: str = None,
+                 control_persist: int = 600, qsub: str = "/opt/nec/nqsv/bin/qsub",
+                 generate_command: str = "generate_XDS.INP", job_script: str = XDS_JOB_SCRIPT,
+                 batch_size: int = 8, batch_seconds: float = 5.0, retries: int = 3,
+                 timeout: float = 120, state_file: str = None, on_result=None, restore_commands: list = None):
+        self.host = host
+        self.ssh_command = ssh_command
+        self.control_path = control_path or os.path.join(tempfile.gettempdir(), "transfer_auto_ssh_%C")
+        self.control_persist = control_persist
+        self.qsub = qsub
+        self.generate_command = generate_command
+        self.restore_commands = restore_commands or []
+        self.job_script = job_script
+        self.batch_size = max(1, batch_size)
+        self.batch_seconds = batch_seconds
+        self.retries = max(1, retries)
+        self.timeout = timeout
+        self.state_file = state_file
+        self.on_result = on_result
+        self.lock = threading.Lock()
+        # ssh の実行は 1 つずつ（同じ ControlMaster を使い回す）
+        self.ssh_lock = threading.Lock()
+        self.pending = []       # [(dataset_path, xds_dir, template, attempts), ...]
+        self.queued = set()
+        self.timer = None
+        self.submitted = set()
+        self.load()
+
+    def load(self):
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r") as fin:
+                self.submitted = set(json.load(fin))
+            log.info(f"Loaded {len(self.submitted)} submitted XDS jobs from {self.state_file}")
+        except (OSError, ValueError) as e:
+            log.warning(f"Failed to load submitted XDS jobs from {self.state_file}: {e}")
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, "w") as fout:
+                json.dump(sorted(self.submitted), fout)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            log.error(f"Failed to save submitted XDS jobs to {self.state_file}: {e}")
+
+    def ssh_args(self):
+        return [
+            self.ssh_command,
+            "-o", "BatchMode=yes",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_path}",
+            "-o", f"ControlPersist={self.control_persist}",
+            self.host,
+        ]
+
+    def add(self, dataset_path: str, xds_dir: str, template: str, attempts: int = 0):
+        #--- queue an XDS job; returns False if dataset_path is already queued or submitted ---#
+        with self.lock:
+            if dataset_path in self.submitted or dataset_path in self.queued:
+                return False
+            self.queued.add(dataset_path)
+            self.pending.append((dataset_path, xds_dir, template, attempts))
+            log.info(f"Queued XDS job: {template} -> {xds_dir}")
+
+            if len(self.pending) < self.batch_size and self.batch_seconds > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.batch_seconds, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return True
+
+        self.flush()
+        return True
+
+    def script(self, batch: list):
+        #--- remote shell script submitting the jobs of batch, one marker line per job ---#
+        lines = ["#!/bin/bash"]
+        for i, (_dataset_path, xds_dir, template, _attempts) in enumerate(batch):
+            # set -e は || の左側では効かないので && でつなぐ
+            frame_dir = shlex.quote(os.path.dirname(template))
+            lines += [
+                "(",
+                f"  mkdir -p {shlex.quote(xds_dir)} &&",
+                f"  cd {shlex.quote(xds_dir)} &&",
+                "  cat > xds.sh <<'EOF_XDS_JOB' &&",
+                self.job_script.rstrip("\n"),
+                "EOF_XDS_JOB",
+            ]
+            lines += [f"  {command} {frame_dir} >> restore.log 2>&1 &&" for command in self.restore_commands]
+            lines += [
+                f"  {self.generate_command} {shlex.quote(template)} > generate_XDS.INP.log 2>&1 &&",
+                f"  job=$({shlex.quote(self.qsub)} xds.sh 2>&1) &&",
+                f"  echo \"XDS_SUBMITTED {i} ${{job//$'\\n'/ }}\"",
+                f") || echo \"XDS_FAILED {i} exit status $?\"",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        #--- submit the queued jobs in one ssh round trip ---#
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            batch = self.pending[:self.batch_size]
+            self.pending = self.pending[self.batch_size:]
+            if self.pending and self.timer is None:
+                self.timer = threading.Timer(0, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if not batch:
+            return
+
+        log.info(f"Submitting {len(batch)} XDS jobs via {self.host}")
+        started = time.monotonic()
+        with self.ssh_lock:
+            try:
+                proc = sp.run(self.ssh_args() + ["bash", "-s"], input=self.script(batch),
+                              stdout=sp.PIPE, stderr=sp.STDOUT, text=True, timeout=self.timeout)
+                returncode, stdout = proc.returncode, proc.stdout
+            except (OSError, sp.TimeoutExpired) as e:
+                returncode, stdout = 255, str(e)
+        log.info(f"ssh finished with returncode {returncode} in {time.monotonic() - started:.1f}s")
+
+        results = {}
+        for line in stdout.splitlines():
+            parts = line.split(" ", 2)
+            if len(parts) >= 2 and parts[0] in ("XDS_SUBMITTED", "XDS_FAILED") and parts[1].isdigit():
+                results[int(parts[1])] = (parts[0] == "XDS_SUBMITTED", parts[2] if len(parts) > 2 else "")
+
+        retry = []
+        with self.lock:
+            for i, entry in enumerate(batch):
+                dataset_path = entry[0]
+                self.queued.discard(dataset_path)
+                if i in results:
+                    ok, output = results[i]
+                elif entry[3] + 1 < self.retries:
+                    # 接続の失敗等でジョブが実行されなかった場合は次のバッチで再送する
+                    log.warning(f"XDS job of {dataset_path} was not run (returncode {returncode}). Retrying.")
+                    retry.append(entry)
+                    continue
+                else:
+                    ok, output = False, stdout.strip()
+                if ok:
+                    self.submitted.add(dataset_path)
+                    log.info(f"Submitted XDS job of {dataset_path}: {output}")
+                else:
+                    log.error(f"Failed to submit XDS job of {dataset_path}: {output}")
+                if self.on_result is not None:
+                    self.on_result(dataset_path, ok, output)
+            self.save()
+
+        for dataset_path, xds_dir, template, attempts in retry:
+            self.add(dataset_path, xds_dir, template, attempts + 1)
+
+    def flush_all(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+            self.flush()
+
+    def close(self):
+        #--- submit the queued jobs and stop the ssh master connection ---#
+        self.flush_all()
+        sp.run([self.ssh_command, "-o", f"ControlPath={self.control_path}", "-O", "exit", self.host],
+               stdout=sp.DEVNULL, stderr=sp.DEVNULL, timeout=self.timeout, check=False)
+
+#--- XdsDispatcher ---#
+
+
+# added LeaseManager 2026-10-17
+class LeaseManager:
+    """
+    Leases on monitors, for sharding them across worker processes or hosts.
+
+    The lease of a monitor is the file <lease_dir>/<name>.lease (lease_dir is
+    on a filesystem shared by the workers) holding the owner and the expiry
+    time. A missing lease is taken with O_EXCL, so only one of two workers
+    creating it at the same time gets it. An expired lease is overwritten;
+    since the last writer wins in that case, the lease is read back after
+    settle seconds to check who got it. The owner renews its leases well
+    before they expire, and a worker that finds another owner in its lease
+    stops the monitor.
+    """
+    def __init__(self, lease_dir: str, owner: str = None, ttl: float = 60, settle: float = 0.5):
+        self.lease_dir = lease_dir
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.settle = settle
+        self.held = set()
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def lease_file(self, name: str):
+        return os.path.join(self.lease_dir, f"{name}.lease")
+
+    def read(self, name: str):
+        try:
+            with open(self.lease_file(name)) as fin:
+                return json.load(fin)
+        except (OSError, ValueError):
+            return None
+
+    def lease_data(self):
+        return json.dumps({"owner": self.owner, "expires": time.time() + self.ttl})
+
+    def write(self, name: str):
+        tmp_file = f"{self.lease_file(name)}.{self.owner.replace('/', '_')}.tmp"
+        with open(tmp_file, "w") as fout:
+            fout.write(self.lease_data())
+        os.replace(tmp_file, self.lease_file(name))
+
+    def acquire(self, name: str):
+        #--- True if this worker holds the lease of name (taking it if free or expired) ---#
+        lease = self.read(name)
+        if lease is not None and lease.get("owner") != self.owner and lease.get("expires", 0) > time.time():
+            return False
+
+        try:
+            if lease is None:
+                fd = os.open(self.lease_file(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                with os.fdopen(fd, "w") as fout:
+                    fout.write(self.lease_data())
+            else:
+                self.write(name)
+        except FileExistsError:
+            return False
+        except OSError as e:
+            log.error(f"Failed to write lease of {name}: {e}")
+            return False
+
+        # 期限切れの lease を同時に取った場合は最後に書いた方が持ち主になるので, 読み直して確認する
+        time.sleep(self.settle)
+        lease = self.read(name)
+        if lease is None or lease.get("owner") != self.owner:
+            return False
+        self.held.add(name)
+        log.info(f"Acquired lease of monitor {name} ({self.owner})")
+        return True
+
+    def renew(self, name: str):
+        #--- extend the lease of name; False if it has been taken over by another worker ---#
+        lease = self.read(name)
+        if lease is None or lease.get("owner") != self.owner:
+            self.held.discard(name)
+            log.warning(f"Lost lease of monitor {name} (now: {lease.get('owner') if lease else None})")
+            return False
+        try:
+            self.write(name)
+        except OSError as e:
+            # 書けなくても期限までは持ち主のまま
+            log.error(f"Failed to renew lease of {name}: {e}")
+        return True
+
+    def release(self, name: str):
+        lease = self.read(name)
+        self.held.discard(name)
+        if lease is not None and lease.get("owner") == self.owner:
+            try:
+                os.remove(self.lease_file(name))
+            except OSError as e:
+                log.error(f"Failed to release lease of {name}: {e}")
+
+    def release_all(self):
+        for name in list(self.held):
+            self.release(name)
+
+#--- LeaseManager ---#
+
 
 class AutoTransferAndProcess:
-    def __init__(self, cfg):
+    def __init__(self, cfg, shared=None, name: str = None):
 
         # bss_dataset_path: /system/data_transfer/monitor.txt
         # データが測定されると更新されるBSS出力ファイルのパス
@@ -44,6 +2567,21 @@ class AutoTransferAndProcess:
         # destination_path_via_aoba: /mnt/lustre/S3/a01768/mxdata/mxdata
         # Kamoが参照するデータセットパスファイルを書き込む先のローカルディレクトリのパス
         self.destination_path_via_aoba = cfg["destination_path_via_aoba"]
+
+        # data_root: ビームラインのデータのルート (/data). この下のパスを S3 / AOBA 側のパスに対応させる
+        # ベンチマーク (bench_transfer.py) では一時ディレクトリを指定する
+        self.data_root = cfg.get("data_root", "/data").rstrip("/")
+
+        # name / weight / priority: 複数のモニターファイルを 1 つのデーモンで監視する場合 (monitors) のモニターごとの設定
+        # weight: 同じ優先度のデータセットの中での転送の割合, priority: 値が小さいモニターのデータセットを先に転送する
+        # shared: 先に作成したモニターのインスタンス. アップローダー・並列数の制御・スケジューラー・metrics を共有する
+        self.name = name
+        self.weight = cfg.get("weight", 1)
+        self.monitor_priority = cfg.get("priority", 0)
+        self.shared = shared
+        self.metric_labels = {"monitor": name} if name else {}
+        # stop_event: セットされると proc() のループを抜ける（lease を失ったモニター等）
+        self.stop_event = threading.Event()
     
         # monitoring mode: all or new_only
         # You can choose monitoring mode: all or new_only
@@ -65,16 +2603,486 @@ class AutoTransferAndProcess:
         # 並列転送のスレッド数
         self.num_threads = cfg["num_threads"]
 
+        # upload backend: s3cmd or boto3
+        # s3cmd: s3cmd sync --dry-run | xargs s3cmd put（従来の動作）
+        # boto3: プロセス内のアップローダーでコネクションを使い回して並列転送
+        self.upload_backend = cfg.get("upload_backend", "s3cmd")
+
+        # multipart: multipart_threshold_mb 以上のファイル (HDF5 の data ファイル等) は
+        # multipart_chunk_mb ごとの part に分けて並列に転送し, part ごとに再送する
+        # s3cmd の場合は --multipart-chunk-size-mb のみ指定（part は s3cmd が順に送る）
+        threshold_mb = cfg.get("multipart_threshold_mb")
+        self.multipart_threshold = int(threshold_mb * 1024 * 1024) if threshold_mb else None
+        self.multipart_chunksize = int(cfg.get("multipart_chunk_mb", 64) * 1024 * 1024)
+        self.s3cmd_put_options = "--no-check-md5"
+        if self.multipart_threshold:
+            self.s3cmd_put_options += f" --multipart-chunk-size-mb={self.multipart_chunksize // (1024 * 1024)}"
+
+        # compression: zstd / lz4 / gzip を指定すると CBF フレームを圧縮して転送する（upload_backend: boto3 のみ）
+        # S3 上は <フレーム名>.cbf.zst 等になる. AOBA 側では `python transfer_auto.py --decompress <dir>` で復元する
+        # （Kamo への登録と XDS のジョブの前に restore_command で自動的に復元する）
+        # checksum: アップロード時に 1 回の読み込みでチェックサム (xxh3 / blake3 / blake2b) を計算し
+        # オブジェクトのメタデータ (content-hash) に保存する（upload_backend: boto3 のみ）
+        # checksum_db: (inode, mtime, size) ごとにチェックサムを記録し, 同じ内容のオブジェクトは S3 内でコピーする
+        # `python transfer_auto.py --verify <dataset_path>` でダウンロードせずに照合する
+        self.checksum_algorithm = None
+        self.checksum_cache = None
+        if shared is not None:
+            self.checksum_algorithm = shared.checksum_algorithm
+            self.checksum_cache = shared.checksum_cache
+        elif cfg.get("checksum", False):
+            algorithm = cfg.get("checksum_algorithm", "auto")
+            self.checksum_algorithm = default_checksum_algorithm() if algorithm == "auto" else algorithm
+            if cfg.get("checksum_db"):
+                self.checksum_cache = ChecksumCache(cfg["checksum_db"])
+
+        # adaptive_concurrency: 並列数を num_threads から始めて, スループット・レイテンシ・エラー/スロットリングの
+        # 割合を見ながら adaptive_min_threads〜adaptive_max_threads の範囲で自動調整する (AIMD)
+        # bandwidth_limit_mb: 転送全体の帯域の上限 (MB/s, null は無制限). ビームラインの回線を使い切らないようにする
+        # monitors を使う場合は全モニターで 1 つのアップローダー（コネクションプール）と並列数・帯域の上限を共有する
+        if shared is not None:
+            self.num_threads = shared.num_threads
+            self.concurrency = shared.concurrency
+            self.max_threads = shared.max_threads
+            self.uploader = shared.uploader
+        else:
+            self.concurrency = self.setup_concurrency(cfg)
+            self.max_threads = self.concurrency.max_workers if self.concurrency is not None else self.num_threads
+            self.uploader = self.setup_uploader(cfg)
+        self.check_compression(cfg)
+
+        # bundle mode: data ディレクトリの CBF フレームを tar (bundle_max_mb / bundle_max_frames ごと) にまとめて転送する
+        # <データセット>/_bundle/ に bundle_XXXX.tar と各フレームの位置を記録した index.json を置く
+        # bundle_spool_dir: 転送前の tar を作る作業ディレクトリ
+        # AOBA 側にはフレームのファイルが無いので, restore_command (--unbundle) でフレームを展開してから Kamo に登録し,
+        # XDS のジョブも展開してから実行する
+        self.bundle_mode = cfg.get("bundle_mode", False)
+        self.bundle_writer = None
+        if self.bundle_mode:
+            spool_dir = cfg.get("bundle_spool_dir") or tempfile.gettempdir()
+            os.makedirs(spool_dir, exist_ok=True)
+            self.bundle_writer = FrameBundleWriter(
+                spool_dir,
+                max_bytes=int(cfg.get("bundle_max_mb", 512) * 1024 * 1024),
+                max_frames=cfg.get("bundle_max_frames", 1000),
+            )
+
+        # streaming mode: 測定中のデータセット (dataset_paths_for_kamo.txt の最新の data) のフレームを、書き込みが完了した順に転送する
+        # それ以外のデータセットは通常どおり scheduler で転送する
+        # stream_stable_seconds: この秒数サイズと mtime が変わらなければ書き込み完了とみなす
+        # stream_idle_timeout: この秒数新しいフレームが来なければ total 未満でも終了する
+        self.streaming_mode = cfg.get("streaming_mode", False)
+        self.stream_stable_seconds = cfg.get("stream_stable_seconds", 2.0)
+        self.stream_poll_interval = cfg.get("stream_poll_interval", 1.0)
+        self.stream_idle_timeout = cfg.get("stream_idle_timeout", 600)
+        # hdf5_images_per_file: HDF5 の data ファイル (<prefix>_data_NNNNNN.h5) 1 つあたりのフレーム数
+        # HDF5 のデータセットは master ファイルとこの数から求めたフレーム数が total に達したら終了する
+        self.hdf5_images_per_file = cfg.get("hdf5_images_per_file", 100)
+        # dataset_path -> streaming thread (finished datasets are kept so that they are not streamed twice)
+        self.streamers = {}
+
+        # engine: thread or asyncio
+        # thread: proc() のループで順に処理（従来の動作）
+        # asyncio: 監視・転送・kamo への登録・転送後の処理 (XDS 等) を asyncio のタスクとして並行して実行し,
+        #          SIGTERM で実行中の転送を shutdown_timeout 秒待ってから終了する
+        # dataset_timeout: 1 データセットの転送の制限時間（超えたら s3cmd を止めて in_progress のまま残す, null は無制限）
+        # hook_timeout: 転送後の処理の制限時間, command_timeout: dataset_paths_for_kamo.txt のアップロードの制限時間
+        self.engine = cfg.get("engine", "thread")
+        self.dataset_timeout = cfg.get("dataset_timeout")
+        self.hook_timeout = cfg.get("hook_timeout")
+        self.shutdown_timeout = cfg.get("shutdown_timeout", 60)
+        self.command_timeout = cfg.get("command_timeout")
+
+        # scheduler: 複数のデータセットを同時に転送する（max_parallel_datasets: 1 の場合は従来通り逐次処理）
+        # max_parallel_datasets: 同時に転送する data ディレクトリの数
+        # max_parallel_other: scan/check 等の転送用の別枠（data の転送の後ろに並ばない）
+        # threads_per_dataset: 1 データセットあたりの並列数の上限（全体では num_threads まで）
+        self.max_parallel_datasets = cfg.get("max_parallel_datasets", 1)
+        self.max_parallel_other = cfg.get("max_parallel_other", 1)
+        self.threads_per_dataset = cfg.get("threads_per_dataset", self.num_threads)
+        self.scheduler = shared.scheduler if shared is not None else self.setup_scheduler(cfg)
+
+        # post_transfer: data ディレクトリの転送が確認できた時に呼ばれる（asyncio engine ではキューに入れて別タスクで実行）
+        # post_transfer_hooks: hook(dataset_path, total, output_path_by_bss) のリスト
+        self.post_transfer_hooks = []
+        self.post_transfer = self.run_post_transfer_hooks
+
+        # restore_command: AOBA 側の transfer_auto.py の実行コマンド (例: python3 /path/to/transfer_auto.py)
+        # bundle_mode / compression の場合は AOBA 側にフレームのファイルがそのまま無いので, 転送が確認できた
+        # auto の data ディレクトリを restore_ssh_host で ssh して 1 回だけ復元 (--unbundle / --decompress) してから Kamo に登録する
+        # restore_timeout: 1 回の復元の制限時間（秒）
+        self.restore_flags = []
+        if self.bundle_writer is not None:
+            self.restore_flags.append("--unbundle")
+        if self.uploader is not None and self.uploader.compression:
+            self.restore_flags.append("--decompress")
+        self.restore_command = cfg.get("restore_command")
+        self.restore_ssh_host = cfg.get("restore_ssh_host", "sfront")
+        self.restore_ssh_command = cfg.get("restore_ssh_command", "ssh")
+        self.restore_timeout = cfg.get("restore_timeout") or 600
+        # dataset_path of the directories already restored on AOBA
+        self.restored = set()
+        if self.restore_flags:
+            if self.restore_command:
+                self.post_transfer_hooks.append(self.register_restored_kamo)
+            else:
+                log.warning(f"{' '.join(self.restore_flags)} on AOBA needs restore_command "
+                            f"(e.g. 'python3 /path/to/transfer_auto.py'). Data directories are not registered to Kamo.")
+
+        # xds_dispatch: 転送が確認できた data ディレクトリの XDS のジョブを AOBA-S に投入する（xds_auto.sh の代わり）
+        # auto: auto 測定のみ, all: visit 測定も含む, null: 投入しない
+        # ssh は ControlMaster で 1 本の接続を使い回し, xds_batch_seconds の間に来たジョブを 1 回の ssh でまとめて投入する
+        self.xds_dispatch = cfg.get("xds_dispatch")
+        self.dispatcher = self.setup_dispatcher(cfg)
+
+        # kamo_coalesce_seconds: この秒数の間に追加された dataset_paths_for_kamo.txt のエントリを
+        # まとめて 1 回で書き込み・アップロードする（0 の場合は従来通り 1 件ずつ）
+        self.kamo_writer = KamoFileWriter(
+            self.upload_kamo_file,
+            coalesce_seconds=cfg.get("kamo_coalesce_seconds", 0),
+            on_flushed=self.kamo_registered,
+        )
+
+        # manifest_db: アップロード済みファイル (path, size, mtime) を記録する SQLite ファイル
+        # 記録があるディレクトリは S3 側の一覧取得 (s3cmd sync --dry-run) を行わずローカルの stat のみで差分を求める
+        # manifest_remote_check: true にすると毎回 S3 側の一覧と比較する（必要な時だけ使用）
+        self.manifest = None
+        self.manifest_remote_check = cfg.get("manifest_remote_check", False)
+        if cfg.get("manifest_db"):
+            self.manifest = TransferManifest(cfg["manifest_db"])
+
+        # metrics: 転送量・スループット・キュー長・処理時間などを集計する
+        # metrics_port: Prometheus 形式で http://127.0.0.1:<port>/metrics に公開（null の場合は公開しない）
+        # metrics_snapshot_file: metrics_snapshot_interval 秒ごとに JSON で書き出す
+        # monitors を使う場合は 1 つの metrics を共有し, モニターごとの gauge には monitor ラベルを付ける
+        self.metrics = shared.metrics if shared is not None else TransferMetrics()
+        self.metrics.register_gauge("transfer_queue_depth",
+                                    lambda: self.scheduler.queue_depth() if self.scheduler is not None else 0)
+        self.metrics.register_gauge("transfer_concurrency_limit",
+                                    lambda: self.upload_threads())
+        self.metrics.register_gauge("transfer_active_streams",
+                                    lambda: sum(1 for t in self.streamers.values() if t.is_alive()),
+                                    **self.metric_labels)
+        # dataset_path -> BSS の行を最初に検出した時刻
+        self.first_seen = {}
+        self.metrics_snapshot_file = cfg.get("metrics_snapshot_file")
+        if shared is None:
+            if cfg.get("metrics_port"):
+                try:
+                    self.metrics.serve(cfg["metrics_port"], cfg.get("metrics_host", "127.0.0.1"))
+                except OSError as e:
+                    log.error(f"Failed to start metrics endpoint on port {cfg['metrics_port']}: {e}")
+            if self.metrics_snapshot_file:
+                self.metrics.write_snapshots(self.metrics_snapshot_file, cfg.get("metrics_snapshot_interval", 60))
+
+        # watch mode: poll, inotify or auto
+        # poll: wait_time 秒ごとにファイルを確認（従来の動作）
+        # inotify: ファイルへの書き込みを inotify で検知して即座に処理（wait_time はタイムアウトとして使用）
+        # auto: ローカルFSなら inotify, Lustre/NFS 等なら poll
+        self.watch_mode = cfg.get("watch_mode", "poll")
+        self.watcher = self.setup_watcher()
+
+        # tail read: monitor.txt と .dataset_paths_for_kamo.txt の追記分のみを読む
+        # 読み込み位置 (inode, byte offset) は offset_state_file に保存され、再起動後も引き継がれる
+        self.tail_reader = None
+        self.monitor_lines = []
+        if cfg.get("tail_read", False):
+            self.tail_reader = TailReader(cfg.get("offset_state_file", ".transfer_offsets.json"))
+
+        # retry_db: 転送に失敗したファイルをファイル単位で記録する SQLite ファイル
+        # 失敗したファイルのみを指数バックオフ（retry_base_delay 秒から 2 倍ずつ, 最大 retry_max_delay 秒, ジッター付き）で再送する
+        # retry_max_attempts 回失敗したファイルは failed として残し, 自動では再送しない
+        self.retry_queue = None
+        if cfg.get("retry_db"):
+            self.retry_queue = RetryQueue(
+                cfg["retry_db"],
+                base_delay=cfg.get("retry_base_delay", 10),
+                max_delay=cfg.get("retry_max_delay", 600),
+                max_attempts=cfg.get("retry_max_attempts", 10),
+            )
+            self.metrics.register_gauge("transfer_retry_queue_depth",
+                                        lambda: self.retry_queue.counts().get("pending", 0),
+                                        **self.metric_labels)
+        # 転送中のデータセット（スレッドごと, 失敗したファイルの記録に使う）
+        self.context = threading.local()
+
+        # state_db: データセットごとの転送状態 (pending / in_progress / uploaded / kamo_registered) を記録する SQLite ファイル
+        # 再起動時には転送済みのデータセットを読み込み, 中断されたデータセットの転送を再開する
+        self.state_store = None
+        if cfg.get("state_db"):
+            self.state_store = DatasetStateStore(cfg["state_db"])
+
         # To keep track of already processed file paths
-        # 既に処理済みのファイルパスを追跡するためのセット
+        # 既に処理済みのファイルパスを追跡するためのセット（state_db があればそこから復元）
         self.processed_files = set()
+        if self.state_store is not None:
+            self.processed_files = self.state_store.processed()
+            log.info(f"Loaded {len(self.processed_files)} processed datasets from {cfg['state_db']}")
 
     #--- __init__ ---#
 
+    # added setup_uploader 2026-10-17
+    def setup_uploader(self, cfg):
+        #--- create in-process uploader for upload_backend: boto3 ---#
+        if self.upload_backend != "boto3":
+            return None
+
+        try:
+            uploader = S3Uploader(
+                self.max_threads,
+                endpoint_url=cfg.get("s3_endpoint_url"),
+                profile=cfg.get("s3_profile"),
+                multipart_threshold=self.multipart_threshold,
+                multipart_chunksize=self.multipart_chunksize,
+                multipart_threads=cfg.get("multipart_threads", 4),
+                part_retries=cfg.get("multipart_part_retries", 3),
+                compression=cfg.get("compression"),
+                compression_level=cfg.get("compression_level", 3),
+                compression_processes=cfg.get("compression_processes", 2),
+                checksum_algorithm=self.checksum_algorithm,
+                checksum_cache=self.checksum_cache,
+                concurrency=self.concurrency,
+            )
+        except Exception as e:
+            log.error(f"Failed to set up boto3 uploader ({e}). Falling back to s3cmd.")
+            return None
+
+        log.info(f"Upload backend: boto3 ({self.max_threads} workers, compression: {cfg.get('compression')})")
+        return uploader
+
+    #--- setup_uploader ---#
+
+    # added setup_dispatcher 2026-10-17
+    def setup_dispatcher(self, cfg):
+        #--- create the XDS job dispatcher for xds_dispatch: auto / all ---#
+        if not self.xds_dispatch:
+            return None
+
+        # AOBA 側にフレームがそのまま無い場合は, ジョブの中で展開してから generate_XDS.INP を実行する
+        if self.restore_flags and not self.restore_command:
+            log.error(f"XDS dispatch needs restore_command (e.g. 'python3 /path/to/transfer_auto.py') "
+                      f"to run {' '.join(self.restore_flags)} on AOBA before XDS. XDS dispatch is disabled.")
+            return None
+
+        dispatcher = XdsDispatcher(
+            host=cfg.get("xds_ssh_host", "sfront"),
+            ssh_command=cfg.get("xds_ssh_command", "ssh"),
+            control_path=cfg.get("xds_ssh_control_path"),
+            control_persist=cfg.get("xds_ssh_control_persist", 600),
+            qsub=cfg.get("xds_qsub", "/opt/nec/nqsv/bin/qsub"),
+            generate_command=cfg.get("xds_generate_command", "generate_XDS.INP"),
+            job_script=cfg.get("xds_job_script") or XDS_JOB_SCRIPT,
+            batch_size=cfg.get("xds_batch_size", 8),
+            batch_seconds=cfg.get("xds_batch_seconds", 5.0),
+            retries=cfg.get("xds_retries", 3),
+            timeout=cfg.get("xds_timeout", 120),
+            state_file=cfg.get("xds_state_file", ".xds_submitted.json"),
+            on_result=self.xds_dispatched,
+            restore_commands=[f"{self.restore_command} {flag}" for flag in self.restore_flags],
+        )
+        self.post_transfer_hooks.append(self.dispatch_xds)
+        log.info(f"XDS dispatch: {self.xds_dispatch} measurements via {dispatcher.host}")
+        return dispatcher
+
+    #--- setup_dispatcher ---#
+
+    # added setup_concurrency 2026-10-17
+    def setup_concurrency(self, cfg):
+        #--- create the AIMD concurrency controller for adaptive_concurrency: true ---#
+        bandwidth_limit_mb = cfg.get("bandwidth_limit_mb")
+        if not cfg.get("adaptive_concurrency", False) and not bandwidth_limit_mb:
+            return None
+
+        adaptive = cfg.get("adaptive_concurrency", False)
+        min_threads = cfg.get("adaptive_min_threads", 1) if adaptive else self.num_threads
+        max_threads = cfg.get("adaptive_max_threads", 4 * self.num_threads) if adaptive else self.num_threads
+        concurrency = AdaptiveConcurrency(
+            self.num_threads,
+            min_workers=min_threads,
+            max_workers=max_threads,
+            interval=cfg.get("adaptive_interval", 5.0),
+            bandwidth_cap=bandwidth_limit_mb * 1e6 if bandwidth_limit_mb else None,
+        )
+        log.info(f"Upload concurrency: {concurrency.limit()} ({concurrency.min_workers}-{concurrency.max_workers}), "
+                 f"bandwidth limit: {bandwidth_limit_mb} MB/s")
+        return concurrency
+
+    #--- setup_concurrency ---#
+
+    # added upload_threads 2026-10-17
+    def upload_threads(self, num_threads: int = None):
+        #--- number of parallel uploads now: the granted/configured number, bounded by the adaptive limit ---#
+        if self.concurrency is None:
+            return num_threads or self.num_threads
+        return max(1, min(num_threads or self.max_threads, self.concurrency.limit()))
+
+    #--- upload_threads ---#
+
+    # added s3cmd_command_options 2026-10-17
+    def s3cmd_command_options(self, num_threads: int):
+        #--- s3cmd put options, with the bandwidth limit shared by the num_threads s3cmd processes ---#
+        if self.concurrency is None or not self.concurrency.bandwidth_cap:
+            return self.s3cmd_put_options
+        return f"{self.s3cmd_put_options} --limit-rate={max(1, int(self.concurrency.bandwidth_cap / num_threads))}"
+
+    #--- s3cmd_command_options ---#
+
+    # added record_s3cmd_batch 2026-10-17
+    def record_s3cmd_batch(self, stdout: str, nbytes: int, files: int, seconds: float, num_threads: int,
+                           returncode: int):
+        #--- report an s3cmd/xargs run to the concurrency controller ---#
+        if self.concurrency is None:
+            return
+        # s3cmd は再送時に SlowDown / 503 を出力する
+        if stdout and any(code in stdout for code in ("SlowDown", "503", "Throttl")):
+            self.concurrency.record_throttle()
+        # 1 ファイルあたりのレイテンシは並列数から概算する
+        latency = seconds * num_threads / files if files else seconds
+        self.concurrency.record(nbytes, latency, error=returncode != 0, files=max(files, 1))
+
+    #--- record_s3cmd_batch ---#
+
+    # added check_compression 2026-10-17
+    def check_compression(self, cfg):
+        #--- compression is done by the in-process uploader only ---#
+        if cfg.get("compression") and self.uploader is None:
+            log.warning(f"compression: {cfg['compression']} requires upload_backend: boto3. "
+                        "Frames are uploaded uncompressed.")
+
+    #--- check_compression ---#
+
+    # added verify_dataset 2026-10-17
+    def verify_dataset(self, dataset_path: str):
+        #--- compare the checksums of the transferred files of dataset_path with their S3 metadata ---#
+        if self.uploader is None:
+            log.error("Verification requires upload_backend: boto3.")
+            return None
+        dirname_transferred, s3_destination = self.transfer_target(dataset_path)
+        results = {}
+        for local_path, _size, _mtime in scan_local_files(dirname_transferred):
+            bucket, key = split_s3_url(remote_url_for(local_path, dirname_transferred, s3_destination))
+            try:
+                status = self.uploader.verify_file(local_path, bucket, key)
+            except Exception as e:
+                log.error(f"Failed to verify {local_path}: {e}")
+                status = "error"
+            results.setdefault(status, []).append(local_path)
+            if status != "ok":
+                log.warning(f"verify: {status}: {local_path}")
+
+        summary = {status: len(paths) for status, paths in results.items()}
+        log.info(f"Verified {dirname_transferred}: {summary}")
+        return results
+
+    #--- verify_dataset ---#
+
+    # added setup_scheduler 2026-10-17
+    def setup_scheduler(self, cfg):
+        #--- create dataset scheduler for max_parallel_datasets > 1 or monitors (engine: thread only) ---#
+        # monitors を使う場合は max_parallel_datasets: 1 でもスケジューラーでモニター間の順番を公平にする
+        if (self.max_parallel_datasets <= 1 and self.name is None) or self.engine == "asyncio":
+            return None
+
+        lanes = {"data": self.max_parallel_datasets, "other": self.max_parallel_other}
+        log.info(f"Dataset scheduler: lanes {lanes}, {self.threads_per_dataset} threads per dataset, "
+                 f"{self.max_threads} threads in total")
+        # 各レーンに 1 並列ずつ確保しておき, data の転送が全ての並列を使って scan/check が待たされないようにする
+        budget = WorkerBudget(self.max_threads, reserved={lane: 1 for lane in lanes})
+        return DatasetScheduler(lanes, budget, self.threads_per_dataset)
+
+    #--- setup_scheduler ---#
+
+    # added record_state 2026-10-17
+    def record_state(self, dataset_path: str, state: str, **kwargs):
+        #--- record the transfer state of dataset_path in state_db (if configured) ---#
+        if self.state_store is None:
+            return
+        try:
+            self.state_store.update(dataset_path, state, **kwargs)
+        except Exception as e:
+            log.error(f"Failed to record state '{state}' of {dataset_path}: {e}")
+
+    #--- record_state ---#
+
+    # added mark_processed 2026-10-17
+    def mark_processed(self, dataset_paths: list):
+        #--- mark datasets as processed (not synced again) in memory and in state_db ---#
+        self.processed_files.update(dataset_paths)
+        if self.state_store is not None:
+            self.state_store.mark_final(dataset_paths)
+
+    #--- mark_processed ---#
+
+    # added resume_interrupted 2026-10-17
+    def resume_interrupted(self, start=None):
+        #--- restart the transfers left pending/in_progress by the previous run ---#
+        # start: start(dataset_path, total, output_path_by_bss, priority) of the asyncio engine
+        if self.state_store is None:
+            return
+        for dataset_path, output_path_by_bss, total in self.state_store.interrupted():
+            if not output_path_by_bss:
+                continue
+            log.info(f"Resuming interrupted dataset: {dataset_path}")
+            if start is not None:
+                start(dataset_path, total, output_path_by_bss,
+                      self.dataset_priority(dataset_path, output_path_by_bss, False))
+            elif self.scheduler is not None:
+                priority = self.dataset_priority(dataset_path, output_path_by_bss, False)
+                lane = self.identify_data_or_other(dataset_path)
+                self.scheduler.submit(lane, dataset_path, priority, self.process_dataset,
+                                      dataset_path, total, output_path_by_bss, tenant=self.name, weight=self.weight)
+            else:
+                self.process_dataset(dataset_path, total, output_path_by_bss)
+
+    #--- resume_interrupted ---#
+
+    # added setup_watcher 2026-10-17
+    def setup_watcher(self):
+        #--- create inotify watcher according to watch_mode ---#
+        if self.watch_mode == "poll":
+            return None
+
+        if self.watch_mode == "auto":
+            watch_dir = os.path.dirname(os.path.abspath(self.bss_dataset_path))
+            if is_network_fs(watch_dir):
+                log.info(f"{watch_dir} is on a network filesystem. Falling back to polling.")
+                return None
+
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            log.warning(f"inotify is not available ({e}). Falling back to polling.")
+            return None
+
+        watcher.watch(self.bss_dataset_path)
+        log.info(f"Watch mode: inotify ({self.bss_dataset_path})")
+        return watcher
+
+    #--- setup_watcher ---#
+
+    # added wait_for_update 2026-10-17
+    def wait_for_update(self, output_path_by_bss: str = None):
+        #--- wait until monitor.txt / .dataset_paths_for_kamo.txt is updated ---#
+        # inotify が使えない場合は従来通り wait_time 秒待機する
+        if self.watcher is None:
+            self.stop_event.wait(self.wait_time)
+            return
+
+        if output_path_by_bss and os.path.isabs(output_path_by_bss):
+            self.watcher.watch(output_path_by_bss)
+
+        if self.watcher.wait(self.wait_time):
+            log.info("Update detected by inotify.")
+
+    #--- wait_for_update ---#
+
     # updated path 2025-11-26 by Akiya Fukuda
     def path(self):
         #--- load diffraction data path via BSS output file ---#
         # self.bss_dataset_path: /system/data_transfer/monitor.txt
+        if self.tail_reader is not None:
+            return self.tail_path()
+
         try:
             with open(self.bss_dataset_path, "r") as fin:
                 # output_path_by_bss:
@@ -120,6 +3128,31 @@ class AutoTransferAndProcess:
         
     #--- path ---#
 
+    # added tail_path 2026-10-17
+    def tail_path(self):
+        #--- same as path(), but reads only the lines appended to monitor.txt ---#
+        try:
+            new_lines = self.tail_reader.read_new_lines(self.bss_dataset_path)
+        except FileNotFoundError:
+            log.error(f"Dataset path not found: {self.bss_dataset_path}")
+            return None
+
+        if self.monitor_mode == "all":
+            self.monitor_lines.extend(new_lines)
+            output_path_by_bss = "\n".join(self.monitor_lines).strip()
+        else:
+            output_path_by_bss = self.tail_reader.last_line(self.bss_dataset_path)
+
+        if not output_path_by_bss:
+            log.info(f"Dataset path file is empty: {self.bss_dataset_path}")
+            return None
+
+        if new_lines:
+            log.info(f"output dataset to {output_path_by_bss}")
+        return output_path_by_bss
+
+    #--- tail_path ---#
+
     # updated identify_auto_or_visit 2025-11-21 by Akiya Fukuda
     def identify_auto_or_visit(self, 
                                output_path_by_bss: str):
@@ -131,7 +3164,7 @@ class AutoTransferAndProcess:
         /data/<Beamline ID>/.dataset_paths_for_kamo.txt (visit measurement)
         """
 
-        if "/data/mxstaff/" in output_path_by_bss:
+        if f"{self.data_root}/mxstaff/" in output_path_by_bss:
             log.info("Auto measurement detected. ---> Return auto")
             return "auto"
         else:
@@ -155,38 +3188,45 @@ class AutoTransferAndProcess:
         """
         
         try:
-            with open(output_path_by_bss, "r") as fin:
-                #lines = fin.readlines()
-                lines = [l.strip() for l in fin if l.strip()]
-
-                if not lines:
+            if self.tail_reader is not None:
+                # 前回読み込んだ位置以降の追記行のみを読む
+                target_lines = self.tail_kamo_target_lines(output_path_by_bss)
+                if not target_lines:
                     log.error(f"File is empty:{output_path_by_bss}")
                     return []
+            else:
+                with open(output_path_by_bss, "r") as fin:
+                    #lines = fin.readlines()
+                    lines = [l.strip() for l in fin if l.strip()]
 
-                target_lines = lines if self.dataset_mode == "all" else [lines[-1]]
+                    if not lines:
+                        log.error(f"File is empty:{output_path_by_bss}")
+                        return []
 
-                if not target_lines:
-                    log.error(f"The last line of the dataset path file is empty: {target_lines}")
-                    return None
+                    target_lines = lines if self.dataset_mode == "all" else [lines[-1]]
 
-                parsed_results = []
-                for line in target_lines:
-                    try:
-                        path_str, data_origin_str, total_str = line.split(",", 2)
-                        dataset_path = path_str.strip()
-                        if dataset_path.endswith(".h5"):
-                            dataset_path = dataset_path[:-3] + ".cbf"
-
-                        parsed_results.append({
-                            "path": dataset_path,
-                            "data_origin": int(data_origin_str.strip()),
-                            "total": int(total_str.strip())
-                        })
-                    except ValueError:
-                        log.warning(f"Skipping invalid line: {line}")
-                        continue
+            if not target_lines:
+                log.error(f"The last line of the dataset path file is empty: {target_lines}")
+                return None
+
+            parsed_results = []
+            for line in target_lines:
+                try:
+                    path_str, data_origin_str, total_str = line.split(",", 2)
+                    dataset_path = path_str.strip()
+                    if dataset_path.endswith(".h5"):
+                        dataset_path = dataset_path[:-3] + ".cbf"
+
+                    parsed_results.append({
+                        "path": dataset_path,
+                        "data_origin": int(data_origin_str.strip()),
+                        "total": int(total_str.strip())
+                    })
+                except ValueError:
+                    log.warning(f"Skipping invalid line: {line}")
+                    continue
 
-                return parsed_results               
+            return parsed_results               
 
         except FileNotFoundError:
             log.error(f"{output_path_by_bss} is not exist")
@@ -198,8 +3238,32 @@ class AutoTransferAndProcess:
 
     #--- load_dataset_paths_for_kamo_file ---#
 
+    # added tail_kamo_target_lines 2026-10-17
+    def tail_kamo_target_lines(self, output_path_by_bss: str):
+        """
+        Returns the lines of .dataset_paths_for_kamo.txt to be processed in this cycle,
+        reading only the lines appended since the previous cycle.
+
+        new_only: the latest line
+        all: the newly appended lines, preceded by the previous latest line
+             (the previous latest dataset gets its final sync once a new line arrives)
+        """
+        previous_last = self.tail_reader.last_line(output_path_by_bss)
+        new_lines = self.tail_reader.read_new_lines(output_path_by_bss)
+        latest = self.tail_reader.last_line(output_path_by_bss)
+
+        if self.dataset_mode != "all" or not new_lines:
+            return [latest] if latest else []
+
+        if previous_last and previous_last != new_lines[0]:
+            return [previous_last] + new_lines
+        return new_lines
+
+    #--- tail_kamo_target_lines ---#
+
 
     # updated identify_data_or_other 2025-11-21 by Akiya Fukuda
+    # updated identify_data_or_other 2026-10-17 (HDF5 の master ファイルのパスもファイルとして扱う)
     def identify_data_or_other(self, dataset_path: str):
         #--- identify data or other files ---#
         # dataset_path by self.load_dataset_paths_for_kamo() is identified as 
@@ -213,7 +3277,8 @@ class AutoTransferAndProcess:
         # <other> (e.g., scan, check etc.)
 
         # パスがファイル名（例: *.cbf）を含む場合、ディレクトリ名を取得するためにos.path.dirnameを使用
-        if os.path.isfile(dataset_path) or "*" in dataset_path:
+        # HDF5 の <prefix>_master.h5 は .cbf に置き換えられていて実在しないので拡張子で判定する
+        if os.path.isfile(dataset_path) or "*" in dataset_path or dataset_path.endswith(FRAME_SUFFIXES):
             # 例: /data/.../data01/*.cbf -> /data/.../data01
             path_to_check = os.path.dirname(dataset_path)
         else:
@@ -235,7 +3300,9 @@ class AutoTransferAndProcess:
     # updated proc 2026-01-23 by Akiya Fukuda
     ''' main process '''
     def proc(self):
-        while True:
+        # 前回の実行で中断された転送を再開
+        self.resume_interrupted()
+        while not self.stop_event.is_set():
             '''
             メインのループ処理
             1. self.path()で/system/data_transfer/monitor.txtから.dataset_paths_for_kamo.txt(=output_path_by_bss)の最新のファイルパスを取得
@@ -259,93 +3326,278 @@ class AutoTransferAndProcess:
             もし新しいデータセットが見つかれば、それをS3に転送し、Kamo用のデータセットパスファイルに追加する
             これにより、データの転送とKamo処理の準備が自動化される
             '''
+            cycle_started = time.monotonic()
             output_path_by_bss = self.path()
             if not output_path_by_bss:
                 log.info("No output_path_by_bss found yet. Waiting...")
-                time.sleep(self.wait_time)
+                self.wait_for_update()
                 continue
 
             dataset_info = self.load_dataset_paths_for_kamo_file(output_path_by_bss)
             if dataset_info is None:
                 log.error("Failed to load dataset info.")
-                time.sleep(self.wait_time)
+                self.wait_for_update(output_path_by_bss)
                 continue
 
-            # Obtain the index of the latest line
-            last_index = len(dataset_info) - 1
-
-            # enumerate関数は、リストやタプルなどのイテラブルなオブジェクトをループ処理する際に
-            # 各要素に対してインデックス（番号）を付与する
-            for i, info in enumerate(dataset_info):
-                dataset_path = info["path"]
-                total = info["total"]
-
-                if i < last_index and dataset_path in self.processed_files:
-                    log.info(f"Dataset path already processed: {dataset_path}. Skipping...")
+            for dataset_path, total, priority in self.new_datasets(output_path_by_bss, dataset_info):
+                if self.should_stream(dataset_path, dataset_info):
+                    # 測定中のデータセットはフレームごとに転送する
+                    self.start_streaming(dataset_path, total, output_path_by_bss)
                     continue
+
+                if self.scheduler is not None:
+                    # data / other ごとの枠で並列に転送する
+                    lane = self.identify_data_or_other(dataset_path)
+                    self.scheduler.submit(lane, dataset_path, priority, self.process_dataset,
+                                          dataset_path, total, output_path_by_bss,
+                                          tenant=self.name, weight=self.weight)
                 else:
-                    log.info(f"Syncing dataset: {dataset_path} (Latest: {i == last_index})")
-
-                if dataset_path not in self.processed_files:
-                    log.info(f"Processing new dataset path: {dataset_path}")
-                    if "auto" == self.identify_auto_or_visit(output_path_by_bss):
-                        log.info("Detected auto measurement.")
-
-                        if "data" == self.identify_data_or_other(dataset_path):
-                            log.info("Detected data directory. Transferring and preparing Kamo dataset file.")
-                            log.info("Starting transfer to S3 for auto measurement data directory.")
-                            self.transfer_to_s3(dataset_path)
-                            log.info("Preparing Kamo dataset file.")
-                            self.write_kamo_dataset_file(dataset_path, data_origin=1, data_total=total)
-                        elif "other" == self.identify_data_or_other(dataset_path):
-                            log.info("Non-data directory detected. Only transferring.")
-                            self.transfer_to_s3(dataset_path)
-
-                    elif "visit" == self.identify_auto_or_visit(output_path_by_bss):
-                        log.info("Detected visit measurement.")
-
-                        if "data" == self.identify_data_or_other(dataset_path):
-                            log.info("Detected data directory. Transferring and preparing Kamo dataset file.")
-                            log.info("Starting transfer to S3 for visit measurement data directory.")
-                            self.transfer_to_s3(dataset_path)
-                            #self.write_kamo_dataset_file(dataset_path, data_origin=1, data_total=total)
-                        elif "other" == self.identify_data_or_other(dataset_path):
-                            log.info("Non-data directory detected. Only transferring.")
-                            self.transfer_to_s3(dataset_path)
-            
-            if len(dataset_info) > 1:
-                for info in dataset_info[:-1]:
-                    self.processed_files.add(info["path"])
+                    self.process_dataset(dataset_path, total, output_path_by_bss)
 
+            self.retry_failed_uploads()
+            self.finish_cycle(dataset_info, cycle_started)
             log.info("Sync cycle finished. Waiting 30s...")
-            time.sleep(self.wait_time)
+            self.wait_for_update(output_path_by_bss)
 
     #--- proc ---#
 
+    # added new_datasets 2026-10-17 (split out of proc)
+    def new_datasets(self, output_path_by_bss: str, dataset_info: list):
+        #--- (dataset_path, total, priority) of the datasets to transfer in this cycle, in priority order ---#
+        # Obtain the index of the latest line
+        last_index = len(dataset_info) - 1
+
+        # enumerate関数は、リストやタプルなどのイテラブルなオブジェクトをループ処理する際に
+        # 各要素に対してインデックス（番号）を付与する
+        # 優先度順（auto の data → visit の data → scan/check 等）に並べ替える（同じ優先度ではファイルの順）
+        priorities = [self.dataset_priority(info["path"], output_path_by_bss, i == last_index)
+                      for i, info in enumerate(dataset_info)]
+        for i, info in sorted(enumerate(dataset_info), key=lambda item: priorities[item[0]]):
+            dataset_path = info["path"]
+            total = info["total"]
+
+            if i < last_index and dataset_path in self.processed_files:
+                log.info(f"Dataset path already processed: {dataset_path}. Skipping...")
+                continue
+            else:
+                log.info(f"Syncing dataset: {dataset_path} (Latest: {i == last_index})")
+
+            if dataset_path not in self.processed_files:
+                log.info(f"Processing new dataset path: {dataset_path}")
+                self.first_seen.setdefault(dataset_path, time.time())
+                self.record_state(dataset_path, "pending", output_path_by_bss=output_path_by_bss, total=total)
+                yield dataset_path, total, priorities[i]
+
+    #--- new_datasets ---#
+
+    # added finish_cycle 2026-10-17 (split out of proc)
+    def finish_cycle(self, dataset_info: list, cycle_started: float):
+        # アップロードに失敗した dataset_paths_for_kamo.txt を再送
+        if self.kamo_writer.unsynced:
+            self.kamo_writer.flush_unsynced()
+
+        if len(dataset_info) > 1:
+            self.mark_processed([info["path"] for info in dataset_info[:-1]])
+
+        # 処理が終わった位置までの読み込み位置を保存
+        if self.tail_reader is not None:
+            self.tail_reader.commit()
+
+        self.metrics.observe("transfer_cycle_seconds", time.monotonic() - cycle_started)
+
+    #--- finish_cycle ---#
+
+    # added proc_async 2026-10-17
+    def proc_async(self):
+        #--- run the daemon on the asyncio engine until SIGTERM/SIGINT ---#
+        engine = AsyncEngine(self, dataset_timeout=self.dataset_timeout, hook_timeout=self.hook_timeout,
+                             shutdown_timeout=self.shutdown_timeout)
+        engine.run()
+
+    #--- proc_async ---#
+
+    # added shutdown 2026-10-17
+    def shutdown(self):
+        #--- flush the pending kamo entries and read offsets, and close the pools and databases ---#
+        self.kamo_writer.flush_all()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        if self.tail_reader is not None:
+            self.tail_reader.commit()
+        if self.watcher is not None:
+            self.watcher.close()
+        # 共有しているアップローダー等は最初に作成したモニター (shared が None) が閉じる
+        owner = self.shared is None
+        if owner and self.uploader is not None:
+            self.uploader.close()
+        if owner and self.metrics_snapshot_file:
+            self.metrics.write_snapshot(self.metrics_snapshot_file)
+        for store in (self.state_store, self.manifest, self.checksum_cache if owner else None, self.retry_queue):
+            if store is not None:
+                store.close()
+
+    #--- shutdown ---#
+
+    # added dataset_priority 2026-10-17
+    def dataset_priority(self, dataset_path: str, output_path_by_bss: str, is_latest: bool):
+        #--- transfer priority of a dataset (smaller is transferred first) ---#
+        # DATASET_PRIORITIES の順位を 2 倍し, 同じ順位の中では最新行のデータセットを先にする
+        # モニターの priority が小さいほど先（その中で DATASET_PRIORITIES の順）
+        key = (self.identify_auto_or_visit(output_path_by_bss), self.identify_data_or_other(dataset_path))
+        rank = 2 * DATASET_PRIORITIES.get(key, max(DATASET_PRIORITIES.values())) + (0 if is_latest else 1)
+        return self.monitor_priority * 2 * (max(DATASET_PRIORITIES.values()) + 1) + rank
+
+    #--- dataset_priority ---#
+
+    # added process_dataset 2026-10-17 (split out of proc)
+    def process_dataset(self, dataset_path: str, total: int, output_path_by_bss: str,
+                        num_threads: int = None, preempt: threading.Event = None):
+        #--- transfer one dataset and prepare the Kamo dataset file (run directly or by the scheduler) ---#
+        # preempt がセットされると transfer_to_s3() が TransferPreempted を送出し, Kamo への登録は行わない
+        # 戻り値: 転送が確認できた場合 True（data ディレクトリの場合は post_transfer を呼ぶ）
+        uploaded = False
+        if self.stop_event.is_set():
+            # lease を失ったモニターのキューに残っていたデータセットは転送しない（state_db では pending のまま）
+            log.info(f"Monitor {self.name} is stopped. Skipping queued dataset: {dataset_path}")
+            return uploaded
+        self.record_state(dataset_path, "in_progress", output_path_by_bss=output_path_by_bss, total=total)
+        if "auto" == self.identify_auto_or_visit(output_path_by_bss):
+            log.info("Detected auto measurement.")
+
+            if "data" == self.identify_data_or_other(dataset_path):
+                log.info("Detected data directory. Transferring and preparing Kamo dataset file.")
+                log.info("Starting transfer to S3 for auto measurement data directory.")
+                uploaded = self.transfer_to_s3(dataset_path, num_threads, preempt)
+                self.record_transfer_result(dataset_path, uploaded)
+                log.info("Preparing Kamo dataset file.")
+                self.write_kamo_dataset_file(dataset_path, data_origin=1, data_total=total)
+            elif "other" == self.identify_data_or_other(dataset_path):
+                log.info("Non-data directory detected. Only transferring.")
+                uploaded = self.transfer_to_s3(dataset_path, num_threads, preempt)
+                self.record_transfer_result(dataset_path, uploaded)
+
+        elif "visit" == self.identify_auto_or_visit(output_path_by_bss):
+            log.info("Detected visit measurement.")
+
+            if "data" == self.identify_data_or_other(dataset_path):
+                log.info("Detected data directory. Transferring and preparing Kamo dataset file.")
+                log.info("Starting transfer to S3 for visit measurement data directory.")
+                uploaded = self.transfer_to_s3(dataset_path, num_threads, preempt)
+                self.record_transfer_result(dataset_path, uploaded)
+                #self.write_kamo_dataset_file(dataset_path, data_origin=1, data_total=total)
+            elif "other" == self.identify_data_or_other(dataset_path):
+                log.info("Non-data directory detected. Only transferring.")
+                uploaded = self.transfer_to_s3(dataset_path, num_threads, preempt)
+                self.record_transfer_result(dataset_path, uploaded)
+
+        if uploaded and "data" == self.identify_data_or_other(dataset_path):
+            self.post_transfer(dataset_path, total, output_path_by_bss)
+        return uploaded
+
+    #--- process_dataset ---#
+
+    # added run_post_transfer_hooks 2026-10-17
+    def run_post_transfer_hooks(self, dataset_path: str, total: int, output_path_by_bss: str):
+        #--- run the post-transfer hooks (e.g. XDS submission) of an uploaded data directory ---#
+        for hook in self.post_transfer_hooks:
+            try:
+                hook(dataset_path, total, output_path_by_bss)
+            except Exception as e:
+                log.error(f"Post-transfer hook {getattr(hook, '__name__', hook)} failed for {dataset_path}: {e}")
+
+    #--- run_post_transfer_hooks ---#
+
+    # added dispatch_xds 2026-10-17
+    def dispatch_xds(self, dataset_path: str, total: int, output_path_by_bss: str):
+        #--- queue the XDS job of a data directory once all its frames are uploaded ---#
+        if self.xds_dispatch != "all" and "auto" != self.identify_auto_or_visit(output_path_by_bss or ""):
+            return
+        frame_dir = self.dataset_directory(dataset_path)
+        name = os.path.basename(dataset_path)
+        frames = self.list_frames(dataset_path)
+        if name.endswith("_master.cbf"):
+            # HDF5: <prefix>_master.h5 は .cbf に置き換えられているので戻して master ファイルをテンプレートにし,
+            # フレーム数は <prefix>_data_NNNNNN.h5 から求める (count_streamed_frames)
+            prefix = name[:-len("_master.cbf")]
+            name = f"{prefix}_master.h5"
+            frames = [f for f in frames if f.endswith(".h5") and os.path.basename(f).startswith(f"{prefix}_")]
+        else:
+            if not ("*" in name or "?" in name or name.endswith(".cbf")):
+                name = f"{os.path.basename(frame_dir)}_00????.cbf"
+            # 同じディレクトリに複数のデータセットがある場合に XDS の結果が重ならないように, テンプレートごとに分ける
+            prefix = re.split(r"[?*]", name, maxsplit=1)[0].rstrip("_.") or "XDS"
+            frames = [f for f in frames if f.endswith(".cbf")]
+        n_frames = self.count_streamed_frames(set(frames), total)
+        if total and n_frames < total:
+            # 測定中のデータセットは全てのフレームが転送されてから投入する
+            log.info(f"{n_frames}/{total} frames of {dataset_path}. XDS job is submitted later.")
+            return
+
+        # AOBA 側のパス (/data 以下を destination_path_via_aoba に置き換え) と XDS の作業ディレクトリ
+        aoba_dir = os.path.join(self.destination_path_via_aoba, os.path.relpath(frame_dir, self.data_root))
+        xds_dir = os.path.join(aoba_dir, "XDS", prefix)
+        self.dispatcher.add(dataset_path, xds_dir, os.path.join(aoba_dir, name))
+
+    #--- dispatch_xds ---#
+
+    # added xds_dispatched 2026-10-17
+    def xds_dispatched(self, dataset_path: str, ok: bool, output: str):
+        #--- called for each XDS job after its ssh round trip ---#
+        self.metrics.inc("xds_jobs_total", result="submitted" if ok else "failed")
+        if ok and dataset_path in self.first_seen:
+            self.metrics.observe("transfer_detect_to_xds_seconds", time.time() - self.first_seen[dataset_path])
+
+    #--- xds_dispatched ---#
+
+    # added record_transfer_result 2026-10-17
+    def record_transfer_result(self, dataset_path: str, uploaded: bool):
+        #--- record uploaded (with file and byte counts of the dataset directory) after a complete sync ---#
+        nbytes, seconds = self.metrics.end_dataset()
+        if nbytes:
+            log.info(f"Uploaded {nbytes} bytes of {dataset_path} in {seconds:.1f}s "
+                     f"({nbytes / max(seconds, 1e-6) / 1e6:.1f} MB/s)")
+        if uploaded and dataset_path in self.first_seen:
+            self.metrics.observe("transfer_detect_to_upload_seconds", time.time() - self.first_seen[dataset_path])
+
+        if self.state_store is None:
+            return
+        if not uploaded:
+            # in_progress のまま残し, 次回の起動時に再開する
+            log.warning(f"Transfer of {dataset_path} is incomplete. Keeping it in_progress.")
+            return
+        files = scan_local_files(self.dataset_directory(dataset_path))
+        self.record_state(dataset_path, "uploaded", files=len(files), nbytes=sum(f[1] for f in files))
+
+    #--- record_transfer_result ---#
+
     #--- updated transfer_to_s3 2025-12-16 by Akiya Fukuda ---#
     #--- updated transfer_to_s3 2026-02-26 by Akiya Fukuda ---#
-    def transfer_to_s3(self, dataset_path: str):
+    def transfer_to_s3(self, dataset_path: str, num_threads: int = None, preempt: threading.Event = None):
         #--- transfer to S3 ---#
-        # obtain full local data directory path
-        data_dir = dataset_path.rstrip("/")
-        # obtain parent directory
-        tmp_path = os.path.dirname(data_dir)
-        # remove /data prefix if present
-        dest_subdir = os.path.dirname(tmp_path.replace("/data", "", 1) if tmp_path.startswith("/data") else tmp_path)
-        # target directory for transfer
-        dirname_transferred = tmp_path
-        
-        log.info(f"data_dir: {data_dir}")
-        log.info(f"tmp_path: {tmp_path}")
-        log.info(f"dest_subdir: {dest_subdir}")
-        log.info(f"dirname_transferred: {dirname_transferred}")
-
-        # Ensure S3 destination path ends with /
-        s3_destination = os.path.join(self.destination_path_via_s3, dest_subdir.lstrip("/"))
-        if not s3_destination.endswith("/"):
-            s3_destination += "/"
+        # num_threads: 並列数（スケジューラから割り当てられた数, 指定が無ければ設定値）
+        # preempt: セットされたら転送を中断して TransferPreempted を送出する（優先度の高いデータセット用）
+        # 戻り値: 全てのファイルの転送が確認できた場合 True
+        num_threads = self.upload_threads(num_threads)
+        self.metrics.begin_dataset()
+        self.context.dataset_path = dataset_path
+        if self.bundle_writer is not None and "data" == self.identify_data_or_other(dataset_path):
+            return self.transfer_bundled(dataset_path, num_threads, preempt)
+        dirname_transferred, s3_destination = self.transfer_target(dataset_path)
 
         log.info(f"Target for transfer: dirname_transferred-{dirname_transferred} -> s3_destination-{s3_destination}")    
+
+        if self.manifest is not None and not self.manifest_remote_check \
+                and self.manifest.is_seeded(dirname_transferred):
+            return self.transfer_with_manifest(dirname_transferred, s3_destination, num_threads, preempt)
+
+        # 転送前のローカルファイルの状態（転送成功後に manifest に記録する）
+        local_files = scan_local_files(dirname_transferred) if self.manifest is not None else []
+
+        if self.uploader is not None:
+            failed = self.transfer_with_uploader(dirname_transferred, s3_destination, num_threads, preempt)
+            if failed is not None:
+                self.record_manifest(dirname_transferred, s3_destination, local_files, failed)
+            return failed is not None and not failed
         
         '''
         cmd = ["s3cmd", "sync", "--recursive", "--no-check-md5",
@@ -360,30 +3612,55 @@ class AutoTransferAndProcess:
         # シェルコマンドの組み立て（修正版）
         # 1. sed で ローカルパス と リモートパス の両方を抽出
         # 2. xargs -n 2 で、2つの引数（ソースと送り先）をセットにして put に渡す
+        # 3. 転送予定のファイル一覧を tee で plan_file に残し, 失敗したファイルのみを retry_db に記録する
+        # 4. 転送済みのディレクトリ（転送予定が空）では xargs -r で s3cmd put を実行せず成功とする.
+        #    s3cmd sync --dry-run 自体の失敗は pipefail で検出する（grep は一致が無くても成功扱い）
+        plan_fd, plan_file = tempfile.mkstemp(prefix="transfer_plan_", suffix=".txt")
+        os.close(plan_fd)
         cmd = (
+                f"set -o pipefail; "
                 f"s3cmd sync --dry-run --no-check-md5 '{dirname_transferred}' '{s3_destination}' | "
-                f"grep 'upload:' | "
+                f"{{ grep 'upload:' || true; }} | "
                 f"sed -E \"s/upload: '([^']*)' -> '([^']*)'.*/\\1 \\2/\" | "
-                f"xargs -n 2 -P {self.num_threads} s3cmd put --no-check-md5"
+                f"tee '{plan_file}' | "
+                f"xargs -r -n 2 -P {num_threads} s3cmd put {self.s3cmd_command_options(num_threads)}"
         )   
 
-        log.info(f"Executing parallel upload with {self.num_threads} threads...")
+        log.info(f"Executing parallel upload with {num_threads} threads...")
         log.info(f"Command: {cmd}")
         try:
             # パイプを使用するため shell=True で実行
-            proc = sp.Popen(cmd, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT, text=True)
-            stdout, _ = proc.communicate()
+            started = time.monotonic()
+            returncode, stdout = self.run_upload_command(cmd, preempt=preempt)
         
             if stdout:
                 log.info(f"Output from transfer process:\n{stdout}")
+            uploaded_paths = parse_s3cmd_uploads(stdout)
+            self.metrics.count_upload(len(uploaded_paths), local_size(uploaded_paths), "s3cmd")
+            self.record_s3cmd_batch(stdout, local_size(uploaded_paths), len(uploaded_paths),
+                                    time.monotonic() - started, num_threads, returncode)
+            planned = read_s3cmd_plan(plan_file)
             
-            if proc.returncode == 0:
-                log.info(f"Upload finished successfully with {self.num_threads} threads.")
+            if returncode == 0:
+                log.info(f"Upload finished successfully with {num_threads} threads.")
+                self.record_upload_outcome(planned, {local_path for local_path, _remote in planned})
+                self.record_manifest(dirname_transferred, s3_destination, local_files, set())
+                return True
             else:
-                log.error(f"Upload failed with returncode {proc.returncode}")
+                log.error(f"Upload failed with returncode {returncode}")
+                self.metrics.count_error("s3cmd")
+                # 出力に upload: 行があるファイルは転送済み, それ以外の予定のファイルを再送の対象にする
+                self.record_upload_outcome(planned, set(uploaded_paths), f"s3cmd returncode {returncode}")
             
+        except TransferPreempted:
+            raise
         except Exception as e:
             log.error(f"Error during parallel transfer: {e}")
+            self.metrics.count_error("s3cmd")
+        finally:
+            os.remove(plan_file)
+
+        return False
     
         '''
         proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.STDOUT, text=True)
@@ -394,24 +3671,554 @@ class AutoTransferAndProcess:
 
     #--- transfer_to_s3 ---#
 
-    def write_kamo_dataset_file(self, dataset_path: str, data_origin: int = 1, data_total: int = None):
+    # added bundle_paths 2026-10-17
+    def bundle_paths(self, dataset_path: str):
+        #--- (bundle directory, local index copy) of dataset_path; the bundle directory is a virtual local path ---#
+        frame_dir = self.dataset_directory(dataset_path)
+        # dirname_transferred の下に置く（テンプレートの場合は frame_dir 自体が dirname_transferred）
+        bundle_dir = os.path.join(frame_dir, "_bundle")
+        digest = hashlib.sha1(frame_dir.encode()).hexdigest()[:16]
+        local_index = os.path.join(self.bundle_writer.spool_dir, f"{digest}.index.json")
+        return bundle_dir, local_index
+
+    #--- bundle_paths ---#
+
+    # added transfer_bundled 2026-10-17
+    def transfer_bundled(self, dataset_path: str, num_threads: int = None, preempt: threading.Event = None):
+        """
+        Transfers a data directory as bundles: the CBF frames not bundled yet (and
+        unchanged for stream_stable_seconds) are packed into new bundle_XXXX.tar
+        objects, the index.json is updated, and the other files of the directory
+        (e.g. HDF5 master files) are uploaded as they are.
+        Frames written less than stream_stable_seconds ago are waited for once;
+        if some are still not bundled after that, False is returned so that the
+        dataset is not taken as uploaded.
+        Returns True if everything was uploaded.
+        """
+        dirname_transferred, s3_destination = self.transfer_target(dataset_path)
+        frame_dir = self.dataset_directory(dataset_path)
+        bundle_dir, local_index = self.bundle_paths(dataset_path)
+
+        # S3 上の index.json の更新に失敗した index は .pending として残し, 次回に再送する
+        pending_index = f"{local_index}.pending"
+        index = {"dataset": frame_dir, "bundles": [], "frames": {}}
+        index_dirty = os.path.isfile(pending_index)
+        if index_dirty or os.path.isfile(local_index):
+            with open(pending_index if index_dirty else local_index, "r") as fin:
+                index = json.load(fin)
+
+        ok = True
+        new_bundles = False
+        for attempt in range(2):
+            frames, others = [], []
+            # 書き込み直後のフレーム（stream_stable_seconds 未満）が安定するまでの秒数
+            wait_seconds = 0
+            now = time.time()
+            for local_path, size, mtime in scan_local_files(frame_dir):
+                name = os.path.basename(local_path)
+                if not name.endswith(".cbf"):
+                    others.append((local_path, size, mtime))
+                elif name in index["frames"]:
+                    continue
+                elif now - mtime >= self.stream_stable_seconds:
+                    frames.append((local_path, size, mtime))
+                else:
+                    wait_seconds = max(wait_seconds, self.stream_stable_seconds - (now - mtime))
+            frames.sort()
+
+            for chunk in self.bundle_writer.chunks(frames):
+                if preempt is not None and preempt.is_set():
+                    raise TransferPreempted(dataset_path)
+                bundle_name = f"bundle_{len(index['bundles']):04d}.tar"
+                tar_path, entries = self.bundle_writer.write(bundle_name, chunk)
+                try:
+                    remote = remote_url_for(os.path.join(bundle_dir, bundle_name), dirname_transferred, s3_destination)
+                    log.info(f"Uploading {bundle_name} ({len(chunk)} frames) of {frame_dir}")
+                    if tar_path not in self.upload_file_list([(tar_path, remote)], num_threads):
+                        ok = False
+                        break
+                finally:
+                    os.remove(tar_path)
+                index["bundles"].append(bundle_name)
+                index["frames"].update(entries)
+                new_bundles = True
+
+            if not ok or not wait_seconds:
+                break
+            if attempt == 0:
+                # 最後の同期で直前に書かれたフレームを取り残さないように, 安定するまで待ってもう一度だけまとめる
+                log.info(f"Waiting {wait_seconds:.1f}s for frames still being written in {frame_dir}")
+                time.sleep(wait_seconds)
+            else:
+                log.info(f"Frames of {frame_dir} are still being written. Not bundled yet.")
+                ok = False
+
+        if new_bundles or index_dirty:
+            # index は bundle のアップロード後に更新する（index に載っているフレームは必ず読める）
+            # ローカルの index は S3 上の index.json の更新に成功してから置き換える
+            tmp_index = f"{pending_index}.tmp"
+            with open(tmp_index, "w") as fout:
+                json.dump(index, fout)
+            os.replace(tmp_index, pending_index)
+            remote_index = remote_url_for(os.path.join(bundle_dir, "index.json"), dirname_transferred, s3_destination)
+            if pending_index in self.upload_file_list([(pending_index, remote_index)], num_threads):
+                os.replace(pending_index, local_index)
+            else:
+                log.error(f"Failed to upload the bundle index of {frame_dir}. Retrying in the next sync.")
+                ok = False
+
+        # フレーム以外のファイル (master ファイル等) はそのまま転送
+        if self.manifest is not None:
+            others = self.manifest.pending(others)
+        uploads = [(f[0], remote_url_for(f[0], dirname_transferred, s3_destination)) for f in others]
+        uploaded = self.upload_file_list(uploads, num_threads, preempt)
+        if self.manifest is not None:
+            remote_urls = dict(uploads)
+            self.manifest.record([(p, size, mtime, remote_urls[p]) for p, size, mtime in others if p in uploaded])
+
+        log.info(f"{len(index['frames'])} frames of {frame_dir} in {len(index['bundles'])} bundles.")
+        return ok and len(uploaded) == len(uploads)
+
+    #--- transfer_bundled ---#
+
+    # added run_upload_command 2026-10-17
+    def run_upload_command(self, cmd: str, stdin: str = None, preempt: threading.Event = None):
+        #--- run an s3cmd/xargs pipeline and return (returncode, stdout); kill it and raise TransferPreempted on preempt ---#
+        # パイプライン全体を止められるように新しいプロセスグループで実行する（pipefail を使うので bash で実行）
+        proc = sp.Popen(cmd, shell=True, executable="/bin/bash", stdin=sp.PIPE if stdin is not None else None,
+                        stdout=sp.PIPE, stderr=sp.STDOUT, text=True, start_new_session=True)
+        while True:
+            try:
+                stdout, _ = proc.communicate(stdin, timeout=1.0)
+                return proc.returncode, stdout
+            except sp.TimeoutExpired:
+                # 入力は最初の communicate() で渡し済み
+                stdin = None
+                if preempt is not None and preempt.is_set():
+                    log.info(f"Stopping upload for a higher-priority dataset: {cmd}")
+                    os.killpg(proc.pid, signal.SIGTERM)
+                    proc.communicate()
+                    raise TransferPreempted(cmd)
+
+    #--- run_upload_command ---#
+
+    # added should_stream 2026-10-17
+    def should_stream(self, dataset_path: str, dataset_info: list):
+        #--- True if dataset_path is the latest data dataset and its frames are still being collected ---#
+        if not self.streaming_mode or dataset_path != dataset_info[-1]["path"]:
+            return False
+        if "data" != self.identify_data_or_other(dataset_path):
+            return False
+        # 再起動時等, 既に全てのフレームが揃っているデータセットは通常の転送にする
+        total = dataset_info[-1]["total"]
+        return not total or self.count_streamed_frames(set(self.list_frames(dataset_path)), total) < total
+
+    #--- should_stream ---#
+
+    # added start_streaming 2026-10-17
+    def start_streaming(self, dataset_path: str, total: int, output_path_by_bss: str):
+        #--- start a background thread that uploads the frames of dataset_path while they are collected ---#
+        if dataset_path in self.streamers:
+            log.debug(f"Dataset is already streamed: {dataset_path}")
+            return
+
+        register_kamo = "auto" == self.identify_auto_or_visit(output_path_by_bss)
+        self.record_state(dataset_path, "in_progress", output_path_by_bss=output_path_by_bss, total=total)
+        streamer = threading.Thread(
+            target=self.stream_dataset,
+            args=(dataset_path, total, register_kamo, output_path_by_bss),
+            name=f"stream-{os.path.basename(self.dataset_directory(dataset_path))}",
+            daemon=True,
+        )
+        self.streamers[dataset_path] = streamer
+        log.info(f"Start streaming dataset: {dataset_path} (total: {total})")
+        streamer.start()
+
+    #--- start_streaming ---#
+
+    # added dataset_directory 2026-10-17
+    def dataset_directory(self, dataset_path: str):
+        #--- directory containing the frames (same rule as identify_data_or_other) ---#
+        if os.path.isfile(dataset_path) or "*" in dataset_path or "?" in dataset_path \
+                or dataset_path.endswith(FRAME_SUFFIXES):
+            return os.path.dirname(dataset_path)
+        return dataset_path.rstrip("/")
+
+    #--- dataset_directory ---#
+
+    # added list_frames 2026-10-17
+    def list_frames(self, dataset_path: str):
+        #--- CBF/HDF5 frame files of dataset_path ---#
+        frame_dir = self.dataset_directory(dataset_path)
+        name = os.path.basename(dataset_path)
+        # テンプレート (例: sample_??????.cbf) がある場合はそれに一致するもの、無い場合は全てのフレーム
+        pattern = name if ("*" in name or "?" in name) else None
+        try:
+            entries = os.listdir(frame_dir)
+        except FileNotFoundError:
+            return []
+
+        frames = []
+        for entry in entries:
+            if not entry.endswith(FRAME_SUFFIXES):
+                continue
+            if pattern and entry.endswith(".cbf") and not fnmatch.fnmatch(entry, pattern):
+                continue
+            frames.append(os.path.join(frame_dir, entry))
+        return frames
+
+    #--- list_frames ---#
+
+    # added stream_dataset 2026-10-17
+    def stream_dataset(self, dataset_path: str, total: int, register_kamo: bool, output_path_by_bss: str = None):
+        """
+        Uploads each frame of dataset_path as soon as its size and mtime have been
+        stable for stream_stable_seconds, and finishes when `total` frames have
+        been uploaded (CBF files, or the HDF5 master file and its data files; see
+        count_streamed_frames) or no new frame arrived for stream_idle_timeout seconds.
+        A final sync of the directory is done before registering to Kamo.
+        """
+        dirname_transferred, s3_destination = self.transfer_target(dataset_path)
+        self.context.dataset_path = dataset_path
+        last_seen = {}       # path -> (size, mtime, time when first seen with this size/mtime)
+        uploaded = set()
+        last_progress = time.monotonic()
+
+        try:
+            while True:
+                now = time.monotonic()
+                stable = []
+                for frame in self.list_frames(dataset_path):
+                    if frame in uploaded:
+                        continue
+                    try:
+                        st = os.stat(frame)
+                    except OSError:
+                        continue
+                    key = (st.st_size, st.st_mtime)
+                    previous = last_seen.get(frame)
+                    if previous is None or previous[:2] != key:
+                        last_seen[frame] = key + (now,)
+                    elif st.st_size > 0 and now - previous[2] >= self.stream_stable_seconds:
+                        stable.append((frame, st.st_size, st.st_mtime))
+
+                if stable:
+                    uploads = [(f[0], remote_url_for(f[0], dirname_transferred, s3_destination)) for f in stable]
+                    done = self.upload_file_list(uploads)
+                    uploaded |= done
+                    if self.manifest is not None:
+                        remote_urls = dict(uploads)
+                        self.manifest.record([(p, size, mtime, remote_urls[p]) for p, size, mtime in stable if p in done])
+                    if done:
+                        last_progress = now
+
+                n_frames = self.count_streamed_frames(uploaded, total)
+                if total and n_frames >= total:
+                    log.info(f"All {total} frames of {dataset_path} uploaded.")
+                    break
+                if now - last_progress > self.stream_idle_timeout:
+                    log.warning(f"No new frames for {self.stream_idle_timeout}s: {dataset_path} "
+                                f"({n_frames}/{total} frames uploaded). Finishing.")
+                    break
+
+                time.sleep(self.stream_poll_interval)
+
+            # 残りのファイル (master ファイル等) をまとめて転送
+            synced = self.transfer_to_s3(dataset_path)
+            self.record_transfer_result(dataset_path, synced)
+            if register_kamo:
+                log.info("Preparing Kamo dataset file.")
+                self.write_kamo_dataset_file(dataset_path, data_origin=1, data_total=total)
+            if synced:
+                self.post_transfer(dataset_path, total, output_path_by_bss)
+            self.mark_processed([dataset_path])
+            log.info(f"Finished streaming dataset: {dataset_path}")
+
+        except Exception as e:
+            log.error(f"Error while streaming {dataset_path}: {e}")
+
+    #--- stream_dataset ---#
+
+    # added count_streamed_frames 2026-10-17
+    def count_streamed_frames(self, uploaded: set, total: int):
+        #--- number of frames in the uploaded files: 1 per CBF, hdf5_images_per_file per HDF5 data file ---#
+        # HDF5 は master ファイルが転送されるまでは数えない（data ファイルだけでは完了にしない）
+        n_frames = sum(1 for f in uploaded if f.endswith(".cbf"))
+        if any(f.endswith("_master.h5") for f in uploaded):
+            n_data_files = sum(1 for f in uploaded if f.endswith(".h5") and not f.endswith("_master.h5"))
+            n_frames += min(total or 0, n_data_files * self.hdf5_images_per_file)
+        return n_frames
+
+    #--- count_streamed_frames ---#
+
+    # added transfer_target 2026-10-17 (split out of transfer_to_s3)
+    def transfer_target(self, dataset_path: str):
+        #--- local directory to sync and its S3 destination for dataset_path ---#
+        # obtain full local data directory path
+        data_dir = dataset_path.rstrip("/")
+        # obtain parent directory
+        tmp_path = os.path.dirname(data_dir)
+        # remove /data prefix if present
+        dest_subdir = os.path.dirname(tmp_path.replace(self.data_root, "", 1) if tmp_path.startswith(self.data_root) else tmp_path)
+        # target directory for transfer
+        dirname_transferred = tmp_path
+        
+        log.info(f"data_dir: {data_dir}")
+        log.info(f"tmp_path: {tmp_path}")
+        log.info(f"dest_subdir: {dest_subdir}")
+        log.info(f"dirname_transferred: {dirname_transferred}")
+
+        # Ensure S3 destination path ends with /
+        s3_destination = os.path.join(self.destination_path_via_s3, dest_subdir.lstrip("/"))
+        if not s3_destination.endswith("/"):
+            s3_destination += "/"
+
+        return dirname_transferred, s3_destination
+
+    #--- transfer_target ---#
+
+    # added transfer_with_uploader 2026-10-17
+    def transfer_with_uploader(self, dirname_transferred: str, s3_destination: str,
+                               num_threads: int = None, preempt: threading.Event = None):
+        #--- transfer to S3 with the in-process uploader (upload_backend: boto3) ---#
+        # returns the set of local paths that failed, or None if the sync itself failed
+        # (with adaptive_concurrency the uploader applies the current limit while it runs)
+        num_threads = num_threads or self.max_threads
+        log.info(f"Executing in-process upload with {num_threads} workers...")
+        try:
+            result = self.uploader.sync_directory(dirname_transferred, s3_destination, num_threads, preempt)
+        except Exception as e:
+            log.error(f"Error during in-process transfer: {e}")
+            self.metrics.count_error("boto3")
+            return None
+
+        self.metrics.count_upload(len(result["uploaded"]), result["bytes"], "boto3")
+        if result["failed"]:
+            self.metrics.count_error("boto3", len(result["failed"]))
+        self.record_upload_result(result, lambda p: remote_url_for(p, dirname_transferred, s3_destination))
+
+        if result["stopped"]:
+            # 途中で止めた同期は manifest に記録しない（再開時にもう一度一覧と比較する）
+            log.info(f"Upload stopped after {len(result['uploaded'])} files: {dirname_transferred}")
+            raise TransferPreempted(dirname_transferred)
+
+        if result["failed"]:
+            log.error(f"Upload failed for {len(result['failed'])} files "
+                      f"({len(result['uploaded'])} files uploaded)")
+        else:
+            log.info(f"Upload finished successfully: {len(result['uploaded'])} files, "
+                     f"{result['bytes']} bytes with {num_threads} workers.")
+
+        return {local_path for local_path, _error in result["failed"]}
+
+    #--- transfer_with_uploader ---#
+
+    # added transfer_with_manifest 2026-10-17
+    def transfer_with_manifest(self, dirname_transferred: str, s3_destination: str,
+                               num_threads: int = None, preempt: threading.Event = None):
+        #--- transfer only the files not recorded in the manifest (no remote listing) ---#
+        # returns True if all new files were uploaded
+        local_files = scan_local_files(dirname_transferred)
+        pending = self.manifest.pending(local_files)
+        if not pending:
+            log.info(f"No new files in {dirname_transferred} ({len(local_files)} files recorded in manifest).")
+            return True
+
+        log.info(f"{len(pending)} new files in {dirname_transferred} according to manifest.")
+        uploads = [(f[0], remote_url_for(f[0], dirname_transferred, s3_destination)) for f in pending]
+        uploaded = self.upload_file_list(uploads, num_threads, preempt)
+
+        remote_urls = dict(uploads)
+        self.manifest.record([(p, size, mtime, remote_urls[p]) for p, size, mtime in pending if p in uploaded])
+        if preempt is not None and preempt.is_set() and len(uploaded) < len(uploads):
+            raise TransferPreempted(dirname_transferred)
+        return len(uploaded) == len(uploads)
+
+    #--- transfer_with_manifest ---#
+
+    # added upload_file_list 2026-10-17
+    def upload_file_list(self, uploads: list, num_threads: int = None, preempt: threading.Event = None):
+        """
+        Uploads the given files with the configured backend.
+        uploads: list of (local_path, s3_url)
+        num_threads: number of parallel uploads (default: num_threads of the config)
+        preempt: when set, the upload stops early (the files not uploaded are left out of the result)
+        Returns the set of local paths confirmed uploaded.
+        """
+        if not uploads:
+            return set()
+
+        if self.uploader is not None:
+            num_threads = num_threads or self.max_threads
+            targets = [(local_path,) + split_s3_url(s3_url) for local_path, s3_url in uploads]
+            result = self.uploader.upload_files(targets, num_threads, preempt)
+            self.metrics.count_upload(len(result["uploaded"]), result["bytes"], "boto3")
+            self.record_upload_result(result, dict(uploads).get)
+            if result["failed"]:
+                self.metrics.count_error("boto3", len(result["failed"]))
+                log.error(f"Upload failed for {len(result['failed'])} files "
+                          f"({len(result['uploaded'])} files uploaded)")
+            else:
+                log.info(f"Upload finished successfully: {len(result['uploaded'])} files, {result['bytes']} bytes.")
+            return set(result["uploaded"])
+
+        # ファイル一覧を NUL 区切りで xargs に渡し、s3cmd put を並列実行
+        num_threads = self.upload_threads(num_threads)
+        cmd = f"xargs -0 -r -n 2 -P {num_threads} s3cmd put {self.s3cmd_command_options(num_threads)}"
+        stdin = "".join(f"{local_path}\0{s3_url}\0" for local_path, s3_url in uploads)
+        log.info(f"Executing parallel upload of {len(uploads)} files with {num_threads} threads...")
+        log.info(f"Command: {cmd}")
+        try:
+            started = time.monotonic()
+            returncode, stdout = self.run_upload_command(cmd, stdin, preempt)
+
+            if stdout:
+                log.info(f"Output from transfer process:\n{stdout}")
+            uploaded_paths = parse_s3cmd_uploads(stdout)
+            self.metrics.count_upload(len(uploaded_paths), local_size(uploaded_paths), "s3cmd")
+            self.record_s3cmd_batch(stdout, local_size(uploaded_paths), len(uploaded_paths),
+                                    time.monotonic() - started, num_threads, returncode)
+
+            if returncode == 0:
+                log.info(f"Upload finished successfully with {num_threads} threads.")
+                uploaded = {local_path for local_path, _s3_url in uploads}
+                self.record_upload_outcome(uploads, uploaded)
+                return uploaded
+            log.error(f"Upload failed with returncode {returncode}")
+            self.metrics.count_error("s3cmd")
+            # 出力に upload: 行があるファイルは転送済みとして扱い, それ以外のみ再送する
+            uploaded = set(uploaded_paths) & {local_path for local_path, _s3_url in uploads}
+            self.record_upload_outcome(uploads, uploaded, f"s3cmd returncode {returncode}")
+            return uploaded
+
+        except TransferPreempted:
+            # どのファイルが転送済みか分からないので, 転送済みとしては扱わない
+            pass
+        except Exception as e:
+            log.error(f"Error during parallel transfer: {e}")
+            self.metrics.count_error("s3cmd")
+            self.record_upload_outcome(uploads, set(), str(e))
+
+        return set()
+
+    #--- upload_file_list ---#
+
+    # added record_upload_result 2026-10-17
+    def record_upload_result(self, result: dict, remote_for):
+        #--- per-file outcome of S3Uploader.upload_files(); remote_for(local_path) gives the S3 URL ---#
+        if self.retry_queue is None:
+            return
+        self.retry_queue.record_success(result["uploaded"])
+        self.record_failures([(p, remote_for(p), error) for p, error in result["failed"]])
+
+    #--- record_upload_result ---#
+
+    # added record_upload_outcome 2026-10-17
+    def record_upload_outcome(self, uploads: list, uploaded: set, error: str = None):
+        #--- uploads: list of (local_path, s3_url); the files not in uploaded are queued for a retry ---#
+        if self.retry_queue is None:
+            return
+        self.retry_queue.record_success([p for p, _remote in uploads if p in uploaded])
+        self.record_failures([(p, remote, error) for p, remote in uploads if p not in uploaded])
+
+    #--- record_upload_outcome ---#
+
+    # added record_failures 2026-10-17
+    def record_failures(self, failures: list):
+        if not failures:
+            return
+        dataset_path = getattr(self.context, "dataset_path", None)
+        given_up = self.retry_queue.record_failures(failures, dataset_path)
+        log.warning(f"{len(failures)} failed uploads queued for a retry"
+                    + (f" (of {dataset_path})" if dataset_path else ""))
+        if given_up:
+            self.metrics.inc("transfer_retries_given_up_total", len(given_up))
+            log.error(f"Giving up {len(given_up)} files after {self.retry_queue.max_attempts} attempts: {given_up[:10]}")
+
+    #--- record_failures ---#
+
+    # added retry_failed_uploads 2026-10-17
+    def retry_failed_uploads(self):
+        #--- resend the files whose retry is due; datasets with no more failed files are marked uploaded ---#
+        if self.retry_queue is None:
+            return
+        due = self.retry_queue.due()
+        if not due:
+            return
+
+        missing = [p for p, _remote, _dataset, _attempts in due if not os.path.isfile(p)]
+        if missing:
+            log.warning(f"{len(missing)} files to retry no longer exist. Dropping them: {missing[:10]}")
+            self.retry_queue.record_success(missing)
+        uploads = [(p, remote) for p, remote, _dataset, _attempts in due if p not in missing]
+        if not uploads:
+            return
+
+        log.info(f"Retrying {len(uploads)} failed uploads.")
+        self.context.dataset_path = None
+        uploaded = self.upload_file_list(uploads)
+        self.metrics.inc("transfer_retried_files_total", len(uploads))
+        if self.manifest is not None:
+            entries = []
+            for p, remote in uploads:
+                if p in uploaded:
+                    st = os.stat(p)
+                    entries.append((p, st.st_size, st.st_mtime, remote))
+            self.manifest.record(entries)
+
+        for dataset_path in {d for p, _remote, d, _attempts in due if d and p in uploaded}:
+            if not self.retry_queue.has_pending(dataset_path):
+                self.dataset_retried(dataset_path)
+
+    #--- retry_failed_uploads ---#
+
+    # added dataset_retried 2026-10-17
+    def dataset_retried(self, dataset_path: str):
+        #--- all failed files of dataset_path were resent ---#
+        log.info(f"All failed files of {dataset_path} are uploaded.")
+        if self.state_store is None:
+            return
+        entry = self.state_store.get(dataset_path)
+        if entry is None or entry["state"] not in ("pending", "in_progress"):
+            return
+        files = scan_local_files(self.dataset_directory(dataset_path))
+        self.record_state(dataset_path, "uploaded", files=len(files), nbytes=sum(f[1] for f in files))
+        if entry["output_path_by_bss"] and "data" == self.identify_data_or_other(dataset_path):
+            self.post_transfer(dataset_path, entry["total"], entry["output_path_by_bss"])
+
+    #--- dataset_retried ---#
+
+    # added record_manifest 2026-10-17
+    def record_manifest(self, dirname_transferred: str, s3_destination: str, local_files: list, failed: set):
+        #--- record the files synced by a full sync and mark the directory as seeded ---#
+        if self.manifest is None:
+            return
+        self.manifest.record([
+            (p, size, mtime, remote_url_for(p, dirname_transferred, s3_destination))
+            for p, size, mtime in local_files if p not in failed
+        ])
+        self.manifest.mark_seeded(dirname_transferred, s3_destination)
+        log.info(f"Recorded {len(local_files) - len(failed)} files of {dirname_transferred} in manifest.")
+
+    #--- record_manifest ---#
+
+    # updated write_kamo_dataset_file 2026-10-17 (coalesced writes via KamoFileWriter)
+    # updated write_kamo_dataset_file 2026-10-17 (restored: frames restored on AOBA by register_restored_kamo)
+    def write_kamo_dataset_file(self, dataset_path: str, data_origin: int = 1, data_total: int = None,
+                                restored: bool = False):
         if dataset_path is None:
             log.error(f"No dataset info to write to {dataset_path}")
             return
 
-        p = Path(dataset_path)
-        base_parent = p.parents[2]
-        dest_subdir = base_parent.relative_to("/data")
-        write_kamo_proc_path = os.path.join(self.destination_path_via_s3, dest_subdir)
-        if not write_kamo_proc_path.endswith('/'):
-           write_kamo_proc_path += '/'
-
-        tmp_path = Path(dataset_path)
-        output_path = tmp_path.relative_to("/data")
-        output_path = os.path.join(self.destination_path_via_aoba, output_path)
-        output_sets = f"{output_path}, {data_origin}, {data_total}"
+        # bundle_mode / compression の data ディレクトリは, 転送後に AOBA 側で復元してから登録する (register_restored_kamo)
+        if self.restore_flags and not restored and "data" == self.identify_data_or_other(dataset_path):
+            log.info(f"{dataset_path} is registered to Kamo after its frames are restored on AOBA.")
+            return
 
-        local_write_kamo_proc_path = os.path.join(base_parent, "dataset_paths_for_kamo.txt")
+        local_write_kamo_proc_path, write_kamo_proc_path, output_sets = \
+            self.kamo_entry(dataset_path, data_origin, data_total)
+        base_parent = Path(dataset_path).parents[2]
+        dest_subdir = base_parent.relative_to(self.data_root)
 
         log.info(f"dataset_path: {dataset_path}")
         log.info(f"base_parent: {base_parent}")
@@ -422,41 +4229,9 @@ class AutoTransferAndProcess:
         log.info(f"output_path to write: {output_sets}")
 
 
+        # 重複チェックはメモリ上の登録済みエントリで行い, 書き込みとアップロードはまとめて行う
         try:
-            # --- 重複チェック用の読み込み ---
-            existing_content = ""
-            if os.path.isfile(local_write_kamo_proc_path):
-                with open(local_write_kamo_proc_path, "r") as f:
-                    existing_content = f.read()
-
-            # すでに output_sets がファイル内に含まれているか確認
-            if f"{output_sets}\n" in existing_content:
-                log.info(f"Path already exists in {local_write_kamo_proc_path}. Skipping.")
-            else:
-                # --- ここから元のロジックを保持 ---
-                if not os.path.isfile(local_write_kamo_proc_path):
-                    with open(local_write_kamo_proc_path, "w") as fout:
-                        fout.write(f"{output_sets}\n")
-                        log.info(f"Wrote path to {local_write_kamo_proc_path}: {output_sets}")
-
-                        log.info(f"Transferring local kamo_proc_path to aoba: {local_write_kamo_proc_path} -> {write_kamo_proc_path}")
-                        # パスを引用符で囲む修正だけ追加（安全のため）
-                        cmd = (f"s3cmd sync --no-check-md5 '{local_write_kamo_proc_path}' '{write_kamo_proc_path}'")
-                        log.info(f"Executing command: {cmd}")
-                        sp.run(cmd, shell=True, check=True)
-                        log.info(f"Transfer finished successfully.")
-                else:
-                    with open(local_write_kamo_proc_path, "a") as fout:
-                        fout.write(f"{output_sets}\n")
-                        log.info(f"Appended path to {local_write_kamo_proc_path}: {output_sets}")
-                
-                        log.info(f"Transferring local kamo_proc_path to aoba: {local_write_kamo_proc_path} -> {write_kamo_proc_path}")
-                        # ファイル単体なのでここも put (または sync) で確実に上書き
-                        cmd = (f"s3cmd sync --force --no-check-md5 '{local_write_kamo_proc_path}' '{write_kamo_proc_path}'")
-                        log.info(f"Executing command: {cmd}")
-                        sp.run(cmd, shell=True, check=True)
-                        log.info(f"Transfer finished successfully.")
-                
+            self.kamo_writer.add(local_write_kamo_proc_path, write_kamo_proc_path, output_sets, key=dataset_path)
         except ValueError as e:
             log.error(f"Failed to write to {local_write_kamo_proc_path}: {e}")
         except Exception as e:
@@ -489,15 +4264,327 @@ class AutoTransferAndProcess:
 
     #--- write_kamo_dataset_file ---#
 
+    # added kamo_entry 2026-10-17 (split out of write_kamo_dataset_file)
+    def kamo_entry(self, dataset_path: str, data_origin: int = 1, data_total: int = None):
+        #--- (local dataset_paths_for_kamo.txt, its S3 URL, entry line) of dataset_path ---#
+        p = Path(dataset_path)
+        base_parent = p.parents[2]
+        dest_subdir = base_parent.relative_to(self.data_root)
+        write_kamo_proc_path = os.path.join(self.destination_path_via_s3, dest_subdir)
+        if not write_kamo_proc_path.endswith('/'):
+           write_kamo_proc_path += '/'
+
+        output_path = p.relative_to(self.data_root)
+        output_path = os.path.join(self.destination_path_via_aoba, output_path)
+        output_sets = f"{output_path}, {data_origin}, {data_total}"
+
+        local_write_kamo_proc_path = os.path.join(base_parent, "dataset_paths_for_kamo.txt")
+        return local_write_kamo_proc_path, write_kamo_proc_path, output_sets
+
+    #--- kamo_entry ---#
+
+    # added register_restored_kamo 2026-10-17
+    def register_restored_kamo(self, dataset_path: str, total: int, output_path_by_bss: str):
+        #--- post-transfer hook: restore the frames of an uploaded auto data directory on AOBA once, then register it to Kamo ---#
+        if "auto" != self.identify_auto_or_visit(output_path_by_bss or ""):
+            return
+        local_path, _remote_url, entry = self.kamo_entry(dataset_path, 1, total)
+        # 最新のデータセットは毎サイクル転送されるので, 登録済みなら何もしない
+        if self.kamo_writer.contains(local_path, entry):
+            return
+        if dataset_path not in self.restored:
+            # 測定中のデータセットは全てのフレームが転送されてから復元する（後から来たフレームが復元されないため）
+            n_frames = self.count_streamed_frames(set(self.list_frames(dataset_path)), total)
+            if total and n_frames < total:
+                log.info(f"{n_frames}/{total} frames of {dataset_path}. Restoring on AOBA later.")
+                return
+            if not self.restore_on_aoba(dataset_path):
+                return
+            self.restored.add(dataset_path)
+        self.write_kamo_dataset_file(dataset_path, data_origin=1, data_total=total, restored=True)
+
+    #--- register_restored_kamo ---#
+
+    # added restore_on_aoba 2026-10-17
+    def restore_on_aoba(self, dataset_path: str):
+        #--- run restore_command (--unbundle / --decompress) on the frame directory on AOBA via ssh; True on success ---#
+        frame_dir = self.dataset_directory(dataset_path)
+        aoba_dir = shlex.quote(os.path.join(self.destination_path_via_aoba, os.path.relpath(frame_dir, self.data_root)))
+        command = " && ".join(f"{self.restore_command} {flag} {aoba_dir}" for flag in self.restore_flags)
+        ssh_args = [self.restore_ssh_command, "-o", "BatchMode=yes",
+                    "-o", f"ConnectTimeout={int(min(30, self.restore_timeout))}", self.restore_ssh_host]
+        log.info(f"Restoring frames on AOBA: {command}")
+        try:
+            proc = sp.run(ssh_args + [command], stdout=sp.PIPE, stderr=sp.STDOUT, text=True,
+                          timeout=self.restore_timeout)
+        except (OSError, sp.TimeoutExpired) as e:
+            log.error(f"Failed to restore frames of {dataset_path} on AOBA: {e}")
+            return False
+        if proc.returncode != 0:
+            log.error(f"Failed to restore frames of {dataset_path} on AOBA "
+                      f"(returncode {proc.returncode}): {proc.stdout.strip()}")
+            return False
+        return True
+
+    #--- restore_on_aoba ---#
+
+    # added upload_kamo_file 2026-10-17
+    def upload_kamo_file(self, local_path: str, remote_url: str):
+        #--- upload dataset_paths_for_kamo.txt (raises on failure) ---#
+        # ファイル単体なので sync --force で確実に上書き
+        cmd = (f"s3cmd sync --force --no-check-md5 '{local_path}' '{remote_url}'")
+        log.info(f"Executing command: {cmd}")
+        try:
+            sp.run(cmd, shell=True, check=True, timeout=self.command_timeout)
+        except (sp.CalledProcessError, sp.TimeoutExpired):
+            self.metrics.count_error("s3cmd")
+            raise
+        self.metrics.count_upload(1, local_size([local_path]), "s3cmd")
+        log.info(f"Transfer finished successfully.")
+
+    #--- upload_kamo_file ---#
+
+    # added kamo_registered 2026-10-17
+    def kamo_registered(self, dataset_path: str):
+        #--- called once the kamo entry of dataset_path is uploaded ---#
+        if dataset_path in self.first_seen:
+            self.metrics.observe("transfer_detect_to_kamo_seconds", time.time() - self.first_seen[dataset_path])
+        if self.state_store is None:
+            return
+        entry = self.state_store.get(dataset_path)
+        # 転送が完了しているデータセットのみ kamo_registered にする
+        if entry is not None and entry["state"] in ("uploaded", "kamo_registered"):
+            self.record_state(dataset_path, "kamo_registered")
+
+    #--- kamo_registered ---#
+
 #%%
+# added MultiMonitorDaemon 2026-10-17
+class MultiMonitorDaemon:
+    """
+    Watches several monitor files (beamlines) in one daemon.
+
+    Every entry of monitors (or every file matching a glob bss_dataset_path)
+    runs its own AutoTransferAndProcess loop in a thread, with its own
+    destination, modes, priority and weight, and its own state files. All of
+    them share the uploader (connection pool), the concurrency controller,
+    the metrics and one DatasetScheduler, which orders the datasets of the
+    monitors fairly by their weights.
+
+    With shard_lease_dir, the monitors are shared out between several
+    daemons (processes or hosts) through LeaseManager: a daemon runs only the
+    monitors whose lease it holds, at most shard_max_monitors of them, and
+    takes over the monitors of a daemon that stopped renewing its leases.
+    """
+    # 設定ファイルのパス. モニターごとに指定しなければ <ファイル名>.<モニター名>.<拡張子> にする
+    PER_MONITOR_FILES = {
+        "state_db": None,
+        "offset_state_file": ".transfer_offsets.json",
+        "manifest_db": None,
+        "retry_db": None,
+        "xds_state_file": ".xds_submitted.json",
+    }
+    # 全モニターで共有するアップローダー・スケジューラー・metrics の設定（トップレベルの設定のみ使う）
+    SHARED_SETTINGS = (
+        "num_threads", "upload_backend", "s3_endpoint_url", "s3_profile", "multipart_threshold_mb",
+        "multipart_chunk_mb", "multipart_threads", "multipart_part_retries", "compression", "compression_level",
+        "compression_processes", "checksum", "checksum_algorithm", "checksum_db", "adaptive_concurrency",
+        "adaptive_min_threads", "adaptive_max_threads", "adaptive_interval", "bandwidth_limit_mb",
+        "max_parallel_datasets", "max_parallel_other", "threads_per_dataset", "metrics_port", "metrics_host",
+        "metrics_snapshot_file", "metrics_snapshot_interval",
+    )
+
+    def __init__(self, cfg: dict):
+        self.cfg = cfg
+        if cfg.get("engine", "thread") == "asyncio":
+            log.warning("engine: asyncio is not supported with several monitors. Using engine: thread.")
+        self.max_monitors = cfg.get("shard_max_monitors")
+        self.leases = None
+        lease_ttl = cfg.get("shard_lease_ttl", 60)
+        if cfg.get("shard_lease_dir"):
+            self.leases = LeaseManager(cfg["shard_lease_dir"], owner=cfg.get("shard_owner"), ttl=lease_ttl)
+            log.info(f"Sharding monitors through leases in {cfg['shard_lease_dir']} as {self.leases.owner}")
+        # lease は期限の 1/3 ごとに更新する
+        self.interval = min(cfg["wait_time"], lease_ttl / 3) if self.leases is not None else cfg["wait_time"]
+        self.shared = None
+        self.instances = {}     # name -> AutoTransferAndProcess of the running monitors
+        self.threads = {}       # name -> thread running proc()
+        self.stopped = []       # instances of the monitors stopped before shutdown
+        self.warned = set()
+
+    def monitor_configs(self):
+        #--- name -> config of each monitor (the top-level config updated with the monitor entry) ---#
+        entries = self.cfg.get("monitors") or [{"bss_dataset_path": self.cfg["bss_dataset_path"]}]
+        monitors = {}
+        for entry in entries:
+            pattern = entry.get("bss_dataset_path", self.cfg.get("bss_dataset_path"))
+            is_glob = any(c in pattern for c in "*?[")
+            paths = sorted(glob.glob(pattern)) if is_glob else [pattern]
+            for path in paths:
+                stem = Path(path).stem
+                name = entry.get("name") or stem
+                if is_glob and entry.get("name"):
+                    name = f"{entry['name']}-{stem}"
+                if name in monitors:
+                    log.error(f"Duplicate monitor name {name} ({path}). Skipping...")
+                    continue
+
+                monitor_cfg = {k: v for k, v in self.cfg.items() if k != "monitors"}
+                for key, value in entry.items():
+                    if key in self.SHARED_SETTINGS:
+                        if (name, key) not in self.warned:
+                            log.warning(f"{key} is shared by all monitors. Ignoring it in monitor {name}.")
+                            self.warned.add((name, key))
+                        continue
+                    monitor_cfg[key] = value
+                monitor_cfg["bss_dataset_path"] = path
+                monitor_cfg["engine"] = "thread"
+                for key, default in self.PER_MONITOR_FILES.items():
+                    file_path = self.cfg.get(key, default)
+                    if key not in entry and file_path:
+                        root, ext = os.path.splitext(file_path)
+                        monitor_cfg[key] = f"{root}.{name}{ext}"
+                monitors[name] = monitor_cfg
+        return monitors
+
+    def run(self):
+        #--- start/stop the monitors until SIGTERM/SIGINT ---#
+        try:
+            while True:
+                self.balance()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            log.info("Interrupted.")
+        finally:
+            self.shutdown()
+
+    def balance(self):
+        #--- renew the leases, stop the monitors that were lost and start the ones that are free ---#
+        for name in list(self.instances):
+            if self.leases is not None and not self.leases.renew(name):
+                self.stop_monitor(name)
+
+        # 新しいモニターファイル（ビームライン）が追加された場合もここで開始する
+        for name, monitor_cfg in self.monitor_configs().items():
+            if name in self.instances:
+                continue
+            if self.max_monitors and len(self.instances) >= self.max_monitors:
+                break
+            if self.leases is not None and not self.leases.acquire(name):
+                continue
+            try:
+                self.start_monitor(name, monitor_cfg)
+            except Exception as e:
+                log.error(f"Failed to start monitor {name}: {e}")
+                if self.leases is not None:
+                    self.leases.release(name)
+
+    def start_monitor(self, name: str, monitor_cfg: dict):
+        instance = AutoTransferAndProcess(monitor_cfg, shared=self.shared, name=name)
+        if self.shared is None:
+            self.shared = instance
+        self.instances[name] = instance
+        thread = threading.Thread(target=self.run_monitor, args=(instance,), name=f"monitor-{name}", daemon=True)
+        self.threads[name] = thread
+        thread.start()
+        log.info(f"Started monitor {name}: {monitor_cfg['bss_dataset_path']} -> "
+                 f"{monitor_cfg['destination_path_via_s3']} (priority {instance.monitor_priority}, "
+                 f"weight {instance.weight})")
+
+    def run_monitor(self, instance):
+        # 例外で proc() が終わっても, 停止されるまでは wait_time 後に再開する
+        while not instance.stop_event.is_set():
+            try:
+                instance.proc()
+            except Exception as e:
+                log.error(f"Monitor {instance.name} failed: {e}")
+                instance.stop_event.wait(instance.wait_time)
+
+    def stop_monitor(self, name: str):
+        instance = self.instances.pop(name)
+        thread = self.threads.pop(name)
+        instance.stop_event.set()
+        thread.join(instance.wait_time + 5)
+        if thread.is_alive():
+            log.warning(f"Monitor {name} is still finishing a cycle.")
+        self.stopped.append(instance)
+        log.info(f"Stopped monitor {name}")
+
+    def shutdown(self):
+        for name in list(self.instances):
+            self.stop_monitor(name)
+        # 共有しているアップローダー等を閉じる最初のモニターは最後に終了する
+        for instance in sorted(self.stopped, key=lambda instance: instance is self.shared):
+            try:
+                instance.shutdown()
+            except Exception as e:
+                log.error(f"Failed to shut down monitor {instance.name}: {e}")
+        if self.leases is not None:
+            self.leases.release_all()
+
+#--- MultiMonitorDaemon ---#
+
+
 def main():
+
+    #--- command line ---#
+    # --decompress <dir>: AOBA 側で XDS の前に圧縮されたフレームを復元する
+    # --unbundle <dir>: AOBA 側で XDS の前に bundle (bundle_mode) からフレームを展開する
+    parser = argparse.ArgumentParser(description="Automated transfer of diffraction data to S3.")
+    parser.add_argument("--decompress", metavar="DIR", help="restore compressed frames in DIR and exit")
+    parser.add_argument("--unbundle", metavar="DIR", help="extract the bundled frames of DIR (bundle_mode) and exit")
+    parser.add_argument("--remove-compressed", action="store_true",
+                        help="with --decompress, remove the compressed frames after restoring them")
+    parser.add_argument("--verify", metavar="DATASET_PATH",
+                        help="compare the checksums of a transferred dataset with S3 (no download) and exit")
+    args = parser.parse_args()
+    if args.unbundle:
+        unbundle_directory(args.unbundle)
+        return
+    if args.decompress:
+        decompress_directory(args.decompress, remove=args.remove_compressed)
+        return
     
     #--- load config ---#
     with open("transfer_auto_config.yaml") as fin:
         cfg = yaml.safe_load(fin)
+
+    # monitors または bss_dataset_path の glob (/system/data_transfer/*.txt) で複数のモニターファイルを監視する
+    # monitors: モニターファイル（ビームライン）ごとの設定のリスト. 例:
+    #   - {name: BL09U, bss_dataset_path: /system/data_transfer/BL09U.txt,
+    #      destination_path_via_s3: "s3://mxdata/bl09u/", monitor_mode: new_only, priority: 0, weight: 2}
+    #   エントリに書いた設定 (destination_path_*, data_root, *_mode, wait_time 等) でトップレベルの設定を上書きする
+    #   アップロードの並列数・帯域等はトップレベルの設定で全モニターが共有する (MultiMonitorDaemon.SHARED_SETTINGS)
+    # shard_lease_dir: 複数のデーモン（プロセス・ホスト）でモニターを分担する場合の lease ファイルのディレクトリ（共有FS上）
+    #   state_db 等も共有FS上に置くと, 止まったデーモンのモニターを引き継いだデーモンが中断された転送を再開する
+    # shard_max_monitors: 1 つのデーモンが担当するモニター数の上限, shard_lease_ttl: lease の有効期限（秒）
+    # shard_owner: lease に書く名前（null の場合は <ホスト名>:<pid>）
+    if not args.verify and (cfg.get("monitors") or any(c in cfg["bss_dataset_path"] for c in "*?[")):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        MultiMonitorDaemon(cfg).run()
+        return
         
     auto = AutoTransferAndProcess(cfg=cfg)
-    auto.proc()
+    if args.verify:
+        results = auto.verify_dataset(args.verify)
+        if results is None:
+            sys.exit(2)
+        for status, paths in sorted(results.items()):
+            print(f"{status}: {len(paths)}")
+        sys.exit(0 if set(results) <= {"ok"} else 1)
+
+    if auto.engine == "asyncio":
+        auto.proc_async()
+        return
+
+    # thread engine: SIGTERM でも dataset_paths_for_kamo.txt 等を書き出してから終了する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        auto.proc()
+    except KeyboardInterrupt:
+        log.info("Interrupted.")
+    finally:
+        auto.shutdown()
 #%%
 if __name__ == '__main__':
     main()